@@ -0,0 +1,2 @@
+from .quadratures import QuadratureExtractor, find_pulse_train, boxcar_mode
+from .statistics import QuadratureStatistics, ScanStatistics
@@ -0,0 +1,264 @@
+"""
+Online extraction of the homodyne quadratures from the oscilloscope records.
+
+The balanced detector output is a train of pulses whose areas, once weighted by the temporal mode of
+the local oscillator, are the quadrature values. Instead of storing every sample of every record,
+the pulse train is located once (repetition period and phase, from the spectrum of the record energy)
+and each pulse is then integrated against a mode function:
+
+    q_k = sum_n w_n v(t_k + n)      with sum_n w_n^2 = 1
+
+so that white electronic noise of variance s^2 per sample gives quadratures of variance s^2.
+Everything is computed on the raw codes, for all the pulses and segments at once.
+
+The period is best given (period or rep_rate). Estimated, it needs calibration records with enough
+pulses: with random pulse areas, a few pulses do not make clear spectral lines (a pulse train with
+alternating areas looks twice as long), so the estimate needs min_pulses pulses and is checked on two
+independent halves of the calibration records.
+"""
+
+import numpy as np
+
+
+def find_pulse_train(energy, period=None):
+    """
+    Locates a periodic pulse train in a record.
+
+    :param energy: The squared, baseline-subtracted samples of one record (1D) or of several records (2D, summed).
+    :param period: The repetition period in samples if known, otherwise it is estimated from the spectrum.
+    :return: A tuple (period, offset) in samples, offset being the center of the first pulse, in [0, period).
+    """
+    energy = np.atleast_2d(np.asarray(energy, dtype=np.float64)).sum(axis=0)
+    energy = energy - energy.mean()
+    n = len(energy)
+    samples = np.arange(n)
+    if period is None:
+        spectrum = np.abs(np.fft.rfft(energy))
+        spectrum[:2] = 0
+        # The fundamental is the lowest frequency with a strong line, the harmonics have similar heights
+        k = int(np.flatnonzero(spectrum >= 0.5 * spectrum.max())[0])
+        left, center, right = spectrum[k - 1:k + 2]
+        frequency = (k + 0.5 * (left - right) / (left - 2 * center + right)) / n
+        # The residual frequency error makes the phase drift linearly along the record: the phases
+        # measured on successive chunks of a few periods are fitted with a line
+        chunk = int(8 / frequency)
+        for _ in range(2):
+            chunks = n // chunk
+            if chunks < 3:
+                break
+            sums = (energy * np.exp(-2j * np.pi * frequency * samples))[:chunks * chunk].reshape(chunks, chunk).sum(axis=1)
+            phases = np.unwrap(np.angle(sums))
+            frequency += np.polyfit(np.arange(chunks) * chunk, phases, 1)[0] / (2 * np.pi)
+        period = 1 / frequency
+    # Pulses centered on offset + k * period give a phase of -2 pi offset / period
+    phase = np.angle(np.sum(energy * np.exp(-2j * np.pi * samples / period)))
+    return float(period), float((-phase / (2 * np.pi) * period) % period)
+
+
+def boxcar_mode(width):
+    """
+    Returns a flat mode function of the given width in samples, normalized to a unit L2 norm.
+    """
+    width = max(int(round(width)), 1)
+    return np.full(width, 1 / np.sqrt(width))
+
+
+class QuadratureExtractor:
+    """
+    Integrates every pulse of the records against a mode function.
+
+    Attributes:
+        mode (str): "boxcar" or "template".
+        width (float): The width of the boxcar window in seconds, half a period if None.
+        template (numpy.ndarray): The template mode function, sampled like the records; learned from the
+                                  calibration records if None.
+        period (float): The repetition period in samples, estimated at calibration if None.
+        offset (float): The center of the first pulse in samples, estimated at calibration.
+        pulse_numbers (numpy.ndarray): The pulses integrated in every record, fixed at calibration so that
+                                       every record gives the same number of quadratures.
+        pulses (int): The number of pulses integrated in every record; all the complete pulses of the first
+                      calibration if None, then kept by the following calibrations.
+        weights (numpy.ndarray): The normalized mode function actually used, centered on the pulses.
+        track_phase (bool): If True, the offset is re-estimated on every record to follow trigger jitter.
+        subtract_baseline (bool): If True, the mean of every record is subtracted before integrating.
+    """
+
+    modes = ("boxcar", "template")
+    period_tolerance = 0.01  # Relative disagreement between the halves of the calibration records rejecting an estimated period
+    min_pulses = 40  # Pulses needed in the calibration records to estimate the period
+
+    def __init__(self, mode="boxcar", width=None, template=None, period=None, rep_rate=None, pulses=None, track_phase=True,
+                 subtract_baseline=True):
+        """
+        :param mode: "boxcar" or "template".
+        :param width: The width of the boxcar window in seconds, half a period if None.
+        :param template: The template mode function (any normalization), learned at calibration if None.
+        :param period: The repetition period in samples, if known.
+        :param rep_rate: The repetition rate in Hz, if known; converted to a period with the record x_increment.
+        :param pulses: The number of pulses integrated in every record, all the complete ones of the first calibration if None.
+        :param track_phase: If True, the pulse positions are re-estimated on every record.
+        :param subtract_baseline: If True, the mean of every record is subtracted before integrating.
+        """
+        if mode not in self.modes:
+            raise ValueError(f"invalid mode '{mode}', expected one of {self.modes}")
+        self.mode = mode
+        self.width = width
+        self.template = None if template is None else np.asarray(template, dtype=np.float64)
+        self.period = period
+        self.rep_rate = rep_rate
+        self.offset = None
+        self.pulse_numbers = None
+        self.pulses = pulses
+        self.weights = None
+        self.track_phase = track_phase
+        self.subtract_baseline = subtract_baseline
+
+    @property
+    def calibrated(self):
+        return self.weights is not None
+
+    def _energy(self, codes):
+        codes = np.atleast_2d(codes).astype(np.float32)
+        if self.subtract_baseline:
+            codes -= codes.mean(axis=1, keepdims=True)
+        return codes, codes ** 2
+
+    def calibrate(self, codes, preamble):
+        """
+        Locates the pulse train and builds the mode function from one or several records.
+
+        :param codes: The raw codes of one record (1D) or of several records (2D, one per row).
+        :param preamble: The preamble tuple returned by InfiniiumOscilloscope.get_preamble.
+        :return: The extractor itself.
+        """
+        x_increment = preamble[0]
+        codes, energy = self._energy(codes)
+        period = self.period
+        if period is None and self.rep_rate is not None:
+            period = 1 / (self.rep_rate * x_increment)
+        if period is None:
+            period = self._estimate_period(energy)
+        self.period, self.offset = find_pulse_train(energy, period)
+        if self.mode == "boxcar":
+            width = self.period / 2 if self.width is None else self.width / x_increment
+            weights = boxcar_mode(width)
+        elif self.template is not None:
+            weights = self.template
+        else:
+            # The temporal mode is learned as the rms profile of the pulses around their centers
+            window = np.arange(2 * int(self.period // 2) + 1)
+            pulse_numbers = self._pulse_numbers(len(window), codes.shape[1])
+            if len(pulse_numbers) < 2:
+                raise ValueError(f"{len(pulse_numbers)} complete pulses of {self.period:.1f} samples in the calibration records, "
+                                 f"at least 2 are needed to learn the template")
+            starts = self._starts(np.full(len(codes), self.offset), pulse_numbers, len(window))
+            profile = energy[np.arange(len(codes))[:, None, None], starts[:, :, None] + window].mean(axis=(0, 1))
+            weights = np.sqrt(np.clip(profile - np.median(profile), 0, None))
+        pulse_numbers = self._pulse_numbers(len(weights), codes.shape[1])
+        needed = 2 if self.pulses is None else self.pulses
+        if len(pulse_numbers) < needed:
+            raise ValueError(f"{len(pulse_numbers)} complete pulses of {self.period:.1f} samples in records of {codes.shape[1]} points, "
+                             f"{needed} are needed")
+        self.weights = weights / np.linalg.norm(weights)
+        self.pulse_numbers = pulse_numbers[:needed] if self.pulses is not None else pulse_numbers
+        self.pulses = len(self.pulse_numbers)
+        return self
+
+    def calibration(self):
+        """
+        Returns the calibration as a JSON-serializable dict, e.g. to store it with a run and restore it with
+        from_calibration when the run is resumed: a new calibration would give other quadratures.
+        """
+        if not self.calibrated:
+            raise ValueError("the extractor is not calibrated")
+        return {"mode": self.mode, "period": self.period, "offset": self.offset, "pulses": self.pulses,
+                "pulse_numbers": self.pulse_numbers.tolist(), "weights": self.weights.tolist(),
+                "track_phase": self.track_phase, "subtract_baseline": self.subtract_baseline}
+
+    @classmethod
+    def from_calibration(cls, calibration):
+        """
+        Returns a calibrated extractor from the dict returned by calibration.
+
+        :param calibration: The dict returned by calibration.
+        """
+        extractor = cls(calibration["mode"], period=calibration["period"], pulses=calibration["pulses"],
+                        track_phase=calibration["track_phase"], subtract_baseline=calibration["subtract_baseline"])
+        extractor.offset = calibration["offset"]
+        extractor.pulse_numbers = np.array(calibration["pulse_numbers"], dtype=np.int64)
+        extractor.weights = np.array(calibration["weights"], dtype=np.float64)
+        return extractor
+
+    def _estimate_period(self, energy):
+        """
+        Estimates the period on the whole calibration records and checks it on two independent halves of them:
+        the even and odd records, or the two halves of a single record.
+        """
+        if len(energy) > 1:
+            halves = (energy[::2], energy[1::2])
+        else:
+            halves = (energy[:, :energy.shape[1] // 2], energy[:, energy.shape[1] // 2:])
+        period = find_pulse_train(energy)[0]
+        pulses = energy.size / period
+        if round(pulses) < self.min_pulses:
+            raise ValueError(f"{pulses:.0f} pulses of {period:.1f} samples in the calibration records, the period is only estimated "
+                             f"from {self.min_pulses} pulses: give period or rep_rate, or calibrate on more records")
+        estimates = []
+        for half in halves:
+            try:
+                estimates.append(find_pulse_train(half)[0])
+            except (ValueError, IndexError):
+                estimates.append(np.nan)
+        if not all(abs(estimate - period) <= self.period_tolerance * period for estimate in estimates):
+            raise ValueError(f"the repetition period could not be estimated reliably ({period:.2f} samples, "
+                             f"{estimates[0]:.2f} and {estimates[1]:.2f} on the halves of the calibration records), "
+                             f"give period or rep_rate, or calibrate on more records")
+        return period
+
+    def _pulse_numbers(self, length, points):
+        """
+        Returns the numbers of the pulses whose window of the given length is complete in a record,
+        wherever phase tracking moves the offset within half a period. The count only depends on the
+        period and the record length, not on the offset, so that calibrations give the same number of pulses.
+        """
+        half = (length - 1) / 2
+        first = int(np.ceil((half - self.offset + self.period / 2) / self.period))
+        # Pulses centered in an interval of this length, the smallest number found wherever the offset is
+        count = int(np.floor((points - 1 - 2 * half - self.period) / self.period))
+        return np.arange(first, first + max(count, 0))
+
+    def _starts(self, offsets, pulse_numbers, length):
+        """
+        Returns the first sample of the window of every pulse of every record, as a (records, pulses) array.
+        """
+        return np.rint(offsets[:, None] + pulse_numbers * self.period - (length - 1) / 2).astype(np.int64)
+
+    def extract(self, codes, preamble):
+        """
+        Integrates every complete pulse of the records against the mode function. Calibrates on these
+        records first if the extractor is not calibrated yet.
+
+        :param codes: The raw codes of one record (1D) or of several records (2D, one per row).
+        :param preamble: The preamble tuple returned by InfiniiumOscilloscope.get_preamble.
+        :return: A (records x pulses) float32 array of quadratures, in volts.
+        """
+        if not self.calibrated:
+            self.calibrate(codes, preamble)
+        y_increment = preamble[3]
+        y_origin = preamble[4]
+        codes, energy = self._energy(codes)
+        offsets = np.full(len(codes), self.offset)
+        if self.track_phase:
+            phasor = np.exp(-2j * np.pi * np.arange(codes.shape[1]) / self.period)
+            measured = -np.angle(energy @ phasor) / (2 * np.pi) * self.period  # Same convention as find_pulse_train
+            # Keeps every record within half a period of the calibration, so that pulses are not renumbered
+            offsets += (measured - self.offset + self.period / 2) % self.period - self.period / 2
+        starts = self._starts(offsets, self.pulse_numbers, len(self.weights))
+        window = np.arange(len(self.weights))
+        pulses = codes[np.arange(len(codes))[:, None, None], starts[:, :, None] + window]
+        quadratures = (pulses @ self.weights.astype(np.float32)) * y_increment
+        if not self.subtract_baseline:
+            quadratures += y_origin * self.weights.sum()
+        return quadratures.astype(np.float32)
+
+    __call__ = extract
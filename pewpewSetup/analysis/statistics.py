@@ -0,0 +1,237 @@
+"""
+Streaming statistics of the quadratures, per scan position.
+
+Every acquisition updates the moments (count, mean and central moments up to the fourth order) and a
+fixed-bin histogram of its position in O(batch), with the pairwise update formulas of Welford/Chan/Pébay:
+a batch is summarized on its own and merged into the running state. The same merge combines the
+states of repeated passes or of separate runs, so memory does not depend on the number of shots.
+
+Shot noise and squeezing estimates are taken against a reference variance (vacuum input), measured
+at a reference position of the scan or given explicitly, with optional electronic noise subtraction.
+"""
+
+import os
+import numpy as np
+
+
+class QuadratureStatistics:
+    """
+    Running moments and histogram of the quadratures of one scan position.
+
+    Attributes:
+        count (int): The number of quadratures accumulated.
+        mean (float): Their mean.
+        m2, m3, m4 (float): The sums of the 2nd, 3rd and 4th powers of the deviations from the mean.
+        edges (numpy.ndarray): The fixed histogram bin edges.
+        histogram (numpy.ndarray): The counts in every bin.
+        underflow, overflow (int): The counts below and above the histogram range.
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = self.m3 = self.m4 = 0.0
+        self.histogram = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.underflow = self.overflow = 0
+
+    def _merge_moments(self, count, mean, m2, m3, m4):
+        n_a, n_b = self.count, count
+        n = n_a + n_b
+        if n_b == 0:
+            return
+        if n_a == 0:
+            self.count, self.mean, self.m2, self.m3, self.m4 = n_b, mean, m2, m3, m4
+            return
+        delta = mean - self.mean
+        self.m4 += (m4 + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3
+                    + 6 * delta ** 2 * (n_a ** 2 * m2 + n_b ** 2 * self.m2) / n ** 2
+                    + 4 * delta * (n_a * m3 - n_b * self.m3) / n)
+        self.m3 += (m3 + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+                    + 3 * delta * (n_a * m2 - n_b * self.m2) / n)
+        self.m2 += m2 + delta ** 2 * n_a * n_b / n
+        self.mean += delta * n_b / n
+        self.count = n
+
+    def update(self, values):
+        """
+        Accumulates a batch of quadratures.
+
+        :param values: The quadratures, any shape.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        deviations = values - mean
+        squares = deviations ** 2
+        self._merge_moments(len(values), mean, squares.sum(), (squares * deviations).sum(), (squares ** 2).sum())
+        bins = np.searchsorted(self.edges, values, side="right") - 1
+        self.underflow += int(np.count_nonzero(bins < 0))
+        # The last edge is included in the last bin, as np.histogram does
+        bins[values == self.edges[-1]] = len(self.histogram) - 1
+        self.overflow += int(np.count_nonzero(bins >= len(self.histogram)))
+        self.histogram += np.bincount(bins[(bins >= 0) & (bins < len(self.histogram))], minlength=len(self.histogram))
+
+    def merge(self, other):
+        """
+        Adds the state of another accumulator with the same histogram edges, e.g. from another pass.
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("cannot merge statistics with different histogram edges")
+        self._merge_moments(other.count, other.mean, other.m2, other.m3, other.m4)
+        self.histogram += other.histogram
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def skewness(self):
+        return np.sqrt(self.count) * self.m3 / self.m2 ** 1.5 if self.m2 > 0 else np.nan
+
+    @property
+    def excess_kurtosis(self):
+        return self.count * self.m4 / self.m2 ** 2 - 3 if self.m2 > 0 else np.nan
+
+    @property
+    def density(self):
+        """
+        The histogram normalized as a probability density over the bins.
+        """
+        total = self.histogram.sum()
+        return self.histogram / (total * np.diff(self.edges)) if total else np.zeros(len(self.histogram))
+
+
+class ScanStatistics:
+    """
+    QuadratureStatistics of every position of a scan, with checkpointing and noise estimates.
+
+    Attributes:
+        edges (numpy.ndarray): The histogram bin edges shared by all positions, fixed at the first update if not given.
+        positions (dict): The QuadratureStatistics of each stage position.
+        reference_position (float): The position whose variance is the shot noise (vacuum) reference, or None.
+        shot_noise_variance (float): The shot noise variance used when there is no reference position.
+        electronic_variance (float): The electronic noise variance subtracted from every variance.
+    """
+
+    def __init__(self, bins=256, limits=None, reference_position=None, shot_noise_variance=None, electronic_variance=0.0):
+        """
+        :param bins: The number of histogram bins.
+        :param limits: The (low, high) histogram range, or None to take +-8 standard deviations around the mean of the first batch.
+        :param reference_position: The position measuring the shot noise, if any.
+        :param shot_noise_variance: The shot noise variance, if known from a separate measurement.
+        :param electronic_variance: The electronic noise variance (detector blocked), subtracted from every variance.
+        """
+        self.bins = bins
+        self.edges = None if limits is None else np.linspace(limits[0], limits[1], bins + 1)
+        self.positions = {}
+        self.reference_position = reference_position
+        self.shot_noise_variance = shot_noise_variance
+        self.electronic_variance = electronic_variance
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, position):
+        return self.positions[float(position)]
+
+    def update(self, position, quadratures):
+        """
+        Accumulates the quadratures of an acquisition at a stage position.
+
+        :return: The QuadratureStatistics of the position.
+        """
+        quadratures = np.asarray(quadratures, dtype=np.float64)
+        if self.edges is None:
+            spread = 8 * quadratures.std() or 1.0
+            self.edges = np.linspace(quadratures.mean() - spread, quadratures.mean() + spread, self.bins + 1)
+        position = float(position)
+        if position not in self.positions:
+            self.positions[position] = QuadratureStatistics(self.edges)
+        self.positions[position].update(quadratures)
+        return self.positions[position]
+
+    def merge(self, other):
+        """
+        Adds the statistics of another scan (e.g. another pass or run over the same positions).
+        """
+        for position, statistics in other.positions.items():
+            if self.edges is None:
+                self.edges = statistics.edges
+            if position not in self.positions:
+                self.positions[position] = QuadratureStatistics(self.edges)
+            self.positions[position].merge(statistics)
+
+    def shot_noise(self):
+        """
+        Returns the shot noise variance, from the reference position if there is one, with the electronic noise subtracted.
+        """
+        if self.reference_position is not None and float(self.reference_position) in self.positions:
+            variance = self.positions[float(self.reference_position)].variance
+        elif self.shot_noise_variance is not None:
+            variance = self.shot_noise_variance
+        else:
+            return np.nan
+        return variance - self.electronic_variance
+
+    def squeezing_db(self, position):
+        """
+        Returns the noise of a position relative to the shot noise, in dB (negative when squeezed).
+        """
+        return 10 * np.log10((self[position].variance - self.electronic_variance) / self.shot_noise())
+
+    def summary(self):
+        """
+        Returns a structured array with the count, mean, variance, skewness, excess kurtosis and noise in dB of every position.
+        """
+        table = np.zeros(len(self.positions), dtype=[("position", "f8"), ("count", "i8"), ("mean", "f8"), ("variance", "f8"),
+                                                      ("skewness", "f8"), ("excess_kurtosis", "f8"), ("noise_db", "f8")])
+        for i, position in enumerate(sorted(self.positions)):
+            statistics = self.positions[position]
+            table[i] = (position, statistics.count, statistics.mean, statistics.variance, statistics.skewness,
+                       statistics.excess_kurtosis, self.squeezing_db(position))
+        return table
+
+    def save(self, path):
+        """
+        Writes a checkpoint of the whole state; the file is replaced atomically, so it is always readable.
+        """
+        positions = sorted(self.positions)
+        states = [self.positions[position] for position in positions]
+        tmp_name = path + ".tmp"
+        with open(tmp_name, "wb") as f:
+            np.savez(f,
+                     positions=np.array(positions, dtype=np.float64),
+                     edges=self.edges if self.edges is not None else np.zeros(0),
+                     counts=np.array([s.count for s in states], dtype=np.int64),
+                     moments=np.array([(s.mean, s.m2, s.m3, s.m4) for s in states], dtype=np.float64).reshape(-1, 4),
+                     histograms=np.array([s.histogram for s in states], dtype=np.int64).reshape(len(states), self.bins),
+                     outside=np.array([(s.underflow, s.overflow) for s in states], dtype=np.int64).reshape(-1, 2),
+                     noise=np.array([np.nan if self.reference_position is None else self.reference_position,
+                                     np.nan if self.shot_noise_variance is None else self.shot_noise_variance,
+                                     self.electronic_variance]))
+        os.replace(tmp_name, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restores the state written by save, e.g. to resume a scan or to merge runs.
+        """
+        with np.load(path) as data:
+            reference_position, shot_noise_variance, electronic_variance = data["noise"]
+            statistics = cls(bins=data["histograms"].shape[1],
+                             reference_position=None if np.isnan(reference_position) else float(reference_position),
+                             shot_noise_variance=None if np.isnan(shot_noise_variance) else float(shot_noise_variance),
+                             electronic_variance=float(electronic_variance))
+            statistics.edges = data["edges"] if len(data["edges"]) else None
+            for i, position in enumerate(data["positions"]):
+                state = QuadratureStatistics(statistics.edges)
+                state.count = int(data["counts"][i])
+                state.mean, state.m2, state.m3, state.m4 = (float(value) for value in data["moments"][i])
+                state.histogram = data["histograms"][i].copy()
+                state.underflow, state.overflow = (int(value) for value in data["outside"][i])
+                statistics.positions[float(position)] = state
+        return statistics
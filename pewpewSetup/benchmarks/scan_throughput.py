@@ -0,0 +1,132 @@
+"""
+End-to-end scan throughput benchmark on the simulated oscilloscope and stage.
+
+Runs scan.py-style scans (PIStage on the serial backend, InfiniiumOscilloscope, RunWriter, ScanPlan,
+PipelinedScan) against simulation.MercurySimulator and simulation.SimulatedInfiniium, for several
+record lengths and step counts, and reports positions/s, bytes/s and the per-phase time split.
+No hardware is needed; the stage simulator uses a pseudo-terminal, so this runs on Linux or macOS.
+
+Run from the pewpewSetup directory:
+    python -m benchmarks.scan_throughput
+    python -m benchmarks.scan_throughput --points 1000 32000 --steps 5 20 --segments 1 100
+    python -m benchmarks.scan_throughput --sources channel1 channel2 function1
+    python -m benchmarks.scan_throughput --points 32000 --steps 5 --trace trace   # writes trace_32000_5_1.json
+    python -m benchmarks.scan_throughput --points 1000 --fly 0.01   # fly scans at 0.01 mm/s instead of step scans
+"""
+
+import argparse
+import contextlib
+import io
+import tempfile
+
+import numpy as np
+from devices.PIStage import PIStage
+from devices.InfiniiumOscilloscope import InfiniiumOscilloscope
+from scanning import FlyScan, PipelinedScan, ScanPlan, ScanTimings
+from simulation import MercurySimulator, SimulatedResourceManager
+from storage import RunWriter
+from tracing import Tracer
+
+channel = "channel1"
+waveform_format = "BYTE"
+bounds = [0, 25]
+scan_span = 10e-3  # mm, same range as scan.py
+
+
+def run_scan(points, steps, segments=1, baud_rate=9600, bandwidth=25e6, sources=(channel,), tracer=None, fly=None, position_every=1):
+    """
+    Runs one simulated scan and returns its ScanTimings and the number of bytes stored.
+    Several sources are acquired together with multi_channel_acquisition; function1 is the difference of channels 1 and 2.
+    If a tracing.Tracer is given, it records the SCPI and serial calls and the scan phases.
+    If fly is a velocity in mm/s, a FlyScan crosses the range at that velocity, reading the position every position_every shots,
+    and steps is ignored.
+    """
+    stored = []
+    acquisitions = []
+    settings = dict(channel=channel, trigger_level="330E-3", scale=0.1, offset=0.0, time_scale="1e-6",
+                    time_position=0.0, acquire_mode="RTIMe" if segments == 1 else "SEGMented", waveform_points=points)
+
+    with MercurySimulator(axes=(1,), baud_rate=baud_rate) as sim, tempfile.TemporaryDirectory() as folder:
+        # The drivers report every step on stdout, which would dominate the measurement on a terminal
+        with contextlib.redirect_stdout(io.StringIO()):
+            oscilloscope = InfiniiumOscilloscope("SIM::INSTR", error_policy="group", tracer=tracer,
+                                                 resource_manager=SimulatedResourceManager(bandwidth=bandwidth, seed=0))
+            oscilloscope.initialize()
+            stage = PIStage(bounds=bounds, com_port=sim.port, backend="serial")
+            if tracer is not None:
+                stage.wrapper.enable_tracing(tracer)
+            run = RunWriter(f"{folder}/run", metadata=dict(points=points, segments=segments, sources=list(sources)))
+            if any(source.startswith("function") for source in sources):
+                oscilloscope.do_command(":FUNCtion1:SUBTract CHANnel1,CHANnel2")
+
+            def acquire():
+                if len(sources) > 1:
+                    oscilloscope.configure_acquisition(autoscale=not acquisitions, **settings)
+                    oscilloscope.multi_channel_acquisition(sources, segments, waveform_format, fetch=False)
+                elif segments > 1:
+                    oscilloscope.configure_acquisition(autoscale=not acquisitions, **settings)
+                    oscilloscope.segmented_acquisition(channel=channel, segments=segments, waveform_points=points,
+                                                       waveform_format=waveform_format, fetch=False)
+                else:
+                    oscilloscope.single_acquisition(autoscale=not acquisitions, **settings)
+                acquisitions.append(1)
+
+            def transfer():
+                if len(sources) > 1:
+                    shots, preambles = oscilloscope.fetch_sources(sources, segments, waveform_format)
+                    # One row per segment with the sources side by side
+                    return shots.view(shots.dtype[0].base).reshape(len(shots), -1), preambles[sources[0]]
+                if segments > 1:
+                    return oscilloscope.fetch_segments(channel=channel, segments=segments, waveform_format=waveform_format)
+                return oscilloscope.get_waveform(channel=channel, waveform_format=waveform_format, name_csv=None)
+
+            def store(position, waveform):
+                run.append(position, waveform[0], waveform[-1])
+                stored.append(waveform[0].nbytes)
+
+            if fly is not None:
+                timings = FlyScan(stage, acquire, transfer, store, tracer=tracer).run(0.0, scan_span, fly, position_every=position_every)
+            else:
+                plan = ScanPlan.linear(0.0, scan_span, steps, stage.wrapper, current_position=stage.get_position(), bounds=bounds)
+                timings = PipelinedScan(stage, acquire, transfer, store, tracer=tracer).run(plan)
+            run.close()
+            stage.close()
+            oscilloscope.close()
+    return timings, sum(stored)
+
+
+def report(points, steps, segments, sources, timings, stored):
+    positions = len(timings.phases["acquire"])
+    phases = "  ".join(f"{name} {np.sum(timings.phases[name]) / timings.wall * 100:4.1f}%" for name in ScanTimings.phase_names)
+    print(f"{points:>8d} {steps:>6d} {segments:>8d} {len(sources):>7d} {positions / timings.wall:10.2f} "
+          f"{stored / timings.wall / 1e6:10.2f}   {phases}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--points", type=int, nargs="+", default=[1000, 32000, 256000], help="record lengths")
+    parser.add_argument("--steps", type=int, nargs="+", default=[5, 20], help="numbers of stage positions")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1], help="segments per position (1 for single acquisitions)")
+    parser.add_argument("--sources", nargs="+", default=[channel], help="sources acquired together (channel1 ... channel4, function1)")
+    parser.add_argument("--baud-rate", type=int, default=9600, help="simulated stage line rate, 0 for no delay")
+    parser.add_argument("--bandwidth", type=float, default=25e6, help="simulated scope transfer rate, in bytes/s")
+    parser.add_argument("--fly", type=float, help="fly scan velocity in mm/s; one fly scan per record length replaces the step scans")
+    parser.add_argument("--position-every", type=int, default=1, help="shots between two position reads of a fly scan")
+    parser.add_argument("--trace", help="prefix of the Chrome/Perfetto trace written for every scan, with a latency table")
+    args = parser.parse_args(argv)
+
+    print(f"{'points':>8s} {'steps':>6s} {'segments':>8s} {'sources':>7s} {'pos/s':>10s} {'MB/s':>10s}   share of the wall time")
+    for segments in args.segments:
+        for points in args.points:
+            for steps in args.steps if args.fly is None else [0]:
+                tracer = Tracer() if args.trace else None
+                timings, stored = run_scan(points, steps, segments, args.baud_rate or None, args.bandwidth, args.sources,
+                                           tracer, args.fly, args.position_every)
+                report(points, len(timings.phases["acquire"]), segments, args.sources, timings, stored)
+                if tracer is not None:
+                    tracer.summary()
+                    tracer.export_chrome_trace(f"{args.trace}_{points}_{steps}_{segments}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark of InfiniiumOscilloscope.get_waveform writing a CSV file.
+
+Compares the historical get_waveform (separate scaling queries, struct.unpack and one f.write per sample)
+with the current one on the simulated oscilloscope, on the same acquisition, and checks that both write
+byte for byte identical CSV files. The transfer model of the simulator is disabled, so the times are
+those of the host: queries, decoding and formatting.
+
+Run from the pewpewSetup directory:
+    python -m benchmarks.waveform_decode
+    python -m benchmarks.waveform_decode 32000 1000000
+"""
+
+import contextlib
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+from devices.InfiniiumOscilloscope import InfiniiumOscilloscope, units_dict
+from simulation import SimulatedResourceManager
+
+default_sizes = [32000, 1000000, 16000000]
+
+
+def legacy_get_waveform(oscilloscope, channel, name_csv):
+    """
+    Retrieves a waveform and writes it the way get_waveform used to do it, preamble included.
+
+    :param oscilloscope: The InfiniiumOscilloscope.
+    :param channel: The source of the waveform.
+    :param name_csv: The name of the CSV file to write.
+    """
+    oscilloscope.do_query_string(":WAVeform:TYPE?")
+    oscilloscope.do_query_string(":WAVeform:POINts?")
+    oscilloscope.do_command(f":WAVeform:SOURce {channel}")
+    oscilloscope.do_query_string(":WAVeform:SOURce?")
+    oscilloscope.do_command(":WAVeform:FORMat BYTE")
+    oscilloscope.do_query_string(":WAVeform:FORMat?")
+    fields = oscilloscope.do_query_string(":WAVeform:PREamble?").split(",")
+    date, acq_time = fields[15], fields[16]
+    x_units, y_units = units_dict[int(fields[20])], units_dict[int(fields[21])]
+    x_increment = oscilloscope.do_query_number(":WAVeform:XINCrement?")
+    x_origin = oscilloscope.do_query_number(":WAVeform:XORigin?")
+    y_increment = oscilloscope.do_query_number(":WAVeform:YINCrement?")
+    y_origin = oscilloscope.do_query_number(":WAVeform:YORigin?")
+    oscilloscope.do_command(":WAVeform:STReaming OFF")
+    sData = oscilloscope.do_query_ieee_block(":WAVeform:DATA?")
+    values = struct.unpack("%db" % len(sData), sData)
+    with open(name_csv, "w") as f:
+        f.write("%s, %s\n" % ("date", date))
+        f.write("%s, %s\n" % ("time", acq_time))
+        f.write(f"Time ({x_units}), Voltage ({y_units})\n")
+        for i in range(len(values)):
+            time_val = x_origin + (i * x_increment)
+            voltage = (values[i] * y_increment) + y_origin
+            f.write(f"{time_val:E}, {voltage:f}\n")
+
+
+def run(points):
+    """
+    Times both versions of get_waveform on one simulated acquisition of the given length and prints the speedup.
+
+    :param points: The number of waveform points.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        oscilloscope = InfiniiumOscilloscope("SIM::INSTR", error_policy="group",
+                                             resource_manager=SimulatedResourceManager(latency=0.0, bandwidth=np.inf, seed=0))
+        oscilloscope.do_command(f":ACQuire:POINts {points}")
+        oscilloscope.do_command(":DIGitize CHANnel1")
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_csv = os.path.join(tmp, "legacy.csv")
+        numpy_csv = os.path.join(tmp, "numpy.csv")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            legacy_get_waveform(oscilloscope, "CHANnel1", legacy_csv)
+            legacy_time = time.perf_counter() - start
+
+            # The settings sent by the legacy version are forgotten, so that get_waveform sends its own
+            oscilloscope.invalidate_settings()
+            start = time.perf_counter()
+            oscilloscope.get_waveform("CHANnel1", "BYTE", numpy_csv)
+            numpy_time = time.perf_counter() - start
+
+        with open(legacy_csv, "rb") as f:
+            legacy_bytes = f.read()
+        with open(numpy_csv, "rb") as f:
+            identical = f.read() == legacy_bytes
+
+    print(f"{points:>10d} points: legacy {legacy_time:8.3f} s, get_waveform {numpy_time:8.3f} s, "
+          f"speedup x{legacy_time / numpy_time:5.1f}, identical output: {identical}")
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or default_sizes
+    for points in sizes:
+        run(points)
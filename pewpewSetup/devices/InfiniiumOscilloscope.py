@@ -1,6 +1,9 @@
 import pyvisa
-import struct
+import numpy as np
+import asyncio
 import sys
+import time
+from contextlib import contextmanager
 
 trig_mode_disct = {
     0: "EDGE",
@@ -28,6 +31,13 @@ wav_form_dict = {
     3 : "LONG",
     4 : "LONGLONG",
 }
+# struct/NumPy type codes of the binary waveform formats
+wav_dtype_dict = {
+    "BYTE" : "b",
+    "WORD" : "h",
+    "LONG" : "i",
+    "LONGLONG" : "q",
+}
 acq_type_dict = {
     1 : "RAW",
     2 : "AVERage",
@@ -47,6 +57,13 @@ coupling_dict = {
     2 : "DCFIFTY",
     3 : "LFREJECT",
 }
+# When instrument errors are checked:
+#   "command": after every command (one ":SYSTem:ERRor?" round-trip per command)
+#   "group": once at the end of each command group, commands outside groups are checked one by one
+#   "esr": like "group", but the check reads "*ESR?" and only drains the error queue when an error bit is set
+error_policies = ("command", "group", "esr")
+esr_error_bits = 0x3C  # Query (4), device dependent (8), execution (16) and command (32) errors
+
 units_dict = {
     0 : "UNKNOWN",
     1 : "VOLT",
@@ -55,22 +72,362 @@ units_dict = {
     4 : "AMP",
     5 : "DECIBEL",
 }
+# Settings changing the preamble: a command starting with one of these headers discards the cached preambles
+# (the preambles are cached per waveform source, so selecting another source keeps them). Headers are compared in
+# the form returned by canonical_header, e.g. ":TIM" for ":TIMebase" and ":CHAN" for ":CHANnel1" or ":CHAN1"
+preamble_settings = (":WAV:FORM", ":WAV:SEGM", ":TIM", ":CHAN", ":FUNC", ":ACQ")
+# Commands starting an acquisition: the date, time and x origin of the preambles belong to one acquisition, so they
+# discard the cached preambles as well
+acquisition_commands = (":DIG", ":SING", ":RUN")
+
+
+def canonical_header(header):
+    """
+    Returns the upper-case short form of a SCPI command header, so that the long and short forms of a header match,
+    e.g. ":CHAN1:SCAL" for ":CHANnel1:SCALe", ":CHANNEL1:SCALE" or ":chan1:scal". The short form of a mnemonic is
+    its first four letters, or three if the fourth one is a vowel, followed by its numeric suffix.
+
+    :param header: The header of a command (without its arguments).
+    """
+    header = header.strip().upper()
+    if header.startswith("*"):
+        return header
+    nodes = []
+    for node in header.split(":"):
+        name = node.rstrip("0123456789")
+        suffix = node[len(name):]
+        if len(name) > 4:
+            name = name[:3] if name[3] in "AEIOU" else name[:4]
+        nodes.append(name + suffix)
+    return ":".join(nodes)
+
+
+def _format_rows(times, voltages):
+    """
+    Formats (time, voltage) pairs as the "%E, %f" lines of the waveform CSV files, with a single format operation.
+    """
+    return ("%E, %f\n" * len(times)) % tuple(np.column_stack((times, voltages)).ravel().tolist())
+
+
+def decode_waveform(block, y_increment, y_origin, dtype=np.int8):
+    """
+    Decodes a waveform block into voltages without leaving NumPy.
+
+    :param block: The raw bytes returned by ":WAVeform:DATA?", or the codes already read as a NumPy array.
+    :param y_increment: The voltage step between two consecutive codes (from the preamble).
+    :param y_origin: The voltage corresponding to code 0 (from the preamble).
+    :param dtype: The type of the codes when block is raw bytes (int8 for BYTE, ">i2" for big endian WORD, ...).
+    :return: A tuple (codes, voltages) with the integer codes and the float64 voltages.
+    """
+    if isinstance(block, np.ndarray):
+        codes = block
+    else:
+        codes = np.frombuffer(block, dtype=dtype)  # View on the block, no copy
+    voltages = codes * y_increment + y_origin
+    return codes, voltages
+
+
+def write_waveform_csv(name_csv, voltages, x_increment, x_origin, x_units, y_units, date, time, chunk_size=65536):
+    """
+    Writes a waveform to a CSV file with the same layout as the historical per-sample writer.
+    Rows are formatted in chunks by a single "%" format operation per chunk, so the output is identical
+    to f"{time:E}, {voltage:f}".
+
+    :param name_csv: The name of the CSV file where the waveform data will be saved.
+    :param voltages: The voltages of the waveform samples, as a NumPy array.
+    :param x_increment: The time step between two consecutive samples.
+    :param x_origin: The time of the first sample.
+    :param x_units: The units of the time axis.
+    :param y_units: The units of the voltage axis.
+    :param date: The acquisition date reported in the preamble.
+    :param time: The acquisition time reported in the preamble.
+    :param chunk_size: The number of rows formatted at once.
+    """
+    with open(name_csv, "w") as f:
+        f.write("%s, %s\n" % ("date", date))
+        f.write("%s, %s\n" % ("time", time))
+        f.write(f"Time ({x_units}), Voltage ({y_units})\n")
+        for start in range(0, len(voltages), chunk_size):
+            stop = min(start + chunk_size, len(voltages))
+            times = x_origin + np.arange(start, stop) * x_increment
+            f.write(_format_rows(times, np.asarray(voltages[start:stop], dtype=float)))
+
+
+class WaveformPreamble:
+    """
+    The 24 fields of a ":WAVeform:PREamble?" response, parsed once.
+
+    For compatibility with the tuples returned before, indexing and unpacking give
+    (x_increment, x_origin, x_units, y_increment, y_origin, y_units, date, time).
+
+    Attributes:
+        waveform_format (str): The waveform format (see wav_form_dict).
+        acquire_type (str): The acquisition type (see acq_type_dict).
+        points (int): The number of points of the waveform.
+        average_count (int): The number of averages.
+        x_increment, x_origin, x_reference (float): The time scaling, time = (index - x_reference) * x_increment + x_origin.
+        y_increment, y_origin, y_reference (float): The vertical scaling, voltage = (code - y_reference) * y_increment + y_origin.
+        coupling (str): The input coupling (see coupling_dict).
+        x_display_range, x_display_origin, y_display_range, y_display_origin (float): The display window.
+        date, time (str): The date and time of the acquisition, as quoted strings (e.g. '"4 MAR 2003"').
+        frame_model (str): The model and serial number of the oscilloscope, as a quoted string.
+        acquire_mode (str): The acquisition mode (see acq_mode_dict).
+        completion (int): The percentage of the waveform that was acquired.
+        x_units, y_units (str): The units of the axes (see units_dict).
+        max_bandwidth_limit, min_bandwidth_limit (float): The bandwidth limits.
+    """
+
+    def __init__(self, preamble_string):
+        """
+        :param preamble_string: The response of ":WAVeform:PREamble?".
+        """
+        fields = preamble_string.strip().split(",")
+        if len(fields) != 24:
+            raise ValueError(f"expected 24 preamble fields, received {len(fields)}")
+        (wav_form, acq_type, points, average_count, x_increment, x_origin, x_reference, y_increment, y_origin,
+         y_reference, coupling, x_display_range, x_display_origin, y_display_range, y_display_origin,
+         date, time, frame_model, acq_mode, completion, x_units, y_units, max_bw_limit, min_bw_limit) = fields
+        self.waveform_format = wav_form_dict.get(int(wav_form), wav_form)
+        self.acquire_type = acq_type_dict.get(int(acq_type), acq_type)
+        self.points = int(float(points))
+        self.average_count = int(float(average_count))
+        self.x_increment = float(x_increment)
+        self.x_origin = float(x_origin)
+        self.x_reference = float(x_reference)
+        self.y_increment = float(y_increment)
+        self.y_origin = float(y_origin)
+        self.y_reference = float(y_reference)
+        self.coupling = coupling_dict.get(int(coupling), coupling)
+        self.x_display_range = float(x_display_range)
+        self.x_display_origin = float(x_display_origin)
+        self.y_display_range = float(y_display_range)
+        self.y_display_origin = float(y_display_origin)
+        self.date = date
+        self.time = time
+        self.frame_model = frame_model
+        self.acquire_mode = acq_mode_dict.get(int(acq_mode), acq_mode)
+        self.completion = int(float(completion))
+        self.x_units = units_dict.get(int(x_units), x_units)
+        self.y_units = units_dict.get(int(y_units), y_units)
+        self.max_bandwidth_limit = float(max_bw_limit)
+        self.min_bandwidth_limit = float(min_bw_limit)
+
+    def _legacy(self):
+        return (self.x_increment, self.x_origin, self.x_units, self.y_increment, self.y_origin, self.y_units, self.date, self.time)
+
+    def __getitem__(self, index):
+        return self._legacy()[index]
+
+    def __iter__(self):
+        return iter(self._legacy())
+
+    def __len__(self):
+        return 8
+
+    def __str__(self):
+        return "\n".join([
+            f"Waveform format: {self.waveform_format}",
+            f"Acquire type: {self.acquire_type}",
+            f"Waveform points: {self.points}",
+            f"Waveform average count: {self.average_count}",
+            f"Waveform X increment: {self.x_increment}",
+            f"Waveform X origin: {self.x_origin}",
+            f"Waveform Y increment: {self.y_increment}",
+            f"Waveform Y origin: {self.y_origin}",
+            f"Coupling: {self.coupling}",
+            f"Waveform X display range: {self.x_display_range}",
+            f"Waveform Y display range: {self.y_display_range}",
+            f"Date: {self.date}",
+            f"Time: {self.time}",
+            f"Acquire mode: {self.acquire_mode}",
+            f"Waveform X units: {self.x_units}",
+            f"Waveform Y units: {self.y_units}",
+        ])
+
+    def times(self, points=None):
+        """
+        Returns the time of every sample.
+
+        :param points: The number of samples, the preamble points if None.
+        """
+        points = self.points if points is None else points
+        return (np.arange(points) - self.x_reference) * self.x_increment + self.x_origin
+
+    def voltages(self, codes, dtype=np.float32, out=None):
+        """
+        Scales raw codes (any shape, e.g. segments x points) to voltages in a single pass.
+
+        :param codes: The codes returned by fetch_waveform_codes or fetch_segments.
+        :param dtype: The type of the voltages, float32 keeps the precision of 8 to 16-bit codes at half the memory of float64.
+        :param out: An array receiving the voltages, to reuse a buffer between shots.
+        :return: The voltages.
+        """
+        if out is None:
+            out = np.empty(np.shape(codes), dtype=dtype)
+        np.multiply(codes, self.y_increment, out=out)
+        out += self.y_origin - self.y_reference * self.y_increment
+        return out
+
+
+class PendingAcquisition:
+    """
+    An acquisition armed with ":SINGle", returned by InfiniiumOscilloscope.start_acquisition. Its completion is polled
+    with ":ADER?" (acquisition done event register), so the host is free while the scope acquires:
+
+        acquisition = oscilloscope.start_acquisition(fetch=lambda: oscilloscope.get_waveform(name_csv=None))
+        stage.start_move(next_position)  # or process the previous record, write files...
+        codes, preamble = acquisition.result(timeout=5.0)
+
+    It can also be awaited in a coroutine ("await acquisition"). The scope must not be sent other commands before the
+    acquisition is over, a new acquisition would overwrite the one in progress.
+
+    Attributes:
+        oscilloscope (InfiniiumOscilloscope): The oscilloscope acquiring.
+        fetch (callable): Called without argument once the acquisition is done; its return value is the result. None for no download.
+        started (float): The time.perf_counter() value when the acquisition was armed.
+        state (str): "running", "done" (acquired, fetched with the first result call), "cancelled" or "timeout".
+    """
+
+    def __init__(self, oscilloscope, fetch=None):
+        self.oscilloscope = oscilloscope
+        self.fetch = fetch
+        self.started = time.perf_counter()
+        self.state = "running"
+        self._fetched = False
+        self._result = None
+
+    def _poll(self):
+        """
+        Reads the acquisition done event register once; reading it clears it.
+        """
+        try:
+            # Queried directly: the error checks of do_query_number would double the cost of every poll
+            return int(float(self.oscilloscope.scope.query(":ADER?"))) == 1
+        except Exception as e:
+            raise IOError(f"Failed to poll the acquisition: {e}")
+
+    def done(self):
+        """
+        Returns True if the acquisition is over, cancelled or timed out, with a single query while it runs.
+        """
+        if self.state == "running" and self._poll():
+            self.state = "done"
+        return self.state != "running"
+
+    def _stop(self, state):
+        """
+        Stops the acquisition and clears the done event, so that the next acquisition starts from a known state.
+        An acquisition that ended meanwhile is kept as done.
+        """
+        self.oscilloscope.do_command(":STOP")
+        self.state = "done" if self._poll() else state
+
+    def cancel(self):
+        """
+        Aborts the acquisition with ":STOP".
+
+        :return: True if the acquisition was cancelled, False if it was already over.
+        """
+        if self.done():
+            return self.state == "cancelled"
+        self._stop("cancelled")
+        return self.state == "cancelled"
+
+    def wait(self, timeout=None, min_interval=0.001, max_interval=0.05):
+        """
+        Polls until the acquisition is over, with an interval starting at min_interval and doubling up to max_interval.
+        On timeout, the acquisition is stopped.
+
+        :param timeout: The maximum waiting time in seconds, the VISA timeout of the session if None.
+        :param min_interval: The first polling interval, in seconds.
+        :param max_interval: The longest polling interval, in seconds.
+        :return: True if the acquisition is done, False if it was cancelled or timed out.
+        """
+        timeout = self.oscilloscope.scope.timeout / 1000 if timeout is None else timeout
+        deadline = time.perf_counter() + timeout
+        interval = min_interval
+        while not self.done():
+            if time.perf_counter() > deadline:
+                print(f"Acquisition did not complete within {timeout} s, stopped.")
+                self._stop("timeout")
+                break
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return self.state == "done"
+
+    def result(self, timeout=None):
+        """
+        Waits for the acquisition and returns the value of fetch (downloaded once), or True if there is no fetch.
+
+        :param timeout: See wait.
+        :raises TimeoutError: If the acquisition did not complete in time.
+        :raises RuntimeError: If the acquisition was cancelled.
+        """
+        if not self.wait(timeout):
+            if self.state == "timeout":
+                raise TimeoutError("the acquisition did not complete in time")
+            raise RuntimeError("the acquisition was cancelled")
+        if not self._fetched:
+            self._result = self.fetch() if self.fetch is not None else True
+            self._fetched = True
+        return self._result
+
+    async def result_async(self, timeout=None, min_interval=0.001, max_interval=0.05):
+        """
+        Coroutine version of result, sleeping with asyncio between the polls.
+        """
+        timeout = self.oscilloscope.scope.timeout / 1000 if timeout is None else timeout
+        deadline = time.perf_counter() + timeout
+        interval = min_interval
+        while not self.done():
+            if time.perf_counter() > deadline:
+                print(f"Acquisition did not complete within {timeout} s, stopped.")
+                self._stop("timeout")
+                break
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return self.result(0)
+
+    def __await__(self):
+        return self.result_async().__await__()
+
 
 class InfiniiumOscilloscope:
     """
     Represents a connection to a Keysight Infiniium Oscilloscope and provides methods to control and retrieve data from the oscilloscope.
     """
 
-    def __init__(self, address):
+    def __init__(self, address, error_policy="command", resource_manager=None, tracer=None):
         """
         Initializes the oscilloscope connection using the provided VISA address.
 
         :param address: The VISA address of the oscilloscope.
+        :param error_policy: When instrument errors are checked, one of error_policies.
+        :param resource_manager: The VISA resource manager opening the address, a new pyvisa.ResourceManager if None.
+        :param tracer: A tracing.Tracer recording every VISA call, or None (see enable_tracing).
         """
+        if error_policy not in error_policies:
+            raise ValueError(f"invalid error policy '{error_policy}', expected one of {error_policies}")
         self.address = address
-        self.rm = pyvisa.ResourceManager()
+        self.error_policy = error_policy
+        self._group_name = None  # Name of the outermost active command group
+        self._group_commands = []  # (command, exit_on_error) of the commands sent since the group was opened
+        self._settings = {}  # Shadow copy of the settings applied with apply_setting, by command header
+        self._preambles = {}  # WaveformPreamble of every waveform source for the last acquisition, discarded by a new acquisition or a setting of preamble_settings
+        self.rm = resource_manager if resource_manager is not None else pyvisa.ResourceManager()
+        self.tracer = tracer
+        self.scope = None
+        self.connect()
+
+    def connect(self):
+        """
+        Opens the VISA session to the oscilloscope. The settings cache is invalidated since the instrument state is unknown.
+        """
+        self.invalidate_settings()
         try:
             self.scope = self.rm.open_resource(self.address)
+            if self.tracer is not None:
+                self.scope = self.tracer.wrap(self.scope, "scpi")
             self.scope.timeout = 20000  # Set command timeout
             self.scope.clear()  # Clear any existing errors or messages
             print("Connection to Infiniium Oscilloscope established.")
@@ -78,41 +435,185 @@ class InfiniiumOscilloscope:
             print(f"Failed to connect to Infiniium Oscilloscope: {e}")
             self.scope = None  # No connection if an error occurred
 
+    def reconnect(self):
+        """
+        Closes and reopens the VISA session to the oscilloscope.
+        """
+        self.close()
+        self.connect()
+
+    def enable_tracing(self, tracer):
+        """
+        Records every VISA write and query (error checks and block transfers included) in a tracing.Tracer,
+        under the "scpi" category and named by their SCPI header. Without tracer the VISA session is used directly.
+
+        :param tracer: The tracing.Tracer receiving the events.
+        """
+        self.disable_tracing()
+        self.tracer = tracer
+        if self.scope is not None:
+            self.scope = tracer.wrap(self.scope, "scpi")
+
+    def disable_tracing(self):
+        """
+        Stops recording the VISA calls.
+        """
+        if self.tracer is not None and self.scope is not None:
+            self.scope = self.scope._target
+        self.tracer = None
+
+    def invalidate_settings(self):
+        """
+        Forgets the settings applied so far, so that the next apply_setting calls send them again.
+        The cached preamble is discarded as well.
+        """
+        self._settings = {}
+        self._preambles = {}
+
+    def apply_setting(self, header, value, query=None, label=None, query_number=False):
+        """
+        Sends "header value" unless the same value was already applied since the last invalidation,
+        then reads the setting back with the query, if given, and prints it.
+
+        :param header: The SCPI command header (e.g., ":TIMebase:SCALe"), cached with its short and long forms (see canonical_header).
+        :param value: The value of the setting.
+        :param query: The SCPI query used to read the setting back, or None.
+        :param label: The label printed with the value read back.
+        :param query_number: If True, the value read back is converted to a float.
+        :return: True if the setting was sent, False if it was already applied.
+        """
+        key = canonical_header(header)
+        value = str(value)
+        if self._settings.get(key) == value:
+            return False
+        if not self.do_command(f"{header} {value}"):
+            return True
+        self._settings[key] = value
+        if query is not None:
+            qresult = self.do_query_number(query) if query_number else self.do_query_string(query)
+            print(f"{label}: {qresult}")
+        return True
+
     def check_instrument_errors(self, command, exit_on_error=True):
         """
         Queries the oscilloscope for any errors and prints them. Continues querying until no more errors are returned.
 
         :param command: The command after which to check for errors. Used for error reporting.
+        :return: True if errors were reported.
         """
+        errors = False
         while True:
             error_string = self.scope.query(":SYSTem:ERRor? STRing")
             if error_string: # If there is an error string value.
                 if error_string.find("0,", 0, 2) == -1: # Not "No error".
+                    errors = True
                     print("ERROR: %s, command: '%s'" % (error_string, command))
                     if exit_on_error:
                         print("Exited because of error.")
                         sys.exit(1)
                 else: # "No error"
-                    break
+                    return errors
             else: # :SYSTem:ERRor? STRing should always return string.
                 print("ERROR: :SYSTem:ERRor? STRing returned nothing, command: '%s'"% command)
                 print("Exited because of error.")
                 sys.exit(1)
 
+    def check_event_status(self, command, exit_on_error=True):
+        """
+        Reads the standard event status register and only queries the error queue if one of its error bits is set.
+
+        :param command: The command after which to check for errors. Used for error reporting.
+        :return: True if errors were reported.
+        """
+        esr = int(self.scope.query("*ESR?"))
+        if esr & esr_error_bits:
+            return self.check_instrument_errors(command, exit_on_error)
+        return False
+
+    def _check_errors(self, command, exit_on_error=True):
+        """
+        Checks for errors after a command according to the error policy.
+        Inside a command group of the "group" and "esr" policies, the command is only recorded and checked with the group.
+
+        :param command: The command that was just sent.
+        :param exit_on_error: If True, exits when the command caused an error; a group does not exit if one of its commands
+                              was sent with exit_on_error False.
+        """
+        if self.error_policy == "command":
+            self.check_instrument_errors(command, exit_on_error)
+        elif self._group_name is not None:
+            self._group_commands.append((command, exit_on_error))
+        elif self.error_policy == "esr":
+            self.check_event_status(command, exit_on_error)
+        else:
+            self.check_instrument_errors(command, exit_on_error)
+
+    @contextmanager
+    def command_group(self, name, exit_on_error=True):
+        """
+        Groups commands so that, with the "group" and "esr" error policies, errors are checked once when the group ends.
+        Errors are reported with the name of the group and the commands it sent. Nested groups are merged into the outermost one.
+        A group causing an error invalidates the settings cache, since the setting rejected is not known.
+
+        :param name: The name of the group, used for error reporting.
+        :param exit_on_error: If True, exits when the group caused an error, unless one of its commands was sent with
+                              exit_on_error False (e.g. the block queries) or an exception is leaving the group.
+        """
+        if self._group_name is not None or self.error_policy == "command":
+            yield
+            return
+        self._group_name = name
+        self._group_commands = []
+        failed = False
+        try:
+            yield
+        except BaseException:
+            # The errors are still reported, but exiting here would hide the exception
+            failed = True
+            raise
+        finally:
+            commands = self._group_commands
+            self._group_name = None
+            self._group_commands = []
+            if self.scope is not None and commands:
+                exit_on_error = exit_on_error and not failed and all(exit for _, exit in commands)
+                description = "group %s (%s)" % (name, "; ".join(command for command, _ in commands))
+                errors = True  # Until the check returns, it may exit
+                try:
+                    if self.error_policy == "esr":
+                        errors = self.check_event_status(description, exit_on_error)
+                    else:
+                        errors = self.check_instrument_errors(description, exit_on_error)
+                finally:
+                    if errors:
+                        # The settings of the group were cached when sent, one of them may have been rejected
+                        self.invalidate_settings()
+
     def do_command(self, command):
         """
         Sends a SCPI command to the oscilloscope and checks for errors.
 
         :param command: The SCPI command string to send to the oscilloscope.
+        :return: True if the command was sent, False otherwise.
         """
         if self.scope is None:
             print("Oscilloscope is not connected.")
-            return
+            return False
+        # The command may change a cached setting, or the whole state for a reset, autoscale or recall
+        header = canonical_header(command.split(" ", 1)[0])
+        if header in ("*RST", "*RCL") or header.startswith(":AUT"):
+            self.invalidate_settings()
+        else:
+            self._settings.pop(header, None)
+            if header.startswith(preamble_settings + acquisition_commands):
+                self._preambles = {}
         try:
             self.scope.write("%s" % command)
-            self.check_instrument_errors(command)  # Check for errors related to the command
+            self._check_errors(command)  # Check for errors related to the command
+            return True
         except Exception as e:
             print(f"Failed to execute command '{command}': {e}")
+            return False
 
     def do_command_ieee_block(self, command, values):
         """
@@ -126,7 +627,7 @@ class InfiniiumOscilloscope:
             return
         try:
             self.scope.write_binary_values(command, values, datatype='B')
-            self.check_instrument_errors(command)  # Check for errors after sending the command
+            self._check_errors(command)  # Check for errors after sending the command
         except Exception as e:
             print(f"Failed to execute command '{command}': {e}")
 
@@ -142,7 +643,7 @@ class InfiniiumOscilloscope:
             return None
         try:
             result = self.scope.query(query)
-            self.check_instrument_errors(query)  # Check for errors related to the query
+            self._check_errors(query)  # Check for errors related to the query
             return result
         except Exception as e:
             print(f"Failed to execute query '{query}': {e}")
@@ -160,7 +661,7 @@ class InfiniiumOscilloscope:
             return None
         try:
             result = self.scope.query(query)
-            self.check_instrument_errors(query)  # Check for errors related to the query
+            self._check_errors(query)  # Check for errors related to the query
             return float(result)
         except Exception as e:
             print(f"Failed to execute query '{query}': {e}")
@@ -178,12 +679,49 @@ class InfiniiumOscilloscope:
             return None
         try:
             result = self.scope.query_binary_values(query, datatype='s', container=bytes)
-            self.check_instrument_errors(query, exit_on_error=False)  # Check for errors, don't exit on error
+            self._check_errors(query, exit_on_error=False)  # Check for errors, don't exit on error
             return result
         except Exception as e:
             print(f"Failed to execute IEEE block query '{query}': {e}")
             return None
 
+    def do_query_ieee_array(self, query, datatype="b", is_big_endian=False):
+        """
+        Sends a SCPI query to the oscilloscope that expects a binary block response, checks for errors,
+        and returns the data as a NumPy array of the given type. The array is a view on the received block, without copy.
+
+        :param query: The SCPI query string to send.
+        :param datatype: The struct type code of a single value (see wav_dtype_dict).
+        :param is_big_endian: True if the values are sent most significant byte first.
+        :return: The values as a NumPy array.
+        """
+        if self.scope is None:
+            print("Oscilloscope is not connected.")
+            return None
+        try:
+            result = self.scope.query_binary_values(query, datatype=datatype, is_big_endian=is_big_endian, container=np.ndarray)
+            self._check_errors(query, exit_on_error=False)  # Check for errors, don't exit on error
+            return result
+        except Exception as e:
+            print(f"Failed to execute IEEE block query '{query}': {e}")
+            return None
+
+    def fetch_waveform_codes(self, waveform_format=wav_form_dict[1], byte_order="LSBFirst"):
+        """
+        Downloads the codes of the current waveform source in a binary format.
+
+        :param waveform_format: One of the binary formats of wav_dtype_dict ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :return: The codes as a NumPy array, or None on error.
+        """
+        datatype = wav_dtype_dict.get(waveform_format.upper())
+        if datatype is None:
+            raise ValueError(f"waveform format '{waveform_format}' is not a binary format, expected one of {list(wav_dtype_dict)}")
+        self.apply_setting(":WAVeform:FORMat", waveform_format)
+        self.apply_setting(":WAVeform:BYTeorder", byte_order)
+        self.apply_setting(":WAVeform:STReaming", "OFF")
+        return self.do_query_ieee_array(":WAVeform:DATA?", datatype, byte_order.upper().startswith("MSB"))
+
     def initialize(self):
         """
         Initializes the oscilloscope by clearing any existing settings or errors and resetting the instrument to its default state.
@@ -204,28 +742,17 @@ class InfiniiumOscilloscope:
         :param time_position: The horizontal position (time offset).
         :param acquire_mode: The acquisition mode.
         """
-        # Set the vertical scale and offset for the specified channel
-        self.do_command(f":{channel}:SCALe {scale}")
-        qresult = self.do_query_number(f":{channel}:SCALe?")
-        print(f"{channel} vertical scale: {qresult}")
+        with self.command_group("set_setup"):
+            # Set the vertical scale and offset for the specified channel
+            self.apply_setting(f":{channel}:SCALe", scale, f":{channel}:SCALe?", f"{channel} vertical scale", query_number=True)
+            self.apply_setting(f":{channel}:OFFSet", offset, f":{channel}:OFFSet?", f"{channel} offset", query_number=True)
 
-        self.do_command(f":{channel}:OFFSet {offset}")
-        qresult = self.do_query_number(f":{channel}:OFFSet?")
-        print(f"{channel} offset: {qresult}")
+            # Set the horizontal scale and position
+            self.apply_setting(":TIMebase:SCALe", time_scale, ":TIMebase:SCALe?", "Timebase scale")
+            self.apply_setting(":TIMebase:POSition", time_position, ":TIMebase:POSition?", "Timebase position")
 
-        # Set the horizontal scale and position
-        self.do_command(f":TIMebase:SCALe {time_scale}")
-        qresult = self.do_query_string(":TIMebase:SCALe?")
-        print(f"Timebase scale: {qresult}")
-
-        self.do_command(f":TIMebase:POSition {time_position}")
-        qresult = self.do_query_string(":TIMebase:POSition?")
-        print(f"Timebase position: {qresult}")
-
-        # Set the acquisition mode
-        self.do_command(f":ACQuire:MODE {acquire_mode}")
-        qresult = self.do_query_string(":ACQuire:MODE?")
-        print(f"Acquire mode: {qresult}")
+            # Set the acquisition mode
+            self.apply_setting(":ACQuire:MODE", acquire_mode, ":ACQuire:MODE?", "Acquire mode")
 
     def save_setup(self, setup_name):
         """
@@ -246,11 +773,84 @@ class InfiniiumOscilloscope:
         try:
             with open(setup_name, "rb") as f:
                 setup_bytes = f.read()  # Read the setup bytes from the specified file
+            self.invalidate_settings()  # The loaded setup replaces the whole instrument state
             self.do_command_ieee_block(":SYSTem:SETup", setup_bytes)  # Load the setup into the oscilloscope
             print("Setup bytes restored: %d" % len(setup_bytes))
         except Exception as e:
             print(f"Failed to load setup from '{setup_name}': {e}")
 
+    def configure_acquisition(self, 
+                channel="channel1", 
+                autoscale=True, 
+                trigger_mode=trig_mode_disct[0], 
+                trigger_level="330E-3", 
+                save_setup=False, 
+                load_setup=False, 
+                setup_name="setup.set", 
+                scale=0.1, 
+                offset=0.0,
+                time_scale="200e-6",
+                time_position=0.0,
+                acquire_mode=acq_mode_dict[0],
+                waveform_points=32000
+                ):
+        """
+        Configures the oscilloscope for acquisitions based on provided settings, without acquiring.
+        Settings that are already applied are not sent again.
+
+        :param channel: The oscilloscope channel to configure and acquire data from.
+        :param autoscale: If True, uses the oscilloscope's auto-scale feature to automatically adjust settings.
+        :param trigger_mode: The trigger mode to use for acquisition.
+        :param trigger_level: The voltage level to set for the trigger.
+        :param save_setup: If True, saves the current oscilloscope setup to a file.
+        :param load_setup: If True, loads oscilloscope settings from a previously saved setup file.
+        :param setup_name: The file name to save or load the oscilloscope setup.
+        :param scale: The vertical scale (volts per division) for the specified channel.
+        :param offset: The vertical offset for the specified channel.
+        :param time_scale: The horizontal scale (seconds per division).
+        :param time_position: The horizontal position (time offset from the trigger point).
+        :param acquire_mode: The acquisition mode for the oscilloscope.
+        :param waveform_points: The number of waveform points to capture.
+        """
+        try:
+            with self.command_group("configure_acquisition"):
+                # Set the probe attenuation factor to 1x for the specified channel
+                self.apply_setting(f":{channel}:PROBe", "1.0", f":{channel}:PROBe?", f"{channel} probe attenuation factor")
+
+                # Automatically adjust the oscilloscope settings for optimal viewing, if autoscale is enabled
+                if autoscale:
+                    print("Autoscale.")
+                    self.do_command(":AUToscale")
+
+                # Configure the trigger settings based on the specified mode and parameters
+                self.apply_setting(":TRIGger:MODE", trigger_mode, ":TRIGger:MODE?", "Trigger mode")
+
+                # If the trigger mode is EDGE, set additional EDGE trigger parameters
+                if trigger_mode == "EDGE":
+                    self.apply_setting(":TRIGger:EDGE:SOURce", channel, ":TRIGger:EDGE:SOURce?", "Trigger edge source")
+                    self.apply_setting(":TRIGger:LEVel", f"{channel},{trigger_level}", f":TRIGger:LEVel? {channel}", f"Trigger level, {channel}")
+                    self.apply_setting(":TRIGger:EDGE:SLOPe", "POSitive", ":TRIGger:EDGE:SLOPe?", "Trigger edge slope")
+
+                # Save the current oscilloscope setup to a file, if requested
+                if save_setup:
+                    self.save_setup(setup_name)
+                    print(f"Oscilloscope setup saved to {setup_name}.")
+
+                # Load a previously saved oscilloscope setup from a file, if requested
+                if load_setup:
+                    self.load_setup(setup_name)
+                    print(f"Oscilloscope setup loaded from {setup_name}.")
+
+                # If not loading from a file, manually configure the oscilloscope settings
+                if not load_setup:
+                    self.set_setup(channel, scale, offset, time_scale, time_position, acquire_mode)
+
+                # Configure the number of waveform points to capture
+                self.apply_setting(":ACQuire:POINts", waveform_points)
+
+        except Exception as e:
+            print(f"Error during acquisition configuration: {e}")
+
     def single_acquisition(self, 
                 channel="channel1", 
                 autoscale=True, 
@@ -284,55 +884,246 @@ class InfiniiumOscilloscope:
         :param waveform_points: The number of waveform points to capture.
         """
         try:
-            # Set the probe attenuation factor to 1x for the specified channel
-            self.do_command(f":{channel}:PROBe 1.0")
-            qresult = self.do_query_string(f":{channel}:PROBe?")
-            print(f"{channel} probe attenuation factor: {qresult}")
-
-            # Automatically adjust the oscilloscope settings for optimal viewing, if autoscale is enabled
-            if autoscale:
-                print("Autoscale.")
-                self.do_command(":AUToscale")
-
-            # Configure the trigger settings based on the specified mode and parameters
-            self.do_command(f":TRIGger:MODE {trigger_mode}")
-            qresult = self.do_query_string(":TRIGger:MODE?")
-            print(f"Trigger mode: {qresult}")
-
-            # If the trigger mode is EDGE, set additional EDGE trigger parameters
-            if trigger_mode == "EDGE":
-                self.do_command(f":TRIGger:EDGE:SOURce {channel}")
-                qresult = self.do_query_string(":TRIGger:EDGE:SOURce?")
-                print(f"Trigger edge source: {qresult}")
-                self.do_command(f":TRIGger:LEVel {channel},{trigger_level}")
-                qresult = self.do_query_string(f":TRIGger:LEVel? {channel}")
-                print(f"Trigger level, {channel}: {qresult}")
-                self.do_command(":TRIGger:EDGE:SLOPe POSitive")
-                qresult = self.do_query_string(":TRIGger:EDGE:SLOPe?")
-                print(f"Trigger edge slope: {qresult}")
-
-            # Save the current oscilloscope setup to a file, if requested
-            if save_setup:
-                self.save_setup(setup_name)
-                print(f"Oscilloscope setup saved to {setup_name}.")
-
-            # Load a previously saved oscilloscope setup from a file, if requested
-            if load_setup:
-                self.load_setup(setup_name)
-                print(f"Oscilloscope setup loaded from {setup_name}.")
-
-            # If not loading from a file, manually configure the oscilloscope settings
-            if not load_setup:
-                self.set_setup(channel, scale, offset, time_scale, time_position, acquire_mode)
-
-            # Configure the number of waveform points to capture and initiate a single acquisition
-            self.do_command(f":ACQuire:POINts {waveform_points}")
-            self.do_command(":DIGitize")
-            print("Single acquisition completed.")
+            with self.command_group("single_acquisition"):
+                self.configure_acquisition(channel, autoscale, trigger_mode, trigger_level, save_setup, load_setup, setup_name,
+                                           scale, offset, time_scale, time_position, acquire_mode, waveform_points)
+                # Initiate a single acquisition
+                self.do_command(":DIGitize")
+                print("Single acquisition completed.")
 
         except Exception as e:
             print(f"Error during single acquisition: {e}")
 
+    def set_segments(self, segments):
+        """
+        Acquires the given number of segments (triggers) with the segmented memory, or switches the segmented mode off
+        for a single segment, in the real time mode, if it was left on (e.g. by segmented_acquisition).
+
+        :param segments: The number of segments, 1 for a single acquisition.
+        """
+        if segments > 1:
+            self.apply_setting(":ACQuire:MODE", "SEGMented")
+            self.apply_setting(":ACQuire:SEGMented:COUNt", segments)
+        elif self._settings.get(canonical_header(":ACQuire:MODE"), "").upper().startswith("SEGM"):
+            self.apply_setting(":ACQuire:MODE", acq_mode_dict[0])
+
+    def segmented_acquisition(self, channel="channel1", segments=1000, waveform_points=1000, waveform_format=wav_form_dict[1], byte_order="LSBFirst", fetch=True):
+        """
+        Acquires one record per trigger into the segmented memory and downloads all the segments in a single block.
+        The trigger and vertical settings are the ones already configured (see configure_acquisition).
+
+        :param channel: The channel from which to retrieve waveform data (e.g., "channel1").
+        :param segments: The number of segments (triggers) to acquire.
+        :param waveform_points: The number of waveform points per segment.
+        :param waveform_format: The binary format of the waveform data to be retrieved ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :param fetch: If False, only acquires; the segments are then downloaded with fetch_segments.
+        :return: The result of fetch_segments, or None if fetch is False or on error.
+        """
+        try:
+            with self.command_group("segmented_acquisition"):
+                # Acquire all the segments with a single digitize
+                self.apply_setting(":ACQuire:MODE", "SEGMented")
+                self.apply_setting(":ACQuire:SEGMented:COUNt", segments)
+                self.apply_setting(":ACQuire:POINts", waveform_points)
+                self.do_command(":DIGitize")
+                print(f"Segmented acquisition of {segments} segments completed.")
+                if fetch:
+                    return self.fetch_segments(channel, segments, waveform_format, byte_order)
+                return None
+
+        except Exception as e:
+            print(f"Error during segmented acquisition: {e}")
+            return None
+
+    def fetch_segments(self, channel="channel1", segments=1000, waveform_format=wav_form_dict[1], byte_order="LSBFirst"):
+        """
+        Downloads all the segments of the last segmented acquisition in a single block.
+
+        :param channel: The channel from which to retrieve waveform data (e.g., "channel1").
+        :param segments: The number of segments that were acquired.
+        :param waveform_format: The binary format of the waveform data to be retrieved ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :return: A tuple (codes, time_tags, preamble) with the (segments x points) raw codes, the trigger time tag of each segment
+                 relative to the first one, and the preamble tuple returned by get_preamble, or None on error.
+        """
+        try:
+            with self.command_group("fetch_segments"):
+                # Download every segment at once instead of the current one only
+                self.apply_setting(":WAVeform:SOURce", channel)
+                self.apply_setting(":WAVeform:FORMat", waveform_format)
+                self.apply_setting(":WAVeform:SEGMented:ALL", "ON")
+                preamble = self.get_preamble()
+                codes = self.fetch_waveform_codes(waveform_format, byte_order)
+                time_tags = self.do_query_string(":WAVeform:SEGMented:XLISt? TTAG")
+
+                if len(codes) % segments != 0:
+                    print(f"Received {len(codes)} values, which is not a multiple of {segments} segments.")
+                    return None
+                codes = codes.reshape(segments, -1)
+                time_tags = np.array(time_tags.split(","), dtype=float)
+                print(f"Downloaded {segments} segments of {codes.shape[1]} points.")
+                return codes, time_tags, preamble
+
+        except Exception as e:
+            print(f"Error while fetching the segments: {e}")
+            return None
+
+    def multi_channel_acquisition(self, sources=("channel1", "channel2"), segments=1, waveform_format=wav_form_dict[1], byte_order="LSBFirst", fetch=True):
+        """
+        Acquires several sources with a single digitize, e.g. both photodiodes of a balanced detector, or a difference
+        function and a reference channel. The trigger, vertical and timebase settings are the ones already configured
+        (see configure_acquisition); math functions must be defined before (e.g. ":FUNCtion1:SUBTract CHANnel1,CHANnel2").
+
+        :param sources: The channels or functions to acquire (e.g., ("channel1", "channel2") or ("function1", "channel3")).
+        :param segments: The number of segments (triggers) to acquire, 1 for a single acquisition (see set_segments).
+        :param waveform_format: The binary format of the waveform data to be retrieved ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :param fetch: If False, only acquires; the sources are then downloaded with fetch_sources.
+        :return: The result of fetch_sources, or None if fetch is False or on error.
+        """
+        try:
+            with self.command_group("multi_channel_acquisition"):
+                self.set_segments(segments)
+                # A digitize with a list of sources only acquires these sources, all on the same triggers
+                self.do_command(":DIGitize " + ",".join(sources))
+                print(f"Acquisition of {', '.join(sources)} completed.")
+                if fetch:
+                    return self.fetch_sources(sources, segments, waveform_format, byte_order)
+                return None
+
+        except Exception as e:
+            print(f"Error during multi-channel acquisition: {e}")
+            return None
+
+    def fetch_sources(self, sources=("channel1", "channel2"), segments=1, waveform_format=wav_form_dict[1], byte_order="LSBFirst"):
+        """
+        Downloads several sources of the last acquisition one after the other, with their cached preambles.
+
+        :param sources: The channels or functions that were acquired.
+        :param segments: The number of segments that were acquired, 1 for a single acquisition.
+        :param waveform_format: The binary format of the waveform data to be retrieved ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :return: A tuple (shots, preambles): shots is a structured array with one element per segment and one (points,) field
+                 of raw codes per source, named after the source; preambles maps every source to its WaveformPreamble.
+                 None on error.
+        """
+        try:
+            with self.command_group("fetch_sources"):
+                if segments > 1:
+                    self.apply_setting(":WAVeform:SEGMented:ALL", "ON")
+                elif self._settings.get(canonical_header(":WAVeform:SEGMented:ALL")) == "ON":
+                    self.apply_setting(":WAVeform:SEGMented:ALL", "OFF")
+                self.apply_setting(":WAVeform:FORMat", waveform_format)
+                codes = {}
+                preambles = {}
+                for source in sources:
+                    self.apply_setting(":WAVeform:SOURce", source)
+                    preambles[source] = self.get_preamble()
+                    codes[source] = self.fetch_waveform_codes(waveform_format, byte_order)
+
+                sizes = {source: len(values) for source, values in codes.items()}
+                if len(set(sizes.values())) != 1 or sizes[sources[0]] % segments != 0:
+                    print(f"Received {sizes} values, which are not {segments} segments of the same length.")
+                    return None
+                points = sizes[sources[0]] // segments
+                shots = np.empty(segments, dtype=[(source, codes[source].dtype, (points,)) for source in sources])
+                for source in sources:
+                    shots[source] = codes[source].reshape(segments, points)
+                print(f"Downloaded {len(sources)} sources of {segments} x {points} points.")
+                return shots, preambles
+
+        except Exception as e:
+            print(f"Error while fetching the sources: {e}")
+            return None
+
+    def burst_acquisition(self, shots, channel="channel1", waveform_format=wav_form_dict[1], byte_order="LSBFirst", out=None,
+                          **acquisition_settings):
+        """
+        Acquires and downloads several single shots of a channel, e.g. many shots at one stage position.
+        Everything is configured once, then every shot only costs a ":DIGitize" and a ":WAVeform:DATA?", read into a
+        row of a (shots x points) buffer; instrument errors are checked once, after the last shot.
+
+        :param shots: The number of shots.
+        :param channel: The channel to acquire and download (e.g., "channel1").
+        :param waveform_format: The binary format of the waveform data ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :param out: A (shots x points) array of the waveform format type receiving the codes, to reuse a buffer between
+                    bursts once its codes are consumed; allocated after the first shot if None.
+        :param acquisition_settings: If given, configure_acquisition settings applied once before the first shot.
+        :return: A tuple (codes, send_times, preamble) with the (shots x points) raw codes, the time at which the ":DIGitize"
+                 of every shot was sent, relative to the first one, on the host clock, and the WaveformPreamble of the first
+                 shot, like fetch_segments; None on error. The send times are not the trigger times: the write returns
+                 before the acquisition ends, and confirming it (":ADER?") would cost a round trip per shot.
+        """
+        if shots < 1:
+            raise ValueError(f"a burst needs at least one shot, received {shots}")
+        datatype = wav_dtype_dict.get(waveform_format.upper())
+        if datatype is None:
+            raise ValueError(f"waveform format '{waveform_format}' is not a binary format, expected one of {list(wav_dtype_dict)}")
+        try:
+            with self.command_group("burst_acquisition"):
+                if acquisition_settings:
+                    self.configure_acquisition(channel=channel, **acquisition_settings)
+                if self._settings.get(canonical_header(":WAVeform:SEGMented:ALL")) == "ON":
+                    self.apply_setting(":WAVeform:SEGMented:ALL", "OFF")
+                self.apply_setting(":WAVeform:SOURce", channel)
+                self.apply_setting(":WAVeform:FORMat", waveform_format)
+                self.apply_setting(":WAVeform:BYTeorder", byte_order)
+                self.apply_setting(":WAVeform:STReaming", "OFF")
+
+            digitize = f":DIGitize {channel}"  # Only the downloaded channel is acquired
+            big_endian = byte_order.upper().startswith("MSB")
+            send_times = np.empty(shots)
+            start = time.perf_counter()
+            for i in range(shots):
+                send_times[i] = time.perf_counter() - start
+                self.scope.write(digitize)
+                if i == 0:
+                    # The preamble of the first shot dates the burst, the following shots only differ by their time
+                    self._preambles = {}
+                    preamble = self.get_preamble()
+                codes = self.scope.query_binary_values(":WAVeform:DATA?", datatype=datatype, is_big_endian=big_endian,
+                                                       container=np.ndarray)
+                if out is None:
+                    out = np.empty((shots, len(codes)), dtype=codes.dtype)
+                if len(codes) != out.shape[1]:
+                    print(f"Shot {i} has {len(codes)} values instead of {out.shape[1]}.")
+                    return None
+                out[i] = codes
+            duration = time.perf_counter() - start
+            # Like the other block queries, an error does not exit
+            self._check_errors(f"burst_acquisition ({shots} x {digitize}; :WAVeform:DATA?)", exit_on_error=False)
+            print(f"Burst of {shots} shots of {out.shape[1]} points in {duration:.3f} s, {shots / duration:.1f} shots/s.")
+            return out, send_times, preamble
+
+        except Exception as e:
+            print(f"Error during burst acquisition: {e}")
+            return None
+
+    def start_acquisition(self, segments=1, fetch=None):
+        """
+        Arms a single acquisition with ":SINGle" and returns immediately, instead of blocking in ":DIGitize".
+        The trigger, vertical and timebase settings are the ones already configured (see configure_acquisition),
+        and the displayed channels are acquired.
+
+        :param segments: The number of segments (triggers) to acquire, 1 for a single acquisition (see set_segments).
+        :param fetch: Called without argument once the acquisition is done, e.g. a get_waveform or fetch_segments call;
+                      its value is the result of the acquisition.
+        :return: A PendingAcquisition, or None if the acquisition could not be armed.
+        """
+        try:
+            with self.command_group("start_acquisition"):
+                self.set_segments(segments)
+                # The done event of an earlier acquisition would report this one as done
+                self.scope.query(":ADER?")
+                if not self.do_command(":SINGle"):
+                    return None
+            return PendingAcquisition(self, fetch)
+
+        except Exception as e:
+            print(f"Error while arming the acquisition: {e}")
+            return None
 
     def make_measures(self, channel):
         """
@@ -341,21 +1132,22 @@ class InfiniiumOscilloscope:
         :param channel: The oscilloscope channel (e.g., "channel1") on which to perform measurements.
         """
         try:
-            # Set the measurement source to the specified channel
-            self.do_command(f":MEASure:SOURce {channel}")
-            # Confirm the measurement source
-            qresult = self.do_query_string(":MEASure:SOURce?")
-            print(f"Measure source: {qresult}")
-
-            # Perform and print frequency measurement
-            self.do_command(":MEASure:FREQuency")
-            qresult = self.do_query_string(":MEASure:FREQuency?")
-            print(f"Measured frequency on {channel}: {qresult}")
-
-            # Perform and print amplitude measurement
-            self.do_command(":MEASure:VAMPlitude")
-            qresult = self.do_query_string(":MEASure:VAMPlitude?")
-            print(f"Measured vertical amplitude on {channel}: {qresult}")
+            with self.command_group("make_measures"):
+                # Set the measurement source to the specified channel
+                self.do_command(f":MEASure:SOURce {channel}")
+                # Confirm the measurement source
+                qresult = self.do_query_string(":MEASure:SOURce?")
+                print(f"Measure source: {qresult}")
+
+                # Perform and print frequency measurement
+                self.do_command(":MEASure:FREQuency")
+                qresult = self.do_query_string(":MEASure:FREQuency?")
+                print(f"Measured frequency on {channel}: {qresult}")
+
+                # Perform and print amplitude measurement
+                self.do_command(":MEASure:VAMPlitude")
+                qresult = self.do_query_string(":MEASure:VAMPlitude?")
+                print(f"Measured vertical amplitude on {channel}: {qresult}")
 
         except Exception as e:
             print(f"Error during measurements on {channel}: {e}")
@@ -382,48 +1174,31 @@ class InfiniiumOscilloscope:
 
 
 
-    def get_preamble(self):
+    def get_preamble(self, refresh=False, verbose=False):
         """
-        Retrieves and prints the preamble information from the oscilloscope, which includes various waveform settings and parameters. 
-        Also, it extracts numeric values for some of these parameters for potential later use in calculations.
-
-        :return: A tuple containing important numeric values extracted from the preamble, including x_increment, x_origin, x_units, y_increment, y_origin, and y_units. If the preamble cannot be retrieved, None is returned.
+        Returns the preamble of the current waveform source, which includes the scaling factors and units.
+        The preamble is read with a single query and kept, for each source selected with apply_setting, until
+        a new acquisition starts (its date, time and x origin change) or a format, timebase, vertical, function
+        or acquisition setting is sent.
+
+        :param refresh: If True, the preamble is read again even if it is cached.
+        :param verbose: If True, the preamble is printed when it is read (print(preamble) prints it at any time).
+        :return: A WaveformPreamble, which also unpacks as (x_increment, x_origin, x_units, y_increment, y_origin, y_units, date, time).
+                 If the preamble cannot be retrieved, None is returned.
         """
+        source = self._settings.get(canonical_header(":WAVeform:SOURce"))
+        if source in self._preambles and not refresh:
+            return self._preambles[source]
         try:
             # Query the oscilloscope for the preamble string that contains metadata about the waveform
             preamble_string = self.do_query_string(":WAVeform:PREamble?")
             if preamble_string:
-                # Split the preamble string into its constituent parts
-                (wav_form, acq_type, wfmpts, avgcnt, x_increment, x_origin, x_reference, y_increment, y_origin, 
-                y_reference, coupling, x_display_range, x_display_origin, y_display_range, y_display_origin, 
-                date, time, frame_model, acq_mode, completion, x_units, y_units, max_bw_limit, min_bw_limit) = preamble_string.split(",")
-
-                # Print out the extracted preamble information for user reference
-                print("Waveform format: %s" % wav_form_dict[int(wav_form)])
-                print("Acquire type: %s" % acq_type_dict[int(acq_type)])
-                print("Waveform points desired: %s" % wfmpts)
-                print("Waveform average count: %s" % avgcnt)
-                print("Waveform X increment: %s" % x_increment)
-                print("Waveform X origin: %s" % x_origin)
-                print("Waveform Y increment: %s" % y_increment)
-                print("Waveform Y origin: %s" % y_origin)
-                print("Coupling: %s" % coupling_dict[int(coupling)])
-                print("Waveform X display range: %s" % x_display_range)
-                print("Waveform Y display range: %s" % y_display_range)
-                print("Date: %s" % date)
-                print("Time: %s" % time)
-                print("Acquire mode: %s" % acq_mode_dict[int(acq_mode)])
-                print("Waveform X units: %s" % units_dict[int(x_units)])
-                print("Waveform Y units: %s" % units_dict[int(y_units)])
-
-                # Query the oscilloscope for specific numeric values related to the waveform that may be used in later calculations
-                x_increment = self.do_query_number(":WAVeform:XINCrement?")
-                x_origin = self.do_query_number(":WAVeform:XORigin?")
-                y_increment = self.do_query_number(":WAVeform:YINCrement?")
-                y_origin = self.do_query_number(":WAVeform:YORigin?")
-
-                # Return the extracted numeric values
-                return x_increment, x_origin, units_dict[int(x_units)], y_increment, y_origin, units_dict[int(y_units)], date, time
+                preamble = WaveformPreamble(preamble_string)
+                if verbose:
+                    print(preamble)
+                if source is not None:
+                    self._preambles[source] = preamble
+                return preamble
             else:
                 print("Failed to retrieve the preamble string.")
                 return None
@@ -432,58 +1207,47 @@ class InfiniiumOscilloscope:
             return None
 
 
-    def get_waveform(self, channel="channel1", waveform_format=wav_form_dict[1], name_csv="waveform_data.csv"):
+    def get_waveform(self, channel="channel1", waveform_format=wav_form_dict[1], name_csv="waveform_data.csv", byte_order="LSBFirst"):
         """
-        Retrieves waveform data from the specified oscilloscope channel and saves it to a CSV file.
+        Retrieves waveform data from the specified oscilloscope channel and optionally saves it to a CSV file.
 
         :param channel: The channel from which to retrieve waveform data (e.g., "channel1").
-        :param waveform_format: The format of the waveform data to be retrieved.
-        :param name_csv: The name of the CSV file where the waveform data will be saved.
+        :param waveform_format: The binary format of the waveform data to be retrieved ("BYTE", "WORD", "LONG" or "LONGLONG").
+        :param name_csv: The name of the CSV file where the waveform data will be saved, or None to skip the CSV file.
+        :param byte_order: "LSBFirst" or "MSBFirst", the byte order of multi-byte formats.
+        :return: A tuple (codes, preamble) with the raw codes and the preamble tuple returned by get_preamble, or None on error.
         """
         try:
-            # Query the oscilloscope for the current waveform type and print it
-            qresult = self.do_query_string(":WAVeform:TYPE?")
-            print(f"Waveform type: {qresult}")
-
-            # Query the oscilloscope for the number of waveform points and print it
-            qresult = self.do_query_string(":WAVeform:POINts?")
-            print(f"Waveform points: {qresult}")
-
-            # Set the source of the waveform data to the specified channel
-            self.do_command(f":WAVeform:SOURce {channel}")
-            # Confirm the waveform source and print it
-            qresult = self.do_query_string(":WAVeform:SOURce?")
-            print(f"Waveform source: {qresult}")
-
-            # Set the format of the waveform data to be retrieved
-            self.do_command(f":WAVeform:FORMat {waveform_format}")
-            # Confirm the waveform format and print it
-            print(f"Waveform format: {self.do_query_string(':WAVeform:FORMat?')}")
-
-            # Retrieve and print the preamble information, which includes scaling factors and units
-            x_increment, x_origin, x_units, y_increment, y_origin, y_units, date, time = self.get_preamble()
-            
-            # Disable streaming to retrieve the waveform data
-            self.do_command(":WAVeform:STReaming OFF")
-            # Query the oscilloscope for the waveform data
-            sData = self.do_query_ieee_block(":WAVeform:DATA?")
-            # Unpack the retrieved waveform data
-            values = struct.unpack("%db" % len(sData), sData)
-            print(f"Number of data values: {len(values)}")
-
-            # Write the waveform data, along with scaling factors and units, to the specified CSV file
-            with open(name_csv, "w") as f:
-                f.write("%s, %s\n" % ("date", date))
-                f.write("%s, %s\n" % ("time", time))
-                f.write(f"Time ({x_units}), Voltage ({y_units})\n")
-                for i in range(len(values)):
-                    time_val = x_origin + (i * x_increment)
-                    voltage = (values[i] * y_increment) + y_origin
-                    f.write(f"{time_val:E}, {voltage:f}\n")
-            print(f"Waveform data written to {name_csv}.")
+            with self.command_group("get_waveform"):
+                # Only download the current segment if all segments were selected by segmented_acquisition
+                if self._settings.get(canonical_header(":WAVeform:SEGMented:ALL")) == "ON":
+                    self.apply_setting(":WAVeform:SEGMented:ALL", "OFF")
+
+                # Set the source of the waveform data to the specified channel and confirm it
+                self.apply_setting(":WAVeform:SOURce", channel, ":WAVeform:SOURce?", "Waveform source")
+
+                # Set the format of the waveform data to be retrieved and confirm it
+                self.apply_setting(":WAVeform:FORMat", waveform_format, ":WAVeform:FORMat?", "Waveform format")
+
+                # Retrieve the preamble (scaling factors, units, waveform type and points)
+                preamble = self.get_preamble()
+
+                # Query the oscilloscope for the waveform data, read directly into a typed array
+                values = self.fetch_waveform_codes(waveform_format, byte_order)
+                print(f"Number of data values: {len(values)}")
+
+                # Write the waveform data, along with scaling factors and units, to the specified CSV file
+                if name_csv is not None:
+                    # Scaled like the historical per-sample writer, so that the files do not change
+                    values, voltages = decode_waveform(values, preamble.y_increment, preamble.y_origin)
+                    write_waveform_csv(name_csv, voltages, preamble.x_increment, preamble.x_origin, preamble.x_units,
+                                       preamble.y_units, preamble.date, preamble.time)
+                    print(f"Waveform data written to {name_csv}.")
+                return values, preamble
 
         except Exception as e:
             print(f"Error occurred while getting the waveform: {e}")
+            return None
 
     def close(self):
         """
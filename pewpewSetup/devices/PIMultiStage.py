@@ -0,0 +1,223 @@
+from .mmc_wrapper import MMC_Wrapper
+from .mercury_serial import MercurySerial
+import time
+
+class PIMultiStage:
+    """
+    Controls every Mercury controller of a daisy chain (network) through a single serial connection.
+    Moves are sent to all the axes back-to-back and waited for together, so that the axes move concurrently.
+
+    Attributes:
+        stages (dict): The stage model of each axis (device number), e.g. {1: 'M1121DG', 2: 'M521DG'}.
+        bounds (dict): The [min, max] allowable positions of each axis, in stage units.
+        com_port (str): The COM port to which the network is connected.
+        baud_rate (int): The baud rate for the serial communication.
+        backend (str): 'dll' to use the MMC.dll (32 bits Windows only), 'serial' to send the native commands with pyserial.
+        wrapper (MMC_Wrapper): An instance of the MMC_Wrapper to interface with the network.
+        axes (list): The device numbers found on the network.
+
+    Methods:
+        init_stage(): Opens the serial connection and registers the devices of the network.
+        get_positions(): Reads the positions of all the axes.
+        start_move(targets): Starts absolute moves on several axes without waiting for their end.
+        wait_motion(axes): Waits until all the given axes have stopped.
+        move(targets): Moves several axes concurrently and waits for all of them.
+        move_home(): Homes all the axes concurrently.
+        stop_motion(): Stops all the axes.
+        close(): Closes the serial connection.
+    """
+
+    backends = {'dll': MMC_Wrapper, 'serial': MercurySerial}
+
+    def __init__(self, stages={1: 'M1121DG'}, bounds=None, com_port='COM11', baud_rate=9600, backend='dll', max_axis=16):
+        """
+        Initializes the network with the stage model of each axis, the bounds, COM port and baud rate,
+        then opens the serial connection and registers the connected devices.
+
+        Parameters:
+            max_axis (int): The highest device number searched by MMC_initNetwork.
+        """
+        self.stages = dict(stages)
+        self.bounds = bounds if bounds is not None else {axis: [0, 25] for axis in self.stages}
+        self.com_port = com_port
+        self.baud_rate = baud_rate
+        self.backend = backend
+        self.max_axis = max_axis
+        self.wrapper = None
+        self.axes = []
+        self.init_stage()
+
+    def init_stage(self):
+        """
+        Opens the serial connection, registers the devices of the network and prints their positions.
+        """
+        try:
+            self.wrapper = self.backends[self.backend](next(iter(self.stages.values())), self.com_port, self.baud_rate)
+            self.wrapper.open()
+            devices = self.wrapper.MMC_initNetwork(self.max_axis)
+            missing = [axis for axis in self.stages if axis not in devices]
+            if missing:
+                print(f"Devices {missing} not found on the network, found {devices}.")
+            self.axes = [axis for axis in self.stages if axis in devices]
+            print(f"Initialization Success - Devices: {self.axes}, Positions: {self.get_positions()}")
+        except Exception as e:
+            print(f"Initialization failed: {e}")
+
+    def units_to_counts(self, axis, units):
+        return self.wrapper.units_to_counts(units, self.stages[axis])
+
+    def counts_to_units(self, axis, counts):
+        return self.wrapper.counts_to_units(counts, self.stages[axis])
+
+    def get_positions(self, axes=None):
+        """
+        Reads the positions of several axes.
+
+        Parameters:
+            axes (list): The axes to read, all of them if None.
+
+        Returns:
+            dict: The position of each axis, in stage units.
+        """
+        positions = {}
+        for axis in (self.axes if axes is None else axes):
+            self.wrapper.MMC_select(axis)
+            positions[axis] = self.counts_to_units(axis, self.wrapper.MMC_getPos())
+        return positions
+
+    def start_move(self, targets):
+        """
+        Sends absolute moves to several axes back-to-back, without waiting for their end.
+
+        Parameters:
+            targets (dict): The absolute target of each axis, in stage units.
+
+        Returns:
+            dict: The targets actually sent, after clamping to the bounds.
+        """
+        sent = {}
+        for axis, target in targets.items():
+            low, high = self.bounds[axis]
+            sent[axis] = max(min(target, high), low)
+            res = self.wrapper.MMC_moveA(axis, self.units_to_counts(axis, sent[axis]))
+            if res != 0:
+                raise IOError(f"MMC_moveA failed on axis {axis} with error code {res}")
+        return sent
+
+    def wait_motion(self, axes=None, timeout=30.0, min_interval=0.001, max_interval=0.05):
+        """
+        Waits until all the given axes report that their move has terminated.
+        The axes still moving are polled in turn, with an interval doubling from min_interval to max_interval.
+
+        Parameters:
+            axes (list): The axes to wait for, all of them if None.
+            timeout (float): The maximum waiting time, in seconds.
+
+        Returns:
+            bool: True if all the axes stopped in time, False on timeout.
+        """
+        moving = list(self.axes if axes is None else axes)
+        deadline = time.perf_counter() + timeout
+        interval = min_interval
+        while moving:
+            still_moving = []
+            for axis in moving:
+                self.wrapper.MMC_select(axis)
+                if self.wrapper.is_moving():  # Same motion status and fallbacks as PIStage.is_moving
+                    still_moving.append(axis)
+            moving = still_moving
+            if not moving:
+                break
+            if time.perf_counter() > deadline:
+                print(f"Axes {moving} did not stop within {timeout} s.")
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return True
+
+    def move(self, targets, timeout=30.0):
+        """
+        Moves several axes concurrently to absolute positions and waits for all of them.
+
+        Parameters:
+            targets (dict): The absolute target of each axis, in stage units.
+
+        Returns:
+            dict: The final position of each moved axis, in stage units, or None if the move failed or did not end in time.
+        """
+        if not self.wrapper:
+            print("Stage not initialized.")
+            return None
+
+        try:
+            self.start_move(targets)
+            if not self.wait_motion(list(targets), timeout):
+                self.stop_motion()
+                print("Move did not complete.")
+                return None
+            positions = self.get_positions(list(targets))
+            print(f"Final positions: {positions}")
+            return positions
+        except Exception as e:
+            print(f"Error moving: {e}")
+
+    def move_home(self, axes=None):
+        """
+        Starts the reference search of all the given axes, waits for all of them, then defines their positions as home.
+
+        Parameters:
+            axes (list): The axes to home, all of them if None.
+
+        Returns:
+            bool: True if all the axes were homed, False otherwise; no home is defined if one of the axes did not stop in time.
+        """
+        if not self.wrapper:
+            print("Stage not initialized.")
+            return False
+
+        axes = self.axes if axes is None else axes
+        try:
+            for axis in axes:
+                self.wrapper.MMC_select(axis)
+                self.wrapper.find_home()
+            print("Homing started...")
+            if not self.wait_motion(axes, timeout=120.0):
+                # Defining the current positions as home would shift every absolute position
+                self.stop_motion()
+                print("Homing did not complete, home not defined.")
+                return False
+            print("Homing complete.")
+            for axis in axes:
+                self.wrapper.MMC_select(axis)
+                self.wrapper.MMC_sendCommand('DH')  # Define the current position as home
+            time.sleep(0.5)  # Short delay to ensure the commands are processed
+            print(f"Final positions: {self.get_positions(axes)}")
+            return True
+        except Exception as e:
+            print(f"Error moving home: {e}")
+            return False
+
+    def stop_motion(self):
+        """
+        Stops all the axes immediately.
+        """
+        if self.wrapper:
+            try:
+                self.wrapper.MMC_globalBreak()
+                for axis in self.axes:
+                    self.wrapper.MMC_select(axis)
+                    self.wrapper.MMC_sendCommand('AB')  # Abort motion
+                print("Motion stopped.")
+            except Exception as e:
+                print(f"Error stopping motion: {e}")
+
+    def close(self):
+        """
+        Closes the serial connection to the network.
+        """
+        if self.wrapper:
+            try:
+                self.wrapper.MMC_COM_close()
+                print("Connection closed successfully.")
+            except Exception as e:
+                print(f"Error closing connection: {e}")
@@ -1,5 +1,6 @@
 from .mmc_wrapper import MMC_Wrapper
-from qtpy.QtCore import QThread
+from .mercury_serial import MercurySerial
+import time
 
 class PIStage:
     """
@@ -10,6 +11,7 @@ class PIStage:
         stage (str): The model of the stage being used.
         com_port (str): The COM port to which the stage is connected.
         baud_rate (int): The baud rate for the serial communication.
+        backend (str): 'dll' to use the MMC.dll (32 bits Windows only), 'serial' to send the native commands with pyserial.
         wrapper (MMC_Wrapper): An instance of the MMC_Wrapper to interface with the stage.
         axis (int): The currently selected axis of the stage.
 
@@ -18,14 +20,20 @@ class PIStage:
         enumerate_devices(wrapper): Enumerates the connected PI devices.
         move_home(): Moves the stage to its home position.
         close(): Closes the serial connection to the stage.
-        stop_motion(): Stops any ongoing movement of the stage.
+        stop_motion(smooth): Stops any ongoing movement of the stage.
         move(position): Moves the stage to a specified position.
+        start_move(target_position): Starts an absolute move without waiting for its end.
+        start_move_counts(target_counts): Starts an absolute move given in controller counts.
+        wait_motion(timeout, settle_band): Waits until the controller reports the end of the move.
+        set_motion_parameters(velocity, acceleration): Programs the velocity and acceleration of the following moves.
+        get_position(): Reads the current position of the stage.
         is_moving(threshold): Checks if the stage is currently moving.
     """
     
     _controller_units = 'mm'  # Default units, update accordingly if needed
+    backends = {'dll': MMC_Wrapper, 'serial': MercurySerial}
     
-    def __init__(self, bounds=[0, 25], stage='M1121DG', com_port='COM11', baud_rate=9600):
+    def __init__(self, bounds=[0, 25], stage='M1121DG', com_port='COM11', baud_rate=9600, backend='dll'):
         """
         Initializes the PIStage class with specified bounds, stage model, COM port, and baud rate.
         Also initializes the stage by setting up the serial connection and selecting the first device.
@@ -34,6 +42,7 @@ class PIStage:
         self.stage = stage
         self.com_port = com_port
         self.baud_rate = baud_rate
+        self.backend = backend
         self.wrapper = None
         self.axis = None
         self.init_stage()
@@ -45,7 +54,7 @@ class PIStage:
         If successful, selects the first device as the current axis and prints its initial position.
         """
         try:
-            self.wrapper = MMC_Wrapper(self.stage, self.com_port, self.baud_rate)
+            self.wrapper = self.backends[self.backend](self.stage, self.com_port, self.baud_rate)
             self.wrapper.open()
             devices = self.enumerate_devices(self.wrapper)
             if devices:
@@ -78,24 +87,32 @@ class PIStage:
     def move_home(self):
         """
         Moves the stage to its home position. It continuously checks the stage's position to determine
-        when the homing process has completed.
+        when the homing process has completed. The home is only defined (DH) if the reference search ended in time.
+
+        Returns:
+            bool: True if the stage was homed, False otherwise.
         """
         if not self.wrapper:
             print("Stage not initialized.")
-            return
+            return False
 
         try:
             self.wrapper.find_home()
             print("Homing started...")
-            while self.is_moving():
-                QThread.msleep(100)  # Short delay between checks
+            if not self.wait_motion(timeout=120.0):
+                # Defining the current position as home would shift every absolute position
+                self.stop_motion()
+                print("Homing did not complete, home not defined.")
+                return False
             print("Homing complete.")
             self.wrapper.MMC_sendCommand('DH')  # Define the current position as home
-            QThread.msleep(500)  # Short delay to ensure the command is processed
+            time.sleep(0.5)  # Short delay to ensure the command is processed
             pos = self.wrapper.getPos()
             print(f"Final position: {pos}")
+            return True
         except Exception as e:
             print(f"Error moving home: {e}")
+            return False
 
     def close(self):
         """
@@ -108,13 +125,18 @@ class PIStage:
             except Exception as e:
                 print(f"Error closing connection: {e}")
 
-    def stop_motion(self):
+    def stop_motion(self, smooth=False):
         """
         Stops any ongoing movement of the stage.
+
+        Parameters:
+            smooth (bool): If True, the stage decelerates with the programmed acceleration (AB1) instead of stopping
+                           abruptly (AB), which may lose track of the position at high velocity.
         """
         if self.wrapper:
             try:
-                self.wrapper.MMC_globalBreak()
+                self.wrapper.MMC_globalBreak()  # Only interrupts the waits, the motion itself is aborted by AB
+                self.wrapper.MMC_sendCommand('AB1' if smooth else 'AB')
                 print("Motion stopped.")
             except Exception as e:
                 print(f"Error stopping motion: {e}")
@@ -125,6 +147,9 @@ class PIStage:
 
         Parameters:
             position (float): The target position to move the stage to.
+
+        Returns:
+            float: The final position, or None if the move failed or did not end in time.
         """
         if not self.wrapper:
             print("Stage not initialized.")
@@ -132,15 +157,13 @@ class PIStage:
 
         try:
             current_position = self.wrapper.getPos()
-            target_position = current_position + position
-            # Ensure target position is within bounds
-            target_position = max(min(target_position, self.bounds[1]), self.bounds[0])
-
-            self.wrapper.moveAbs(self.axis, target_position)
+            self.start_move(current_position + position)
 
             print(f"Move started, initial position: {current_position}")
-            while self.is_moving():
-                QThread.msleep(100)  # Short delay between checks
+            if not self.wait_motion():
+                self.stop_motion()
+                print("Move did not complete.")
+                return None
             print("Move complete.")
             pos = self.wrapper.getPos()
             print(f"Final position: {pos}")
@@ -148,31 +171,131 @@ class PIStage:
         except Exception as e:
             print(f"Error moving: {e}")
 
+    def start_move(self, target_position):
+        """
+        Starts an absolute move to a position within the defined bounds and returns without waiting for the end of the move.
+
+        Parameters:
+            target_position (float): The absolute target position, in stage units.
+
+        Returns:
+            float: The target position actually sent, after clamping to the bounds.
+        """
+        # Ensure target position is within bounds
+        target_position = max(min(target_position, self.bounds[1]), self.bounds[0])
+        self.wrapper.moveAbs(self.axis, target_position)
+        return target_position
+
+    def start_move_counts(self, target_counts):
+        """
+        Starts an absolute move to a position given in controller counts, without any conversion or rounding.
+
+        Parameters:
+            target_counts (int): The absolute target position, in counts.
+
+        Raises:
+            ValueError: If the target is outside of the defined bounds.
+        """
+        target_counts = int(target_counts)
+        low, high = (self.wrapper.units_to_counts(bound) for bound in self.bounds)
+        if not low <= target_counts <= high:
+            raise ValueError(f"target {target_counts} counts is outside of the bounds [{low}, {high}] counts")
+        res = self.wrapper.MMC_moveA(self.axis, target_counts)
+        if res != 0:
+            raise IOError(f"MMC_moveA failed with error code {res}")
+
+    def get_position_counts(self):
+        """
+        Reads the current position of the stage in controller counts.
+
+        Returns:
+            int: The current position, in counts.
+        """
+        return self.wrapper.MMC_getPos()
+
+    def motion_parameters(self):
+        """
+        Reads the programmed velocity (TY) and acceleration (TL) of the controller.
+
+        Returns:
+            tuple: (velocity in counts/s, acceleration in counts/s^2).
+        """
+        return self.wrapper.MMC_getVal(5), self.wrapper.MMC_getVal(6)
+
+    def set_motion_parameters(self, velocity, acceleration=None):
+        """
+        Programs the velocity (SV) and acceleration (SA) of the controller, used by the following moves.
+
+        Parameters:
+            velocity (int): The velocity, in counts/s.
+            acceleration (int): The acceleration and deceleration, in counts/s^2, unchanged if None.
+        """
+        self.wrapper.MMC_sendCommand(f'SV{int(velocity)}')
+        if acceleration is not None:
+            self.wrapper.MMC_sendCommand(f'SA{int(acceleration)}')
+
+    def wait_motion(self, timeout=30.0, settle_band=None, min_interval=0.001, max_interval=0.05):
+        """
+        Waits until the controller reports that the move has terminated. The status is polled with an interval
+        starting at min_interval and doubling up to max_interval, so that short moves return within milliseconds
+        while long moves do not flood the serial line.
+
+        Parameters:
+            timeout (float): The maximum waiting time, in seconds.
+            settle_band (float): If given, also waits until the distance to the target is within this band, in stage units.
+            min_interval (float): The first polling interval, in seconds.
+            max_interval (float): The longest polling interval, in seconds.
+
+        Returns:
+            bool: True if the stage stopped (and settled) in time, False on timeout.
+        """
+        deadline = time.perf_counter() + timeout
+        interval = min_interval
+        band = None if settle_band is None else self.wrapper.units_to_counts(settle_band)
+        while self.is_moving() or (band is not None and abs(self.distance_to_target()) > band):
+            if time.perf_counter() > deadline:
+                print(f"Motion did not complete within {timeout} s.")
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return True
+
+    def get_position(self):
+        """
+        Reads the current position of the stage.
+
+        Returns:
+            float: The current position, in stage units.
+        """
+        return self.wrapper.getPos()
+
     def is_moving(self, threshold=0.0001):
         """
-        Checks if the stage is currently moving by comparing its position at two different times.
-        If the change in position exceeds a specified threshold, it is considered to be moving.
+        Checks if the stage is currently moving, from the motion status of the controller.
+        If the status cannot be read, the distance to the target reported by the controller is used instead,
+        then the change in position between two reads (see MMC_Wrapper.is_moving). A communication error is
+        raised rather than reported as a stopped stage.
 
         Parameters:
-            threshold (float): The minimum change in position to consider the stage as moving.
+            threshold (float): The minimum change in position to consider the stage as moving, when only the position can be read.
 
         Returns:
-            bool: True if the stage is moving, False otherwise.
+            bool: True if the stage is moving, False otherwise (or if the stage is not initialized).
         """
         if not self.wrapper:
             print("Stage not initialized.")
             return False
 
-        try:
-            initial_pos = self.wrapper.getPos()
-            QThread.msleep(10)  # Short delay to allow for movement detection
-            final_pos = self.wrapper.getPos()
+        return self.wrapper.is_moving(threshold)
 
-            # If the change in position is greater than the threshold, consider the stage as moving
-            if abs(final_pos - initial_pos) > threshold:
-                return True
-            else:
-                return False
-        except Exception as e:
-            print(f"Error checking if stage is moving: {e}")
-            return False
\ No newline at end of file
+    def distance_to_target(self):
+        """
+        Reads the distance between the target and the current position (TE).
+
+        Returns:
+            int: The distance to the target, in counts.
+        """
+        distance = self.wrapper.MMC_getVal(4)
+        if distance >= 2147483644:  # MaxInt - 3 to MaxInt are error codes of the dll
+            raise IOError(f"Error reading the distance to target: {distance}")
+        return distance
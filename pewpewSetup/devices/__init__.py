@@ -1,3 +1,5 @@
-from .InfiniiumOscilloscope import InfiniiumOscilloscope
+from .InfiniiumOscilloscope import InfiniiumOscilloscope, PendingAcquisition, WaveformPreamble
 from .mmc_wrapper import MMC_Wrapper
-from .PIStage import PIStage
\ No newline at end of file
+from .PIStage import PIStage
+from .PIMultiStage import PIMultiStage
+from .mercury_serial import MercurySerial
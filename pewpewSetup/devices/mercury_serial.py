@@ -0,0 +1,365 @@
+"""
+--------------------------------
+Pure-Python backend for the Mercury™ controllers (C-862, C-863, C-663, C-170).
+It speaks the native ASCII command set (manuals/Mercury_native_commands.pdf) directly over a serial port
+instead of going through the 32 bits MMC.dll, so it runs on any platform and any Python (64 bits included).
+The method surface is the one of MMC_Wrapper, so both can be used interchangeably by PIStage and PIMultiStage.
+--------------------------------
+
+Protocol summary:
+    Address selection code: ASCII 1 followed by the address character '0'-'9', 'A'-'F' (addresses 0 to 15,
+                            device numbers 1 to 16), sent without terminator.
+    Base/compound commands: terminated by CR, several base commands can be chained with commas.
+    Reports: terminated by the sequence CR LF ETX, e.g. TP -> "P:+0000005555".
+    Single-character commands: sent without terminator, e.g. "\\" reports the moving status as 0 or 1.
+"""
+
+import threading
+from .mmc_wrapper import MMC_Wrapper
+
+REPORT_END = b'\r\n\x03'
+ADDRESS_CHARS = '0123456789ABCDEF'
+
+# C-863 defaults (SV/SA), used when the controller cannot be asked
+default_velocity = 250000  # counts/s
+default_acceleration = 400000  # counts/s^2
+
+# MMC_getVal identifiers and the equivalent report commands
+value_commands = {1: 'TP', 2: 'TT', 3: 'TF', 4: 'TE', 5: 'TY', 6: 'TL', 7: 'GP', 8: 'GI', 9: 'GD', 10: 'GL'}
+
+# Error codes returned by the value readers, same as the MMC.dll
+CONTENT_ERROR = 2147483647
+GETSTRING_ERROR = 2147483646
+SENDSTRING_ERROR = 2147483645
+CONVERSION_ERROR = 2147483644
+
+
+def address_code(axis):
+    """
+    Returns the address selection code of a device number (1 to 16).
+    """
+    if not 1 <= axis <= 16:
+        raise IOError('Wrong axis number')
+    return b'\x01' + ADDRESS_CHARS[axis - 1].encode()
+
+
+def parse_report(report):
+    """
+    Converts a report such as "P:+0000005555" to an integer.
+    """
+    return int(report.split(':', 1)[1])
+
+
+class MercurySerial(MMC_Wrapper):
+    """
+    Mercury™ controller (or network of controllers) driven with the native ASCII commands over a serial port.
+
+    The port can be any name or URL understood by pyserial: 'COM11', '/dev/ttyUSB0', '/dev/pts/4', 'loop://'...
+    """
+
+    def __init__(self, stage='M1121DG', com_port='COM11', baud_rate=9600, timeout=1.0):
+        if stage not in self.stages.keys():
+            raise Exception('not valid stage')
+        if baud_rate not in self.baudrates:
+            raise IOError('invalid baudrate')
+        self.stage = stage
+        self._comport = com_port
+        self._baudrate = baud_rate
+        self.timeout = timeout
+        self.tracer = None
+        self._serial = None
+        self._lock = threading.RLock()
+        self._break = threading.Event()
+        self._registered = []
+        self._selected = None
+
+    @property
+    def comport(self):
+        return self._comport
+
+    @comport.setter
+    def comport(self, port):
+        if not isinstance(port, str):
+            raise TypeError("not a valid port type, should be a string: 'COM6'")
+        self._comport = port
+
+    def open(self):
+        self.MMC_COM_open(self._comport, self._baudrate)
+
+    def moving(self):
+        return self.MDC_moving()
+
+    def enable_tracing(self, tracer):
+        """
+        Records the duration and size of every serial read and write in a tracing.Tracer, under the "serial" category,
+        and every MMC_sendCommand under the "mmc" category, named by the command, e.g. "MMC_sendCommand MA".
+        """
+        self.disable_tracing()
+        self.tracer = tracer
+        if self._serial is not None:
+            self._serial = tracer.wrap(self._serial, "serial")
+
+    def disable_tracing(self):
+        if self.tracer is not None and self._serial is not None:
+            self._serial = self._serial._target
+        self.tracer = None
+
+    def _write(self, data):
+        try:
+            self._serial.write(data)
+        except Exception as e:
+            raise IOError(f'Write error: {e}')
+
+    def _read_report(self):
+        """
+        Reads one report up to its CR LF ETX terminator and returns it without the terminator.
+        """
+        data = self._serial.read_until(REPORT_END)
+        if not data.endswith(REPORT_END):
+            raise IOError('Report timeout')
+        # Drops the terminator bytes that a single-character report may have left in the buffer
+        return data[:-len(REPORT_END)].lstrip(REPORT_END).decode()
+
+    def _address(self, axis):
+        """
+        Sends the address selection code if the axis is not already the selected one.
+        """
+        if axis > 0 and axis != self._selected:
+            self._write(address_code(axis))
+            self._selected = axis
+
+    def query(self, cmd, axis=0):
+        """
+        Sends a report command (or a compound command with one report per base command)
+        and returns the list of reports, in a single round trip.
+        Parameters
+        ----------
+        cmd: (str or list) Report command, e.g. 'TP', or list of commands, e.g. ['TP', 'TE', 'TS']
+        axis: (int) If >0 the axis is selected before sending the command.
+        Returns
+        -------
+        list: the reports as strings, e.g. ['P:+0000005555']
+        """
+        commands = [cmd] if isinstance(cmd, str) else list(cmd)
+        with self._lock:
+            self._address(axis)
+            self._write((','.join(commands) + '\r').encode())
+            return [self._read_report() for _ in commands]
+
+    def get_values(self, command_IDs, axis=0):
+        """
+        Reads several values of MMC_getVal in a single round trip.
+        Parameters
+        ----------
+        command_IDs: (list) MMC_getVal identifiers, e.g. [1, 4] for TP and TE
+        Returns
+        -------
+        list: the values, or the error code of MMC_getVal
+        """
+        try:
+            reports = self.query([value_commands[ind] for ind in command_IDs], axis)
+        except IOError:
+            return [GETSTRING_ERROR] * len(command_IDs)
+        values = []
+        for report in reports:
+            try:
+                values.append(parse_report(report))
+            except (IndexError, ValueError):
+                values.append(CONVERSION_ERROR)
+        return values
+
+    def MMC_getStringCR(self):
+        with self._lock:
+            return self._read_report()
+
+    def MMC_COM_open(self, port_number, baudrate):
+        try:
+            import serial
+        except ImportError:
+            raise IOError('pyserial is required by the serial backend')
+        try:
+            self._serial = serial.serial_for_url(str(port_number), baudrate=baudrate, timeout=self.timeout)
+        except Exception as e:
+            raise IOError(f'wrong return from serial port: {e}')
+        if self.tracer is not None:
+            self._serial = self.tracer.wrap(self._serial, "serial")
+        self._selected = None
+
+    def MMC_COM_close(self):
+        """
+        Closes the COM port previously opened by the MMC_COM_open function.
+
+        """
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def MMC_COM_EOF(self):
+        """
+        Returns the number of characters available in the COM-port input buffer
+        """
+        return self._serial.in_waiting
+
+    def MMC_COM_clear(self):
+        """
+        Clears the COM-port input buffer.
+        """
+        self._serial.reset_input_buffer()
+
+    def MMC_getDLLversion(self):
+        return 0
+
+    def MMC_getPos(self):
+        """
+        Reads the current motor position of the currently selected Mercury™ controller.
+        Returns
+        -------
+        int:    Current motor position in counts/steps or error code (see MMC_getVal).
+        """
+        return self.MMC_getVal(1)
+
+    def MDC_getPosErr(self):
+        """
+        Reads the current motor-position error of the currently selected Mercury™ controller.
+        """
+        return self.MMC_getVal(3)
+
+    def MMC_getVal(self, command_ID: int):
+        """
+        Reads the value of the requested parameter, identifiers as in MMC_Wrapper.MMC_getVal.
+        Returns
+        -------
+        int: The requested value or the error code:
+                2,147,483,647 (MaxInt) = content error
+                2,147,483,646 (MaxInt-1) = getString error
+                2,147,483,644 (MaxInt-3) = conversion error
+        """
+        if command_ID not in value_commands:
+            return CONTENT_ERROR
+        return self.get_values([command_ID])[0]
+
+    def MMC_initNetwork(self, maxAxis: int=16):
+        """
+        Searches all addresses, starting at address maxAxis down to 1, for Mercury™ devices connected.
+        Each address is selected and asked its position, the devices answering are registered for MMC_select.
+        Returns
+        -------
+        list: list of integers corresponding to the connected devices
+        """
+        devices = []
+        timeout = self._serial.timeout
+        self._serial.timeout = min(timeout, 0.2)
+        try:
+            for axis in range(maxAxis, 0, -1):
+                try:
+                    self.query('TP', axis)
+                    devices.append(axis)
+                except IOError:
+                    self.MMC_COM_clear()
+        finally:
+            self._serial.timeout = timeout
+        self._registered = sorted(devices)
+        if devices:
+            self.MMC_select(self._registered[0])
+        return self._registered
+
+    def MMC_moveA(self, axis: int=0, position: int=0):
+        """
+        Moves the motor of the specified axis (device number) to specified position (MA command).
+        Returns
+        -------
+        int:    Error codes:
+                    0: No error
+                    1: Error, wrong axis
+                    2: Error, not connected
+                    3: Error, sendString
+        """
+        return self._move('MA', axis, position)
+
+    def MMC_moveR(self, axis: int=0, shift: int=0):
+        """
+        Moves the motor of the specified axis (device number) relative to its current position (MR command).
+        Returns
+        -------
+        int:    Error codes as for MMC_moveA
+        """
+        return self._move('MR', axis, shift)
+
+    def _move(self, command, axis, counts):
+        if self._serial is None:
+            return 2
+        if not 0 <= axis <= 16:
+            return 1
+        try:
+            with self._lock:
+                self._address(axis)
+                self._write(f'{command}{int(counts)}\r'.encode())
+        except IOError:
+            return 3
+        return 0
+
+    def MDC_moving(self):
+        """
+        Returns the motion status of the currently selected controller, using the single-character command "\\".
+        Returns
+        -------
+        bool: moving status
+        """
+        with self._lock:
+            self._write(b'\\')
+            data = self._serial.read(1)
+            while data and data in REPORT_END:
+                data = self._serial.read(1)
+        if data not in (b'0', b'1'):
+            raise IOError('wrong moving status')
+        return data == b'1'
+
+    def MST_moving(self):
+        return self.MDC_moving()
+
+    def MMC_setDevice(self, axis: int=0):
+        """
+        Addresses the selected axis (controller), registered or not.
+        """
+        with self._lock:
+            self._write(address_code(axis))
+            self._selected = axis
+
+    def MMC_select(self, axis: int=0):
+        """
+        Selects the specified axis (device), which must have been registered by MMC_initNetwork.
+        """
+        if not 1 <= axis <= 16:
+            raise IOError('Wrong axis number')
+        if axis not in self._registered:
+            raise IOError('axis not registered')
+        with self._lock:
+            self._address(axis)
+
+    def MMC_sendCommand(self, cmd):
+        if self.tracer is None:
+            with self._lock:
+                self._write((cmd + '\r').encode())
+            return
+        # Named by the command, the serial write only shows the bytes
+        with self.tracer.span("mmc", f"MMC_sendCommand {cmd[:2].upper()}", len(cmd)):
+            with self._lock:
+                self._write((cmd + '\r').encode())
+
+    def MDC_waitStop(self):
+        """
+        Waits until the current move has terminated or interrupted by MMC_globalBreak.
+        """
+        self._break.clear()
+        while self.MDC_moving():
+            if self._break.wait(0.01):
+                raise IOError('User break')
+
+    def MST_waitStop(self):
+        self.MDC_waitStop()
+
+    def MMC_globalBreak(self):
+        """
+        Interrupts pending operations waiting for termination of a move (MDC_waitStop).
+        """
+        self._break.set()
@@ -15,12 +15,11 @@ C-170 Redstone PILine® Controller
 """
 
 import sys
-from ctypes import windll, create_string_buffer, POINTER, byref, pointer
-from ctypes import c_uint, c_int, c_char, c_char_p, c_void_p, c_short, c_long, c_bool, c_double, c_uint64, c_uint32, Array, CFUNCTYPE, WINFUNCTYPE
+from ctypes import create_string_buffer, POINTER, byref, pointer
+from ctypes import c_uint, c_int, c_char, c_char_p, c_void_p, c_short, c_long, c_bool, c_double, c_uint64, c_uint32, Array, CFUNCTYPE
 from ctypes import c_ushort, c_ulong, c_float
 import os
-from pyvisa import ResourceManager
-from bitstring import Bits
+import time
 
 class MMC_Wrapper(object):
     """
@@ -31,24 +30,53 @@ class MMC_Wrapper(object):
         'M521DG': dict(cts_units_num=2458624, cts_units_denom=81, units="mm"),
         'M1121DG': dict(cts_units_num=1310720, cts_units_denom=9, units="mm")
               }
-    VISA_rm = ResourceManager()
-    ress = VISA_rm.list_resources_info()
-    print(ress)
-    aliases = []
-    ports = []
-    for key in ress.keys():
-        print(ress[key].alias)
-        if ress[key].resource_name is not None:
-            if 'ASRL' in ress[key].resource_name:
-                aliases.append('COM' + str(ress[key].interface_board_number))
-                ports.append(ress[key].interface_board_number)
-
     baudrates = [9600, 19200]
+    ports_ttl = 60.0  # seconds before the enumerated COM ports are considered stale
+    _VISA_rm = None
+    _serial_ports = None
+    _serial_ports_time = 0.0
+
+    @classmethod
+    def serial_ports(cls, refresh=False):
+        """
+        Enumerates the serial (ASRL) VISA resources on first use only, then returns the cached result
+        until it is older than ports_ttl seconds or refresh is True.
+        Returns
+        -------
+        dict: COM port alias (ex: 'COM11') -> interface board number
+        """
+        now = time.monotonic()
+        if refresh or cls._serial_ports is None or now - cls._serial_ports_time > cls.ports_ttl:
+            if cls._VISA_rm is None:
+                from pyvisa import ResourceManager
+                cls._VISA_rm = ResourceManager()
+            ports = {}
+            for info in cls._VISA_rm.list_resources_info().values():
+                if info.resource_name is not None and 'ASRL' in info.resource_name:
+                    ports['COM' + str(info.interface_board_number)] = info.interface_board_number
+            cls._serial_ports = ports
+            cls._serial_ports_time = now
+        return cls._serial_ports
+
+    @classmethod
+    def refresh_ports(cls):
+        """
+        Forces a new enumeration of the serial VISA resources, for instance after plugging a controller.
+        """
+        return cls.serial_ports(refresh=True)
+
+    @property
+    def aliases(self):
+        return list(self.serial_ports())
+
+    @property
+    def ports(self):
+        return list(self.serial_ports().values())
 
     def __init__(self,stage='M1121DG', com_port='COM11', baud_rate=9600):
         if stage not in self.stages.keys():
             raise Exception('not valid stage')
-        if com_port not in self.aliases:
+        if com_port not in self.serial_ports() and com_port not in self.refresh_ports():
             raise IOError('invalid com port')
         if baud_rate not in self.baudrates:
             raise IOError('invalid baudrate')
@@ -56,6 +84,8 @@ class MMC_Wrapper(object):
         super(MMC_Wrapper,self).__init__()
         self._comport = com_port
         self._baudrate = baud_rate
+        self.tracer = None
+        from ctypes import windll  # Windows only, imported here so that the module loads on any platform
         self._dll = windll.LoadLibrary(os.path.join(os.path.split(__file__)[0],'MMC.dll'))
 
     @property
@@ -66,7 +96,7 @@ class MMC_Wrapper(object):
     def comport(self,port):
         if not isinstance(port, str):
             raise TypeError("not a valid port type, should be a string: 'COM6'")
-        if port not in self.ports:
+        if port not in self.serial_ports():
             raise IOError('{} is an invalid COM port'.format(port))
         self._comport = port
 
@@ -82,11 +112,14 @@ class MMC_Wrapper(object):
             raise IOError('{} is an invalid baudrate'.format(rate))
         self._baudrate = rate
 
-    def counts_to_units(self,counts):
-        return counts*1/(self.stages[self.stage]['cts_units_num']/self.stages[self.stage]['cts_units_denom'])
+    def counts_to_units(self,counts,stage=None):
+        # stage: the model of another axis of the network, the model of the wrapper if None
+        stage = self.stages[self.stage if stage is None else stage]
+        return counts*1/(stage['cts_units_num']/stage['cts_units_denom'])
 
-    def units_to_counts(self,units):
-        return int(units/(self.stages[self.stage]['cts_units_denom']/self.stages[self.stage]['cts_units_num']))
+    def units_to_counts(self,units,stage=None):
+        stage = self.stages[self.stage if stage is None else stage]
+        return int(units/(stage['cts_units_denom']/stage['cts_units_num']))
 
     def moveAbs(self, axis, units):
         """
@@ -110,27 +143,75 @@ class MMC_Wrapper(object):
         return self.counts_to_units(self.MMC_getPos())
 
     def open(self):
-        port = self.ports[self.aliases.index(self._comport)]
+        port = self.serial_ports()[self._comport]
         self.MMC_COM_open(port,self._baudrate)
 
     def find_home(self):
         self.MMC_sendCommand('FE1')
 
     def moving(self):
-        target = self.MMC_getVal(2)
+        # TE reports the distance between the target and the current position
         self.MMC_sendCommand('TE')
         st = self.MMC_getStringCR()
         if '-' in st:
-            pos = -int(st.split('E:-')[1])
+            distance = -int(st.split('E:-')[1])
         else:
-            pos = int(st.split('E:+')[1])
-        return abs(target - pos) > 100
+            distance = int(st.split('E:+')[1])
+        return abs(distance) > 100
+
+    def is_moving(self, threshold=0.0001):
+        """
+        Returns whether the selected controller is moving, from its motion status (MDC_moving). If the status
+        cannot be read, the distance to the target (TE) is used, and if it cannot be read either, the change
+        between two positions read 10 ms apart. Errors of the last resort are raised, not taken as a stopped stage.
+
+        Parameters
+        ----------
+        threshold : float
+            The change of position, in stage units, above which the stage is moving when only the positions can be read.
+
+        Returns
+        -------
+        bool: True if the stage is moving
+        """
+        try:
+            return self.MDC_moving()
+        except IOError:
+            pass
+        try:
+            return self.moving()
+        except (IOError, ValueError, IndexError):
+            initial_pos = self.getPos()
+            time.sleep(0.01)
+            return abs(self.getPos() - initial_pos) > threshold
+
+    def enable_tracing(self, tracer):
+        """
+        Records the duration of every DLL call in a tracing.Tracer, under the "mmc" category.
+        MMC_sendCommand is named by the command, e.g. "MMC_sendCommand MA".
+
+        Parameters
+        ----------
+        tracer : Tracer
+            The tracer receiving the events.
+        """
+        self.disable_tracing()
+        self.tracer = tracer
+        self._dll = tracer.wrap(self._dll, "mmc")
+
+    def disable_tracing(self):
+        """
+        Stops recording the DLL calls.
+        """
+        if self.tracer is not None:
+            self._dll = self._dll._target
+            self.tracer = None
 
     def MMC_getStringCR(self):
         st = create_string_buffer(128)
         res = self._dll.MMC_getStringCR(byref(st))
         if res != 0:
-            return st.decode()
+            return st.value.decode()
         else:
             raise IOError('wrong return from dll')
 
@@ -262,9 +343,8 @@ class MMC_Wrapper(object):
         if res < 0:
             raise IOError('wrong return from dll')
         if res > 0:
-            bits = Bits(int=res, length=32).bin
             for ind in range(maxAxis):
-                if bits[-1-ind] == '1':
+                if (res >> ind) & 1:
                     devices.append(ind+1)
         return devices
 
@@ -377,7 +457,12 @@ class MMC_Wrapper(object):
 
     def MMC_sendCommand(self,cmd):
         c_cmd = create_string_buffer(cmd.encode())
-        res = self._dll.MMC_sendCommand(byref(c_cmd))
+        if self.tracer is None:
+            res = self._dll.MMC_sendCommand(byref(c_cmd))
+        else:
+            # Traced here rather than by the DLL proxy, which only sees a pointer to the command
+            with self.tracer.span("mmc", f"MMC_sendCommand {cmd[:2].upper()}", len(cmd)):
+                res = self._dll._target.MMC_sendCommand(byref(c_cmd))
         if res == 114:
             raise IOError('Write error')
         elif res == 116:
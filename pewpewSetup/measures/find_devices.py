@@ -1,53 +1,239 @@
+"""
+Discovery of the VISA instruments.
+
+The interfaces are listed and the instruments identified with "*IDN?" concurrently, on a single
+resource manager, each interface with its own timeout. The address -> identity map is cached on
+disk, so that acquisition scripts resolve an instrument instantly instead of scanning the buses:
+
+    from measures.find_devices import resolve
+    port_oscilloscope = resolve("DSO") or "USB0::0x0957::0x900A::MY51050155::INSTR"
+
+Run as a script to list everything, as before, and to refresh the cache:
+    python measures/find_devices.py
+"""
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pyvisa
 
-def find(searchString):
+# Open and I/O timeout used to identify the instruments of every interface, in ms
+interface_timeouts = {
+    "USB": 2000,
+    "TCPIP": 2000,
+    "GPIB": 1000,
+    "PXI": 1000,
+    "VXI": 1000,
+    "ASRL": 500,
+}
+# Serial ports are listed but not probed by default: the stage controllers do not speak SCPI
+probed_interfaces = ("USB", "TCPIP", "GPIB", "PXI", "VXI")
+cache_path = os.path.join(os.path.expanduser("~"), ".pewpew_devices.json")
+cache_ttl = 24 * 3600.0  # seconds
+
+
+def find(searchString, resourceManager=None):
     """
     Searches for devices matching the specified search string and prints the results.
 
     :param searchString: The search pattern to use for finding devices.
+    :param resourceManager: The resource manager to search with, a new one (closed afterwards) if None.
     """
-    # Create a resource manager object
-    resourceManager = pyvisa.ResourceManager()
+    own_manager = resourceManager is None
+    if own_manager:
+        # Create a resource manager object
+        resourceManager = pyvisa.ResourceManager()
 
     print(f"Find with search string '{searchString}':")
     # List resources that match the search string
-    devices = resourceManager.list_resources(searchString)
+    try:
+        devices = resourceManager.list_resources(searchString)
+    except pyvisa.VisaIOError:
+        devices = ()  # Some VISA implementations raise instead of returning an empty list
     if len(devices) > 0:
         for device in devices:
             print(f"\t{device}")
     else:
         print("... didn't find anything!")
 
-    # Close the resource manager to clean up resources
-    resourceManager.close()
+    if own_manager:
+        # Close the resource manager to clean up resources
+        resourceManager.close()
+
+
+def interface(address):
+    """
+    Returns the interface type of a VISA address, e.g. "USB" for "USB0::0x0957::0x900A::MY51050155::INSTR".
+    """
+    return re.match(r"[A-Za-z]*", address).group(0).upper()
+
 
-# Find all devices and interfaces
-print('Find all devices and interfaces:\n')
-find('?*')
-
-# Different search strings can be used to specify other device types. Common examples include:
-
-# All instruments (excluding interfaces, backplanes, or memory access)
-find('?*INSTR')
-# PXI modules
-find('PXI?*INSTR')
-# USB devices
-find('USB?*INSTR')
-# GPIB instruments
-find('GPIB?*INSTR')
-# GPIB interfaces
-find('GPIB?*INTFC')
-# GPIB instruments on the GPIB0 interface
-find('GPIB0?*INSTR')
-# LAN instruments
-find('TCPIP?*INSTR')
-# SOCKET (::SOCKET) instruments
-find('TCPIP?*SOCKET')
-# VXI-11 (inst) instruments
-find('TCPIP?*inst?*INSTR')
-# HiSLIP (hislip) instruments
-find('TCPIP?*hislip?*INSTR')
-# RS-232 instruments
-find('ASRL?*INSTR')
-
-print('Done.')
\ No newline at end of file
+def identify(resourceManager, address, timeout=None):
+    """
+    Opens an instrument and returns its "*IDN?" answer, or None if it does not answer.
+
+    :param resourceManager: The resource manager opening the address.
+    :param address: The VISA address.
+    :param timeout: The open and I/O timeout in ms, the one of the interface in interface_timeouts if None.
+    """
+    timeout = interface_timeouts.get(interface(address), 2000) if timeout is None else timeout
+    resource = None
+    try:
+        resource = resourceManager.open_resource(address, open_timeout=timeout)
+        resource.timeout = timeout
+        return resource.query("*IDN?").strip() or None
+    except Exception:
+        return None
+    finally:
+        if resource is not None:
+            try:
+                resource.close()
+            except Exception:
+                pass
+
+
+def discover(resourceManager=None, interfaces=tuple(interface_timeouts), probe=probed_interfaces, workers=8):
+    """
+    Lists the instruments of every interface and identifies them, all concurrently.
+
+    :param resourceManager: The resource manager to use, a new one (closed afterwards) if None.
+    :param interfaces: The interfaces listed.
+    :param probe: The interfaces whose instruments are asked "*IDN?"; the others are listed with an identity of None.
+    :param workers: The number of concurrent listings and probes.
+    :return: A dict mapping every address found to its identity string (or None).
+    """
+    own_manager = resourceManager is None
+    if own_manager:
+        resourceManager = pyvisa.ResourceManager()
+
+    def listing(name):
+        try:
+            return resourceManager.list_resources(f"{name}?*INSTR")
+        except pyvisa.VisaIOError:
+            return ()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # An absent or slow interface only delays its own listing
+            addresses = [address for found in executor.map(listing, interfaces) for address in found]
+            addresses = list(dict.fromkeys(addresses))
+            probed = [address for address in addresses if interface(address) in probe]
+            identities = dict(zip(probed, executor.map(lambda address: identify(resourceManager, address), probed)))
+        return {address: identities.get(address) for address in addresses}
+    finally:
+        if own_manager:
+            resourceManager.close()
+
+
+def load_cache(path=cache_path, ttl=cache_ttl):
+    """
+    Returns the cached address -> identity map, or None if there is none or it is older than ttl seconds.
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get("time", 0) > ttl:
+        return None
+    return cache["devices"]
+
+
+def save_cache(devices, path=cache_path):
+    """
+    Writes the address -> identity map with the current time; the file is replaced atomically.
+    """
+    tmp_name = path + ".tmp"
+    with open(tmp_name, "w") as f:
+        json.dump({"time": time.time(), "devices": devices}, f, indent=2)
+    os.replace(tmp_name, path)
+
+
+def devices(refresh=False, ttl=cache_ttl, path=cache_path, resourceManager=None):
+    """
+    Returns the address -> identity map of the instruments, from the cache if it is recent enough.
+
+    :param refresh: If True, the buses are scanned even if the cache is valid.
+    :param ttl: The maximum age of the cache, in seconds.
+    :param path: The cache file.
+    :param resourceManager: The resource manager used for a scan, a new one if None.
+    """
+    cached = None if refresh else load_cache(path, ttl)
+    if cached is not None:
+        return cached
+    found = discover(resourceManager)
+    save_cache(found, path)
+    return found
+
+
+def resolve(pattern, ttl=cache_ttl, path=cache_path, resourceManager=None):
+    """
+    Returns the address of the first instrument whose identity or address matches a pattern, e.g. "DSO" or
+    "KEYSIGHT" for the Infiniium. The cache is used first; the buses are scanned again if nothing matches.
+
+    :param pattern: A regular expression searched in the identities and addresses, case-insensitive.
+    :param ttl: The maximum age of the cache, in seconds.
+    :param path: The cache file.
+    :param resourceManager: The resource manager used for a scan, a new one if None.
+    :return: The VISA address, or None if no instrument matches.
+    """
+    expression = re.compile(pattern, re.IGNORECASE)
+
+    def match(found):
+        for address, identity in found.items():
+            if expression.search(identity or "") or expression.search(address):
+                return address
+        return None
+
+    cached = load_cache(path, ttl)
+    if cached is not None:
+        address = match(cached)
+        if address is not None:
+            return address
+    # Without a cache, or without a match in it, the buses are scanned once and the cache refreshed
+    return match(devices(True, ttl, path, resourceManager))
+
+
+if __name__ == "__main__":
+    resourceManager = pyvisa.ResourceManager()
+
+    # Find all devices and interfaces
+    print('Find all devices and interfaces:\n')
+    find('?*', resourceManager)
+
+    # Different search strings can be used to specify other device types. Common examples include:
+
+    # All instruments (excluding interfaces, backplanes, or memory access)
+    find('?*INSTR', resourceManager)
+    # PXI modules
+    find('PXI?*INSTR', resourceManager)
+    # USB devices
+    find('USB?*INSTR', resourceManager)
+    # GPIB instruments
+    find('GPIB?*INSTR', resourceManager)
+    # GPIB interfaces
+    find('GPIB?*INTFC', resourceManager)
+    # GPIB instruments on the GPIB0 interface
+    find('GPIB0?*INSTR', resourceManager)
+    # LAN instruments
+    find('TCPIP?*INSTR', resourceManager)
+    # SOCKET (::SOCKET) instruments
+    find('TCPIP?*SOCKET', resourceManager)
+    # VXI-11 (inst) instruments
+    find('TCPIP?*inst?*INSTR', resourceManager)
+    # HiSLIP (hislip) instruments
+    find('TCPIP?*hislip?*INSTR', resourceManager)
+    # RS-232 instruments
+    find('ASRL?*INSTR', resourceManager)
+
+    # Identify the instruments and refresh the cache used by resolve
+    print('\nIdentify the instruments:')
+    for address, identity in devices(refresh=True, resourceManager=resourceManager).items():
+        print(f"\t{address}: {identity or '(not identified)'}")
+    print(f"Cached in {cache_path}.")
+
+    resourceManager.close()
+    print('Done.')
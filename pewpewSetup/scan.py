@@ -1,6 +1,12 @@
 import numpy as np
+import datetime
 from devices.PIStage import PIStage
-from devices.InfiniiumOscilloscope import InfiniiumOscilloscope, trig_mode_disct, acq_mode_dict
+from devices.InfiniiumOscilloscope import InfiniiumOscilloscope, trig_mode_disct, acq_mode_dict, wav_form_dict
+from storage import RunWriter, RunReader
+from analysis import QuadratureExtractor, ScanStatistics
+from scanning import AdaptiveScan, FlyScan, ResumableScan, ScanManifest, ScanPlan
+from tracing import Tracer
+from measures.find_devices import resolve
 
 # Oscilloscope variables
 channel="channel1"
@@ -16,23 +22,49 @@ time_scale="200e-6"
 time_position=0.0
 acquire_mode=acq_mode_dict[0]
 waveform_points=32000
-name_csv="data/waveform_data"
+waveform_format=wav_form_dict[1] # BYTE, or WORD for 16-bit samples in high-resolution mode
+segments=1 # pulses acquired per position with the segmented memory, 1 for a single acquisition
+shots=1 # single acquisitions per position in a burst (configured once, then digitize and download only), with segments=1
+error_policy="group"
+resume_path=None # run directory of an interrupted scan to finish, None to start a new run
+run_path=resume_path or "data/run_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+store_raw=False # the raw records are only needed to check the quadrature extraction
+mode_function="template" # "boxcar", or "template" to integrate against the pulse profile learned on the first record
+rep_rate=None # laser repetition rate in Hz, estimated from the calibration records if None
+calibration_records=16 # records (shots or segments) locating the pulse train before the scan, a single record holds too few pulses to estimate the period
+reference_position=None # stage position measuring the shot noise (signal blocked), None if not scanned
+shot_noise_variance=None # shot noise variance in V^2 from a separate measurement, used without reference position
+electronic_variance=0.0 # electronic noise variance in V^2 (detector blocked), subtracted from every variance
+adaptive=False # refine position_array where the variance changes, instead of scanning it as planned (no resume)
+adaptive_budget=64 # positions acquired by an adaptive scan, coarse pass included
+adaptive_min_spacing=0.0 # smallest distance between two positions of an adaptive scan in stage units, 0 for one count
+fly=False # acquire continuously while the stage crosses position_array at fly_velocity, every shot stamped with its position (no resume), statistics on the nearest position_array point
+fly_velocity=1e-3 # stage units/s
+fly_position_every=1 # shots between two position reads, more when the serial line is slower than the acquisitions
+trace=False # record the latency of every instrument call, written as a Chrome/Perfetto timeline with the run
 
 # stage variables
 bounds = [0, 25]
 stage='M1121DG'
 com_port='COM11'
 baud_rate=9600
+home_stage=True # the controller keeps its absolute position while powered, homing once per power cycle is enough
+passes=1 # repeated passes alternate direction, so averaging passes need no return trip
 
 
 # port variables
-port_oscilloscope = "USB0::0x0957::0x900A::MY51050155::INSTR"
+port_oscilloscope = None # None to look the Infiniium up in the device cache of measures/find_devices.py when the scan starts
+port_oscilloscope_fallback = "USB0::0x0957::0x900A::MY51050155::INSTR" # used when the lookup finds nothing
 port_stage = "COM11"
 
-def acquisition(name):
-    oscilloscope.single_acquisition(
+acquisitions = 0
+burst = None
+
+def acquire():
+    global acquisitions, burst
+    settings = dict(
     channel=channel, 
-    autoscale=autoscale, 
+    autoscale=autoscale and acquisitions == 0, # autoscaling at every position would invalidate the settings cache
     trigger_mode=trigger_mode, 
     trigger_level=trigger_level, 
     save_setup=save_setup, 
@@ -42,30 +74,130 @@ def acquisition(name):
     offset=offset,
     time_scale=time_scale,
     time_position=time_position,
-    acquire_mode=acquire_mode,
+    acquire_mode=acquire_mode if segments == 1 else "SEGMented",
     waveform_points=waveform_points
     )
-    oscilloscope.get_waveform(
+    if segments > 1:
+        # one trigger per segment, all segments downloaded in a single block by transfer()
+        oscilloscope.configure_acquisition(**settings)
+        oscilloscope.segmented_acquisition(
+            channel=channel,
+            segments=segments,
+            waveform_points=waveform_points,
+            waveform_format=waveform_format,
+            fetch=False
+        )
+    elif shots > 1:
+        # a new buffer per position, the previous one is still being stored by the worker
+        burst = oscilloscope.burst_acquisition(shots, waveform_format=waveform_format, **settings)
+    else:
+        oscilloscope.single_acquisition(**settings)
+    acquisitions += 1
+
+def transfer():
+    if segments > 1:
+        return oscilloscope.fetch_segments(
+            channel=channel,
+            segments=segments,
+            waveform_format=waveform_format
+        )
+    if shots > 1:
+        # the burst is downloaded shot by shot during acquire(), as (codes, send_times, preamble) like a segmented acquisition
+        return burst
+    return oscilloscope.get_waveform(
         channel=channel,
-        name_csv= name + ".csv"
+        waveform_format=waveform_format,
+        name_csv=None
     )
 
+def store(position, waveform):
+    # waveform is (codes, preamble), or (codes, time_tags, preamble) for segmented acquisitions and (codes, send_times, preamble) for bursts
+    codes, preamble = waveform[0], waveform[-1]
+    quadratures = extractor.extract(codes, preamble)
+    run.append(position, codes if store_raw else None, preamble, quadratures)
+    if fly:
+        # every fly shot has its own position: the statistics are kept on the nearest position of position_array,
+        # otherwise each shot would add an accumulator, all of them rewritten by every checkpoint
+        position = float(position_array[np.argmin(np.abs(position_array - position))])
+    moments = statistics.update(position, quadratures)
+    statistics.save(statistics_path)
+    print(f"position {position}: {moments.count} quadratures, mean {moments.mean:.4g} V, variance {moments.variance:.4g} V^2, "
+          f"noise {statistics.squeezing_db(position):+.2f} dB from shot noise")
+
 # initialize oscilloscope
-oscilloscope = InfiniiumOscilloscope(port_oscilloscope)
+if port_oscilloscope is None:
+    port_oscilloscope = resolve(r"(KEYSIGHT|AGILENT).*,(DSO|MSO|DSA|UXR)") or port_oscilloscope_fallback
+tracer = Tracer() if trace else None
+oscilloscope = InfiniiumOscilloscope(port_oscilloscope, error_policy=error_policy, tracer=tracer)
 oscilloscope.initialize()
 # initialize translation stage
 stage = PIStage(bounds=bounds, stage=stage, com_port=port_stage, baud_rate=baud_rate)
-stage.move_home()
+if tracer is not None:
+    stage.wrapper.enable_tracing(tracer)
+if home_stage and not stage.move_home():
+    # the absolute positions of the plan and of a resumed run would be shifted
+    raise RuntimeError("The stage could not be homed.")
+# open the run container, one row of quadratures (and of raw codes if store_raw) per shot
+run = RunWriter(run_path, metadata=dict(
+    channel=channel, scale=scale, offset=offset, time_scale=time_scale,
+    time_position=time_position, acquire_mode=acquire_mode, waveform_points=waveform_points,
+    stage=stage.stage, bounds=bounds, mode_function=mode_function))
+
+# the pulse train is located and the mode function built on calibration records acquired before the scan,
+# the calibration is stored in run.json and restored by a resumed run, so that all its quadratures match
+if run.calibration is not None:
+    extractor = QuadratureExtractor.from_calibration(run.calibration)
+    autoscale = False  # the pulses must stay where they were at the calibration
+else:
+    extractor = QuadratureExtractor(mode_function, rep_rate=rep_rate)
+    calibration = []
+    while sum(len(codes) for codes in calibration) < calibration_records:
+        acquire()
+        waveform = transfer()
+        if waveform is None:
+            raise RuntimeError("The calibration records could not be acquired.")
+        calibration.append(np.atleast_2d(waveform[0]))
+    extractor.calibrate(np.concatenate(calibration), waveform[-1])
+    run.save_calibration(extractor.calibration())
+print(f"pulse train: period {extractor.period:.2f} samples, {extractor.pulses} pulses per record")
+# moments and histograms per position, merged over the passes and checkpointed after every acquisition
+statistics_path = run_path + "/statistics.npz"
+statistics = ScanStatistics(reference_position=reference_position, shot_noise_variance=shot_noise_variance,
+                            electronic_variance=electronic_variance)
 
+# absolute positions from home, planned in controller counts; a resumed run keeps its own plan
 position_array = np.linspace(0.0,10e-3,5)
-final_position = position_array[0]
+if fly:
+    # one long move at constant velocity, the positions are as dense as the acquisitions allow
+    scan = FlyScan(stage, acquire, transfer, store, tracer=tracer)
+    timings = scan.run(position_array[0], position_array[-1], fly_velocity, position_every=fly_position_every)
+elif adaptive:
+    # position_array is the coarse pass, the positions added go where the quadrature variance changes the most
+    def merit(position):
+        moments = statistics[position]
+        if moments.count < 2:
+            return np.nan, np.inf  # no variance from a single quadrature, the position counts as unknown
+        return moments.variance, moments.variance * np.sqrt(2 / (moments.count - 1))
+    scan = AdaptiveScan(stage, acquire, transfer, store, merit, adaptive_min_spacing, tracer=tracer)
+    timings = scan.run(position_array, max_acquisitions=adaptive_budget)
+else:
+    plan = ScanManifest.saved_plan(run_path, stage.wrapper) or ScanPlan.from_positions(
+        position_array, stage.wrapper, passes=passes, current_position=stage.get_position(), bounds=bounds)
+    velocity, acceleration = stage.motion_parameters()
+    plan.report(velocity, acceleration, start_counts=stage.get_position_counts())
 
-for i in range(len(position_array)):
-    if(i == 0):
-        final_position = stage.move(position_array[i])
-    else:
-        final_position = stage.move(position_array[i]-position_array[i-1])
-    print(f"position : {final_position*1e2}")
-    acquisition(name_csv + "_" + str(final_position*1e2))
+    # the stage moves to the next position while the waveform is transferred; every stored position is committed
+    # to the manifest of the run, so that rerunning with resume_path only acquires the positions left
+    scan = ResumableScan(run, plan, stage, acquire, transfer, store, tracer=tracer)
+    # the statistics are rebuilt from the committed quadratures, the checkpoint may hold a position acquired again
+    reader = RunReader(run_path)
+    for position, pass_number, rows in scan.units():
+        statistics.update(position, reader.quadratures[rows])
+    timings = scan.run()
+timings.summary()
+if tracer is not None:
+    tracer.summary()
+    tracer.export_chrome_trace(run_path + "/trace.json")
 
+run.close()
 oscilloscope.close()
\ No newline at end of file
@@ -0,0 +1,5 @@
+from .adaptive import AdaptiveScan
+from .fly import FlyScan
+from .pipeline import PipelinedScan, ScanTimings
+from .planner import ScanPlan, move_duration
+from .resumable import ResumableScan, ScanManifest
@@ -0,0 +1,130 @@
+"""
+Adaptive scans refining the positions where the measured signal changes.
+
+A coarse pass is acquired first. Both axes are then normalized by their ranges and every interval
+between two measured positions gets a loss:
+
+    loss = sqrt(triangle_area) + 0.02 * (hypot(dx, dy) + dx) + uncertainty_weight * (error_left + error_right)
+
+triangle_area being the largest area of the triangles its ends form with their other neighbours. The
+area follows the curvature, so fringes, dips and edges get most of the positions while straight and
+flat regions only keep a small share through the length terms; the error bars of the figure of merit
+make uncertain intervals count as well, and the intervals next to a position without a usable value
+(an infinite error) come first. The intervals with the largest losses are split at their middle, a
+batch at a time, each batch being scanned in one sweep with a PipelinedScan, until the acquisition or
+time budget is spent or no interval can be split above the minimum spacing.
+"""
+
+import time
+import numpy as np
+from .pipeline import PipelinedScan, ScanTimings
+from .planner import ScanPlan
+
+
+class AdaptiveScan:
+    """
+    Scan engine choosing the next positions from the figure of merit of the previous ones.
+
+    Attributes:
+        stage (PIStage): The stage, see PipelinedScan.
+        acquire, transfer, sink (callable): See PipelinedScan; the sink stores the waveform and updates what merit reads.
+        merit (callable): Called on the main thread as merit(position) after the position was stored; returns the figure
+                          of merit of the position, or a tuple (value, error). A NaN value or an infinite error (e.g. a
+                          variance from a single shot) marks the position as unknown.
+        min_spacing (float): The smallest distance between two positions, in stage units.
+        batch (int): The number of positions added per round.
+        uncertainty_weight (float): The weight of the error bars in the loss, 0 to only follow the shape of the values.
+        values (dict): The figure of merit and its error at every measured position, in stage units.
+    """
+
+    def __init__(self, stage, acquire, transfer, sink, merit, min_spacing, batch=8, uncertainty_weight=1.0, queue_size=8, tracer=None):
+        self.stage = stage
+        self.merit = merit
+        self.min_spacing = min_spacing
+        self.batch = batch
+        self.uncertainty_weight = uncertainty_weight
+        self.values = {}
+        self._positions = {}  # Controller counts -> position, the intervals are split in counts
+        self.scan = PipelinedScan(stage, acquire, transfer, sink, queue_size, tracer)
+
+    def losses(self):
+        """
+        Returns the measured positions in controller counts, sorted, and the loss of every interval between two
+        consecutive positions. The intervals ending at an unknown position have an infinite loss.
+        """
+        counts = np.array(sorted(self._positions))
+        values, errors = np.array([self.values[self._positions[c]] for c in counts]).T
+        known = np.isfinite(values) & np.isfinite(errors)
+        values, errors = np.where(known, values, 0.0), np.where(known, errors, 0.0)
+        value_range = (np.ptp(values[known]) or np.max(np.abs(values[known]))) if known.any() else 0.0
+        x = (counts - counts[0]) / (counts[-1] - counts[0] or 1)
+        y, errors = values / (value_range or 1.0), errors / (value_range or 1.0)
+        dx, dy = np.diff(x), np.diff(y)
+        area = np.zeros(len(x))
+        area[1:-1] = 0.5 * np.abs(dx[:-1] * dy[1:] - dx[1:] * dy[:-1])  # Triangle of every point with its neighbours
+        area[1:-1] *= known[:-2] & known[1:-1] & known[2:]
+        losses = (np.sqrt(np.maximum(area[:-1], area[1:])) + 0.02 * (np.hypot(dx, dy) + dx)
+                  + self.uncertainty_weight * (errors[1:] + errors[:-1]))
+        return counts, np.where(known[1:] & known[:-1], losses, np.inf)
+
+    def propose(self, count):
+        """
+        Returns up to count new positions in controller counts, the middles of the intervals with the largest losses.
+        """
+        counts, losses = self.losses()
+        min_counts = max(1, int(np.ceil(self.min_spacing / self.stage.wrapper.counts_to_units(1))))
+        losses = np.where(np.diff(counts) >= 2 * min_counts, losses, -np.inf)
+        best = np.argsort(losses)[::-1][:count]
+        best = best[losses[best] > -np.inf]
+        return np.sort((counts[best] + counts[best + 1]) // 2)
+
+    def _round(self, plan, timings):
+        targets = [float(plan.wrapper.counts_to_units(c)) for c in plan.counts]
+        round_timings = self.scan.run(plan)
+        for name in ScanTimings.phase_names:
+            timings.phases[name] += round_timings.phases[name]
+        timings.moves += round_timings.moves
+        timings.writes += round_timings.writes
+        timings.failed += round_timings.failed
+        failed = {step for step, _ in round_timings.failed}
+        for step, target in enumerate(targets):
+            # A position whose transfer failed was not stored, it is unknown
+            value = (np.nan, np.inf) if step in failed else self.merit(target)
+            value, error = value if isinstance(value, tuple) else (value, 0.0)
+            # A position without a usable value or error is unknown, as uncertain as can be
+            self.values[target] = (float(value), float(error) if np.isfinite(value) and not np.isnan(error) else np.inf)
+        self._positions.update(zip((int(c) for c in plan.counts), targets))
+        return len(targets)
+
+    def run(self, coarse_positions, max_acquisitions=None, max_time=None):
+        """
+        Acquires the coarse positions, then refines until a budget is spent.
+
+        :param coarse_positions: The positions of the first pass, in stage units; they set the scanned range.
+        :param max_acquisitions: The maximum number of positions acquired, coarse pass included, or None.
+        :param max_time: The maximum duration of the scan in seconds, or None. A round is only started if the
+                         average duration of a position so far leaves time for it.
+        :return: The ScanTimings of the whole scan.
+        """
+        timings = ScanTimings()
+        start = time.perf_counter()
+        wrapper = self.stage.wrapper
+        acquired = self._round(ScanPlan.from_positions(coarse_positions, wrapper, current_position=self.stage.get_position()), timings)
+        while True:
+            count = self.batch
+            if max_acquisitions is not None:
+                count = min(count, max_acquisitions - acquired)
+            if max_time is not None:
+                per_position = (time.perf_counter() - start) / acquired
+                count = min(count, int((max_time - (time.perf_counter() - start)) / per_position))
+            counts = self.propose(count) if count > 0 else []
+            if len(counts) == 0:
+                break
+            # Sorted, so the round is scanned in one sweep starting from the closest end
+            current = wrapper.units_to_counts(self.stage.get_position())
+            if abs(current - counts[-1]) < abs(current - counts[0]):
+                counts = counts[::-1]
+            acquired += self._round(ScanPlan(counts, np.zeros(len(counts), dtype=np.int64), wrapper), timings)
+        timings.wall = time.perf_counter() - start
+        print(f"Adaptive scan: {acquired} positions acquired in {timings.wall:.1f} s.")
+        return timings
@@ -0,0 +1,182 @@
+"""
+Continuous-motion (fly) scans.
+
+A step scan pays the acceleration, the deceleration and the end-of-move polling at every position.
+A fly scan programs a constant velocity (SV) and acceleration (SA), starts a single long move from a
+run-up position before the scanned range to a run-out position after it, and acquires back to back
+while the stage crosses the range. The position is read (MMC_getPos) between the acquisitions, and
+every shot is stamped with the position interpolated in time at the middle of its acquisition,
+between the reads before and after it:
+
+    stage      |-run-up-|------------- constant velocity --------------|-run-out-|
+    main                |-TP-|-digitize-|-transfer-|-TP-|-digitize-|-transfer-|-TP-|...
+    worker                                             |-write 0-|                 |-write 1-|
+
+The shots are as dense as the acquisition and transfer allow, velocity * shot period apart, and
+every shot is smeared over velocity * acquisition time, reported in stamps.
+"""
+
+import queue
+import threading
+import time
+import numpy as np
+from .pipeline import PipelinedScan, ScanTimings
+
+# MaxInt - 3 to MaxInt are error codes of the position readers
+_POSITION_ERRORS = 2147483644
+# Constant velocity kept after stop, in seconds, so that the position read after the last shot is still on the line
+_RUN_OUT_TIME = 0.2
+
+
+class FlyScan(PipelinedScan):
+    """
+    Scan engine acquiring while the stage moves at a constant velocity, see PipelinedScan for the attributes.
+
+    Attributes:
+        stamps (numpy.ndarray): After run, the stamp of every shot: the interpolated position and the smear (the
+                                distance travelled during the acquisition), in stage units, and the time of the shot
+                                from the start of the scan, in seconds.
+        read_latency (float): The time between the start of a position read and the sampling of the position by the
+                              controller, in seconds; None for the transmission of "TP\\r" at the baud rate of the stage.
+                              A wrong latency shifts every stamp by velocity * error.
+    """
+
+    stamp_dtype = np.dtype([("position", "f8"), ("smear", "f8"), ("time", "f8")])
+
+    def __init__(self, stage, acquire, transfer, sink, queue_size=8, tracer=None):
+        super().__init__(stage, acquire, transfer, sink, queue_size, tracer)
+        self.stamps = np.zeros(0, dtype=self.stamp_dtype)
+        self.read_latency = None
+        self._latency = 0.0
+
+    def _read_counts(self):
+        """
+        Reads the position in counts and returns (time, counts). The controller samples the position as soon as it
+        receives the command, so the time is the start of the read plus the latency: the report takes most of the read.
+        """
+        t0 = time.perf_counter()
+        counts = self.stage.get_position_counts()
+        if counts >= _POSITION_ERRORS:
+            raise IOError(f"Error reading the position: {counts}")
+        return t0 + self._latency, counts
+
+    def run(self, start, stop, velocity, acceleration=None, max_shots=None, position_every=1):
+        """
+        Scans from start to stop at a constant velocity, acquiring continuously. The sink receives the stamped
+        position of every shot, in stage units. The velocity and acceleration of the controller are restored after the scan.
+
+        :param start: The position where the acquisitions start, in stage units.
+        :param stop: The position where the acquisitions stop, in stage units; it can be below start.
+        :param velocity: The scan velocity, in stage units/s.
+        :param acceleration: The acceleration of the run-up and run-out, in stage units/s^2, the programmed one if None.
+        :param max_shots: The maximum number of shots, or None to acquire until stop is reached.
+        :param position_every: The number of shots between two position reads. The shots in between are stamped by
+                               interpolation between the reads around them, and handed to the sink after the second one;
+                               on a slow serial line, the position read can take longer than the shot itself.
+        :return: The ScanTimings of the scan, wait_stage being the run-up.
+        """
+        wrapper = self.stage.wrapper
+        self._latency = 30 / self.stage.baud_rate if self.read_latency is None else self.read_latency
+        direction = 1 if stop >= start else -1
+        start_counts, stop_counts = wrapper.units_to_counts(start), wrapper.units_to_counts(stop)
+        saved_velocity, saved_acceleration = self.stage.motion_parameters()
+        velocity_counts = max(1, abs(wrapper.units_to_counts(velocity)))
+        acceleration_counts = saved_acceleration if acceleration is None else max(1, abs(wrapper.units_to_counts(acceleration)))
+        # The constant velocity is reached before start and kept until after stop
+        run_up = int(np.ceil(velocity_counts ** 2 / (2 * acceleration_counts))) + 1
+        run_out = run_up + int(np.ceil(velocity_counts * _RUN_OUT_TIME))
+        low, high = (wrapper.units_to_counts(bound) for bound in self.stage.bounds)
+        entry = min(max(start_counts - direction * run_up, low), high)
+        finish = min(max(stop_counts + direction * run_out, low), high)
+        if abs(entry - start_counts) < run_up or abs(finish - stop_counts) < run_out:
+            print("The run-up or run-out is cut by the stage bounds, the velocity is not constant over the whole range.")
+
+        self.stage.start_move_counts(entry)
+        if not self.stage.wait_motion():
+            self.stage.stop_motion()
+            raise TimeoutError(f"the stage did not reach the run-up position {entry} counts")
+        timings = ScanTimings()
+        stamps = []
+        waveforms = queue.Queue(maxsize=self.queue_size)
+        self._worker_error = None
+        worker = threading.Thread(target=self._worker, args=(waveforms, timings), daemon=True)
+        worker.start()
+        scan_start = time.perf_counter()
+        failed = False
+        try:
+            self.stage.set_motion_parameters(velocity_counts, acceleration_counts)
+            self.stage.start_move_counts(finish)
+            t0 = time.perf_counter()
+            before = self._read_counts()
+            while (before[1] - start_counts) * direction < 0:
+                if not self.stage.is_moving():
+                    raise RuntimeError(f"the stage stopped at {before[1]} counts before the start of the scan")
+                before = self._read_counts()
+            timings.phases["wait_stage"].append(time.perf_counter() - t0)
+            if self.tracer is not None:
+                self.tracer.add("scan", "run_up", t0, timings.phases["wait_stage"][-1])
+            # Shots acquired since the last position read, stamped once the next read brackets them
+            pending = []
+
+            def stamp(before):
+                after = self._read_counts()
+                for middle, duration, shot in pending:
+                    # Linear interpolation at the middle of the acquisition, the velocity being constant
+                    counts = before[1] + (after[1] - before[1]) * (middle - before[0]) / (after[0] - before[0])
+                    position = wrapper.counts_to_units(counts)
+                    stamps.append((position, wrapper.counts_to_units(velocity_counts) * duration, middle - scan_start))
+                    if shot is not None:
+                        waveforms.put((len(stamps) - 1, position, shot))
+                    else:
+                        timings.failed.append((len(stamps) - 1, position))
+                pending.clear()
+                return after
+
+            i = 0
+            while max_shots is None or i < max_shots:
+                # Between two reads, the position is extrapolated from the last one at the programmed velocity
+                if (stop_counts - before[1]) * direction - velocity_counts * (time.perf_counter() - before[0]) < 0:
+                    break
+                if self._worker_error is not None:
+                    raise RuntimeError(f"writing a waveform failed: {self._worker_error}")
+                t1 = time.perf_counter()
+                self.acquire()
+                t2 = time.perf_counter()
+                waveform = self.transfer()
+                t4 = time.perf_counter()
+                pending.append(((t1 + t2) / 2, t2 - t1, waveform))
+                i += 1
+                if len(pending) >= position_every:
+                    before = stamp(before)
+                t5 = time.perf_counter()
+                if i > 1:
+                    timings.phases["wait_stage"].append(0.0)
+                for name, start_time, duration in zip(ScanTimings.phase_names[1:], (t1, t2, t4), (t2 - t1, t4 - t2, t5 - t4)):
+                    timings.phases[name].append(duration)
+                    if self.tracer is not None:
+                        self.tracer.add("scan", name, start_time, duration)
+            if pending:
+                stamp(before)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            waveforms.put(None)
+            worker.join()
+            timings.wall = time.perf_counter() - scan_start
+            if failed:
+                # The run-out is not needed any more, the stage only decelerates
+                self.stage.stop_motion(smooth=True)
+                timeout = velocity_counts / acceleration_counts + 5.0
+            else:
+                timeout = abs(finish - entry) / velocity_counts + 30.0
+            # The velocity is only restored once the move is over, changing it during the move would change the move
+            self.stage.wait_motion(timeout=timeout)
+            self.stage.set_motion_parameters(saved_velocity, saved_acceleration)
+            self.stamps = np.array(stamps, dtype=self.stamp_dtype)
+        if self._worker_error is not None:
+            raise RuntimeError(f"writing a waveform failed: {self._worker_error}")
+        if len(self.stamps) > 1:
+            print(f"Fly scan: {len(self.stamps)} shots, {np.mean(np.abs(np.diff(self.stamps['position']))):.4g} apart, "
+                  f"smeared over {np.mean(self.stamps['smear']):.4g} stage units.")
+        return timings
@@ -0,0 +1,194 @@
+"""
+Pipelined scan engine.
+
+At every position the engine digitizes, starts the move to the next position, and only then
+downloads the waveform, so that the USB transfer runs while the stage is moving. Decoding and
+disk writes run on a background worker fed through a bounded queue.
+
+    position i     |-wait stage-|-digitize-|-transfer----|-enqueue-|
+    stage                       | moving to i+1 -------------------|-wait-|
+    worker                                                 |-write i-|
+"""
+
+import queue
+import threading
+import time
+import numpy as np
+from .planner import ScanPlan
+
+
+class ScanTimings:
+    """
+    Per-position timing of a pipelined scan, in seconds.
+
+    Attributes:
+        phases (dict): For each phase name, the list of durations measured at every position.
+        writes (list): The duration of the sink call for every position, measured on the worker.
+        wall (float): The wall-clock duration of the whole scan.
+        failed (list): The (step, position) of the steps whose transfer failed; they are not stored (nor committed).
+    """
+
+    phase_names = ("wait_stage", "acquire", "transfer", "enqueue")
+
+    def __init__(self):
+        self.phases = {name: [] for name in self.phase_names}
+        self.moves = []
+        self.writes = []
+        self.wall = 0.0
+        self.failed = []
+
+    def summary(self):
+        """
+        Prints the mean duration of every phase per position and how much of the stage motion was hidden by the transfer.
+        """
+        positions = len(self.phases["acquire"])
+        if positions == 0:
+            print("No position was acquired.")
+            return
+        print(f"{positions} positions in {self.wall:.3f} s, {self.wall / positions * 1e3:.1f} ms per position")
+        for name in self.phase_names:
+            print(f"  {name:<10s} {np.mean(self.phases[name]) * 1e3:8.1f} ms")
+        if self.writes:
+            print(f"  {'write':<10s} {np.mean(self.writes) * 1e3:8.1f} ms (background worker)")
+        if self.moves:
+            move = np.mean(self.moves)
+            waited = np.mean(self.phases["wait_stage"][1:len(self.moves) + 1])
+            print(f"  {'move':<10s} {move * 1e3:8.1f} ms, of which {max(move - waited, 0) * 1e3:.1f} ms overlapped with the transfer")
+        if self.failed:
+            print(f"  {len(self.failed)} transfers failed, positions not stored: {', '.join(str(position) for _, position in self.failed)}")
+
+
+class PipelinedScan:
+    """
+    Scan engine overlapping the stage motion with the waveform transfer, and the disk writes with both.
+
+    Attributes:
+        stage (PIStage): The stage, used through start_move, wait_motion and get_position.
+        acquire (callable): Called without argument once the stage is in position; configures and digitizes.
+        transfer (callable): Called without argument after acquire; downloads and returns the waveform, or None on error
+                             (the step is then recorded in ScanTimings.failed instead of being stored).
+        sink (callable): Called on the worker as sink(position, waveform) with the value returned by transfer.
+        queue_size (int): The maximum number of waveforms waiting for the worker.
+        tracer (Tracer): A tracing.Tracer receiving the phases of every position and the sink calls, or None.
+        on_stored (callable): Called on the worker as on_stored(step, position) once the sink returned for a step, or None.
+        verbose (bool): If True, prints every position with the position read back from the stage (one more serial round trip).
+    """
+
+    def __init__(self, stage, acquire, transfer, sink, queue_size=8, tracer=None):
+        self.stage = stage
+        self.acquire = acquire
+        self.transfer = transfer
+        self.sink = sink
+        self.queue_size = queue_size
+        self.tracer = tracer
+        self.on_stored = None
+        self.verbose = False
+        self._worker_error = None
+
+    @classmethod
+    def from_oscilloscope(cls, stage, oscilloscope, sink, channel="channel1", waveform_format="BYTE", queue_size=8, **acquisition_settings):
+        """
+        Builds a scan doing a single_acquisition then a get_waveform (without CSV file) at every position.
+
+        :param stage: The PIStage to move.
+        :param oscilloscope: The InfiniiumOscilloscope to acquire with.
+        :param sink: Called as sink(position, (codes, preamble)) on the worker.
+        :param channel: The channel to acquire and download.
+        :param waveform_format: The binary format of the waveform data.
+        :param queue_size: The maximum number of waveforms waiting for the worker.
+        :param acquisition_settings: The other single_acquisition parameters.
+        """
+        def acquire():
+            oscilloscope.single_acquisition(channel=channel, **acquisition_settings)
+
+        def transfer():
+            return oscilloscope.get_waveform(channel=channel, waveform_format=waveform_format, name_csv=None)
+
+        return cls(stage, acquire, transfer, sink, queue_size, oscilloscope.tracer)
+
+    def _worker(self, waveforms, timings):
+        while True:
+            item = waveforms.get()
+            if item is None:
+                return
+            if self._worker_error is not None:
+                continue  # Keep draining so that the producer never blocks
+            step, position, waveform = item
+            start = time.perf_counter()
+            try:
+                self.sink(position, waveform)
+                if self.on_stored is not None:
+                    self.on_stored(step, position)
+            except Exception as e:
+                self._worker_error = e
+            timings.writes.append(time.perf_counter() - start)
+            if self.tracer is not None:
+                self.tracer.add("scan", "write", start, timings.writes[-1])
+
+    def _start_move(self, positions, i):
+        """
+        Starts the move to step i and returns its target, in stage units.
+        """
+        if isinstance(positions, ScanPlan):
+            self.stage.start_move_counts(positions.counts[i])
+            return positions.wrapper.counts_to_units(positions.counts[i])
+        return self.stage.start_move(positions[i])
+
+    def run(self, positions, steps=None):
+        """
+        Scans the given absolute stage positions in order. The sink receives the target of each step,
+        so that repeated passes over a position share the same key.
+
+        :param positions: A ScanPlan, or the absolute stage positions in stage units.
+        :param steps: The indices of the steps to do, in order, or None for all of them (e.g. the steps left by an interrupted scan).
+        :return: The ScanTimings of the scan.
+        """
+        steps = list(range(len(positions)) if steps is None else steps)
+        timings = ScanTimings()
+        waveforms = queue.Queue(maxsize=self.queue_size)
+        self._worker_error = None
+        worker = threading.Thread(target=self._worker, args=(waveforms, timings), daemon=True)
+        worker.start()
+        scan_start = time.perf_counter()
+        try:
+            if len(steps) > 0:
+                target = self._start_move(positions, steps[0])
+            for k, i in enumerate(steps):
+                if self._worker_error is not None:
+                    raise RuntimeError(f"writing a waveform failed: {self._worker_error}")
+                t0 = time.perf_counter()
+                if not self.stage.wait_motion():
+                    self.stage.stop_motion()
+                    raise TimeoutError(f"the stage did not reach step {i} at {target}")
+                t1 = time.perf_counter()
+                if k > 0:
+                    timings.moves.append(t1 - move_start)
+                position = target
+                if self.verbose:
+                    print(f"position : {position} (read back {self.stage.get_position()})")
+                self.acquire()
+                t2 = time.perf_counter()
+                # The stage can leave as soon as the record is in the scope memory
+                if k + 1 < len(steps):
+                    target = self._start_move(positions, steps[k + 1])
+                    move_start = time.perf_counter()
+                t3 = time.perf_counter()
+                waveform = self.transfer()
+                t4 = time.perf_counter()
+                if waveform is not None:
+                    waveforms.put((i, position, waveform))
+                else:
+                    timings.failed.append((i, position))
+                    print(f"The waveform of step {i} at {position} could not be transferred, the step is not stored.")
+                t5 = time.perf_counter()
+                for name, start, duration in zip(ScanTimings.phase_names, (t0, t1, t3, t4), (t1 - t0, t2 - t1, t4 - t3, t5 - t4)):
+                    timings.phases[name].append(duration)
+                    if self.tracer is not None:
+                        self.tracer.add("scan", name, start, duration)
+        finally:
+            waveforms.put(None)
+            worker.join()
+            timings.wall = time.perf_counter() - scan_start
+        if self._worker_error is not None:
+            raise RuntimeError(f"writing a waveform failed: {self._worker_error}")
+        return timings
@@ -0,0 +1,146 @@
+"""
+Scan planning in absolute controller counts.
+
+Positions are converted to counts once, when the plan is built, and the stage is then sent to
+each absolute target with MMC_moveA. Nothing is accumulated from one step to the next, so there
+is no drift from clamping or rounding relative moves. Repeated passes alternate their direction
+(serpentine) so that averaging passes do not pay a return trip to the start of the scan.
+"""
+
+import numpy as np
+from devices.mercury_serial import default_velocity, default_acceleration
+
+
+def move_duration(distance, velocity, acceleration):
+    """
+    Duration of a point-to-point move with a trapezoidal (or triangular, for short moves) velocity profile.
+
+    :param distance: The distance to travel, in counts (scalar or array).
+    :param velocity: The programmed velocity, in counts/s.
+    :param acceleration: The programmed acceleration and deceleration, in counts/s^2.
+    :return: The duration of the move, in seconds.
+    """
+    distance = np.abs(np.asarray(distance, dtype=float))
+    triangular = distance < velocity ** 2 / acceleration
+    return np.where(triangular, 2 * np.sqrt(distance / acceleration), distance / velocity + velocity / acceleration)
+
+
+class ScanPlan:
+    """
+    An ordered list of absolute stage targets, in controller counts.
+
+    Attributes:
+        counts (numpy.ndarray): The absolute target of every step, in counts, in scan order.
+        passes (numpy.ndarray): The pass number of every step.
+        wrapper (MMC_Wrapper): Used for the conversions between stage units and counts.
+    """
+
+    def __init__(self, counts, passes, wrapper):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.passes = np.asarray(passes, dtype=np.int64)
+        self.wrapper = wrapper
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def from_positions(cls, positions, wrapper, passes=1, serpentine=True, optimize=True, current_position=None, bounds=None):
+        """
+        Builds a plan visiting the given positions once per pass.
+
+        :param positions: The positions to visit, in stage units.
+        :param wrapper: The MMC_Wrapper of the stage, used for units_to_counts.
+        :param passes: The number of passes over the positions (e.g. for averaging).
+        :param serpentine: If True, every other pass runs backwards, so that a new pass starts where the previous one ended.
+                           If False, every pass runs in the same direction, which keeps the backlash identical for every point.
+        :param optimize: If True, the positions are sorted to minimize the travel; otherwise the given order is kept.
+        :param current_position: The position of the stage before the scan, in stage units. The first pass starts from the closest end.
+        :param bounds: The [min, max] stage bounds, in stage units. Positions outside raise ValueError.
+        """
+        positions = np.asarray(positions, dtype=float)
+        if bounds is not None and ((positions < bounds[0]) | (positions > bounds[1])).any():
+            raise ValueError(f"positions outside of the stage bounds {bounds}")
+        counts = np.array([wrapper.units_to_counts(position) for position in positions], dtype=np.int64)
+        if optimize:
+            counts = np.unique(counts)  # Sorted, duplicates removed
+            if current_position is not None:
+                start_counts = wrapper.units_to_counts(current_position)
+                if abs(start_counts - counts[-1]) < abs(start_counts - counts[0]):
+                    counts = counts[::-1]
+        order = []
+        for n in range(passes):
+            order.append(counts[::-1] if serpentine and n % 2 == 1 else counts)
+        return cls(np.concatenate(order), np.repeat(np.arange(passes), len(counts)), wrapper)
+
+    @classmethod
+    def linear(cls, start, stop, steps, wrapper, **kwargs):
+        """
+        Builds a plan of evenly spaced positions, see from_positions for the other parameters.
+
+        :param start: The first position, in stage units.
+        :param stop: The last position, in stage units.
+        :param steps: The number of positions.
+        """
+        return cls.from_positions(np.linspace(start, stop, steps), wrapper, **kwargs)
+
+    @classmethod
+    def logarithmic(cls, start, stop, steps, wrapper, origin=0.0, **kwargs):
+        """
+        Builds a plan whose distances to an origin are logarithmically spaced, e.g. to sample a delay
+        finely close to zero and coarsely far from it. See from_positions for the other parameters.
+
+        :param start: The closest distance to the origin, in stage units (> 0).
+        :param stop: The farthest distance to the origin, in stage units.
+        :param steps: The number of positions.
+        :param origin: The position the distances are measured from, in stage units.
+        """
+        return cls.from_positions(origin + np.geomspace(start, stop, steps), wrapper, **kwargs)
+
+    @property
+    def positions(self):
+        """
+        The targets converted to stage units.
+        """
+        return np.array([self.wrapper.counts_to_units(c) for c in self.counts])
+
+    def travel(self, start_counts=None):
+        """
+        Returns the total travel of the plan, in counts.
+
+        :param start_counts: The position of the stage before the scan, in counts.
+        """
+        path = self.counts if start_counts is None else np.concatenate(([start_counts], self.counts))
+        return int(np.abs(np.diff(path)).sum())
+
+    def reversals(self):
+        """
+        Returns the number of direction reversals of the plan.
+        """
+        steps = np.sign(np.diff(self.counts))
+        steps = steps[steps != 0]
+        return int(np.count_nonzero(steps[1:] != steps[:-1]))
+
+    def estimate_time(self, velocity=default_velocity, acceleration=default_acceleration, settle_time=0.0, acquisition_time=0.0, start_counts=None):
+        """
+        Estimates the duration of the scan.
+
+        :param velocity: The programmed velocity, in counts/s.
+        :param acceleration: The programmed acceleration, in counts/s^2.
+        :param settle_time: The time waited after every move, in seconds.
+        :param acquisition_time: The time spent acquiring at every position, in seconds.
+        :param start_counts: The position of the stage before the scan, in counts.
+        :return: The estimated duration, in seconds.
+        """
+        path = self.counts if start_counts is None else np.concatenate(([start_counts], self.counts))
+        moves = move_duration(np.diff(path), velocity, acceleration).sum()
+        return float(moves + len(self.counts) * (settle_time + acquisition_time))
+
+    def report(self, velocity=default_velocity, acceleration=default_acceleration, settle_time=0.0, acquisition_time=0.0, start_counts=None):
+        """
+        Prints a summary of the plan and its estimated duration.
+        """
+        duration = self.estimate_time(velocity, acceleration, settle_time, acquisition_time, start_counts)
+        print(f"Scan plan: {len(self.counts)} steps in {self.passes.max() + 1 if len(self.passes) else 0} passes, "
+              f"travel {self.wrapper.counts_to_units(self.travel(start_counts)):.4f}, {self.reversals()} reversals, "
+              f"estimated time {duration:.1f} s")
+        return duration
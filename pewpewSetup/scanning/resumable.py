@@ -0,0 +1,172 @@
+"""
+Checkpointed scans that resume where they were interrupted.
+
+The run directory holds a manifest.json next to the RunWriter files: the plan of the scan and, for
+every completed step (position and pass), the rows of the run holding its shots. A step is committed
+once its shots are flushed to the run, by replacing the manifest atomically, so the manifest always
+describes complete data. After a crash (VISA timeout, sys.exit on an instrument error, power cut),
+running the same scan on the same directory drops the shots written after the last commit and only
+acquires the steps that were not committed: an interrupted overnight scan loses one position.
+"""
+
+import datetime
+import json
+import os
+
+from .pipeline import PipelinedScan
+from .planner import ScanPlan
+
+
+class ScanManifest:
+    """
+    The plan of a scan and its completed steps, stored in manifest.json.
+
+    Attributes:
+        path (str): The manifest file.
+        counts (list): The target of every step of the plan, in controller counts.
+        passes (list): The pass of every step of the plan.
+        units (list): The completed steps, in completion order, as dicts with the step index, position,
+                      pass and the [start, stop) rows of its shots in the run.
+    """
+
+    def __init__(self, path, plan):
+        """
+        Loads the manifest of a run directory, or creates it for a new scan.
+
+        :param path: The run directory.
+        :param plan: The ScanPlan of the scan; it must be the plan of the manifest when resuming.
+        """
+        self.path = os.path.join(path, "manifest.json")
+        counts, passes = [int(c) for c in plan.counts], [int(n) for n in plan.passes]
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest["counts"] != counts or manifest["passes"] != passes:
+                raise ValueError(f"{path} was acquired with another scan plan, it cannot be resumed with this one")
+            self.created = manifest["created"]
+            self.units = manifest["units"]
+        else:
+            self.created = datetime.datetime.now().isoformat()
+            self.units = []
+        self.counts, self.passes = counts, passes
+        self.completed = {unit["step"] for unit in self.units}
+        if not os.path.exists(self.path):
+            self._write()
+
+    def __len__(self):
+        return len(self.units)
+
+    @staticmethod
+    def saved_plan(path, wrapper):
+        """
+        Returns the ScanPlan recorded in the manifest of a run directory, or None if there is no manifest.
+        Resuming with the saved plan avoids a plan built differently (e.g. from another start position).
+
+        :param path: The run directory.
+        :param wrapper: The MMC_Wrapper of the stage.
+        """
+        try:
+            with open(os.path.join(path, "manifest.json")) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        return ScanPlan(manifest["counts"], manifest["passes"], wrapper)
+
+    @property
+    def rows(self):
+        """
+        The number of committed shots of the run.
+        """
+        return self.units[-1]["rows"][1] if self.units else 0
+
+    def remaining(self):
+        """
+        Returns the indices of the steps that were not completed, in plan order.
+        """
+        return [step for step in range(len(self.counts)) if step not in self.completed]
+
+    def commit(self, step, position, rows):
+        """
+        Records a completed step; the manifest file is replaced atomically.
+
+        :param step: The index of the step in the plan.
+        :param position: The position given to the sink, in stage units.
+        :param rows: The number of shots of the run once the step is stored.
+        """
+        self.units.append({"step": step, "position": position, "pass": self.passes[step], "rows": [self.rows, rows],
+                           "time": datetime.datetime.now().isoformat()})
+        self.completed.add(step)
+        self._write()
+
+    def _write(self):
+        tmp_name = self.path + ".tmp"
+        with open(tmp_name, "w") as f:
+            json.dump({"created": self.created, "counts": self.counts, "passes": self.passes, "units": self.units}, f)
+            f.flush()
+            os.fsync(f.fileno())  # The commit must not reach the disk before its content
+        os.replace(tmp_name, self.path)
+
+
+class ResumableScan:
+    """
+    A PipelinedScan whose completed steps are committed to a manifest, and which only does the remaining steps.
+
+    Attributes:
+        writer (RunWriter): The run written by the sink.
+        plan (ScanPlan): The plan of the scan.
+        manifest (ScanManifest): The completed steps.
+        scan (PipelinedScan): The scan engine.
+    """
+
+    def __init__(self, writer, plan, stage, acquire, transfer, sink, queue_size=8, tracer=None):
+        """
+        Opens or creates the manifest of the run and drops the shots written after its last commit.
+
+        :param writer: The RunWriter the sink appends to, one append per step.
+        :param plan: The ScanPlan of the scan.
+        :param stage: The stage, see PipelinedScan.
+        :param acquire: Called without argument once the stage is in position, see PipelinedScan.
+        :param transfer: Called without argument after acquire, see PipelinedScan.
+        :param sink: Called on the worker as sink(position, waveform), see PipelinedScan.
+        :param queue_size: The maximum number of waveforms waiting for the worker.
+        :param tracer: A tracing.Tracer, or None.
+        """
+        self.writer = writer
+        self.plan = plan
+        self.manifest = ScanManifest(writer.path, plan)
+        if len(writer) > self.manifest.rows:
+            print(f"Dropping {len(writer) - self.manifest.rows} shots written after the last checkpoint.")
+        writer.truncate(self.manifest.rows)
+        self.scan = PipelinedScan(stage, acquire, transfer, sink, queue_size, tracer)
+        self.scan.on_stored = self._commit
+
+    @property
+    def done(self):
+        return not self.manifest.remaining()
+
+    def _commit(self, step, position):
+        self.writer.flush()
+        self.manifest.commit(step, float(position), len(self.writer))
+
+    def units(self):
+        """
+        Yields (position, pass, rows) for every committed step, rows being a slice of the run, e.g. to rebuild
+        statistics from the stored quadratures when resuming.
+        """
+        for unit in self.manifest.units:
+            yield unit["position"], unit["pass"], slice(*unit["rows"])
+
+    def run(self):
+        """
+        Acquires the steps that were not completed.
+
+        :return: The ScanTimings of the steps done now.
+        """
+        steps = self.manifest.remaining()
+        if self.manifest.units:
+            print(f"Resuming the scan: {len(self.manifest)} of {len(self.plan)} steps already done, {len(steps)} left.")
+        timings = self.scan.run(self.plan, steps)
+        if timings.failed:
+            # The failed steps are not committed, resuming acquires them again
+            print(f"{len(timings.failed)} steps were not stored, run the scan again on {self.writer.path} to acquire them.")
+        return timings
@@ -0,0 +1,2 @@
+from .mercury import MercurySimulator, SimulatedAxis
+from .infiniium import SimulatedInfiniium, SimulatedResourceManager
@@ -0,0 +1,327 @@
+"""
+Simulated Keysight Infiniium oscilloscope behind a fake VISA resource.
+
+SimulatedInfiniium answers the SCPI subset used by devices.InfiniiumOscilloscope and returns synthetic
+pulsed homodyne records: a train of Gaussian pulses whose areas follow the quadrature statistics of
+a coherent state (mean amplitude, shot noise), plus electronic noise, quantized like the scope ADC.
+Channels 1 and 2 are the two photodiodes of a balanced detector (the local oscillator pulse on both,
+the quadrature with opposite signs), the other channels a reference of the local oscillator alone, and
+":FUNCtion<n>:SUBTract" / ":FUNCtion<n>:ADD" define math functions of two sources. ":DIGitize" blocks
+for the acquisition, ":SINGle" arms it and returns; its end is reported by ":ADER?" and awaited by "*OPC?",
+and ":STOP" aborts it.
+Acquisition and transfer times are modelled so that scan throughput can be measured without hardware:
+
+    oscilloscope = InfiniiumOscilloscope("SIM::INSTR", resource_manager=SimulatedResourceManager())
+"""
+
+import re
+import time
+import numpy as np
+import pyvisa.util
+
+from devices.InfiniiumOscilloscope import wav_form_dict, wav_dtype_dict
+
+# ADC resolution of the records, by waveform format
+format_bits = {"BYTE": 8, "WORD": 16, "LONG": 16, "LONGLONG": 16}
+
+
+def source_name(source):
+    """
+    Returns the long upper-case form of a channel or function name, e.g. "CHANNEL1" for "chan1".
+    """
+    match = re.fullmatch(r":?(CHAN|FUNC)[A-Z]*(\d+)", source.strip().upper())
+    if match is None:
+        raise KeyError(f"unknown source '{source}'")
+    return ("CHANNEL" if match.group(1) == "CHAN" else "FUNCTION") + match.group(2)
+
+
+class SimulatedInfiniium:
+    """
+    A fake pyvisa resource speaking the SCPI subset of InfiniiumOscilloscope.
+
+    Attributes:
+        rep_rate (float): The repetition rate of the pulses in a record, in Hz.
+        pulse_width (float): The standard deviation of the Gaussian pulses, in seconds.
+        coherent_amplitude (float): The mean pulse amplitude at zero phase, in volts.
+        phase (float): The local oscillator phase, in radians; the mean amplitude is coherent_amplitude * cos(phase).
+        lo_amplitude (float): The amplitude of the local oscillator pulses on every photodiode, in volts.
+        shot_noise (float): The standard deviation of the pulse amplitudes, in volts.
+        electronic_noise (float): The standard deviation of the per-sample noise, in volts.
+        trigger_rate (float): The rate of the triggers, in Hz; one segment is recorded per trigger.
+        arm_time (float): The fixed cost of a :DIGitize, in seconds.
+        latency (float): The round-trip time of every command and query, in seconds.
+        bandwidth (float): The throughput of the binary block transfers, in bytes/s.
+        log (list): Every command and query received, in order.
+    """
+
+    def __init__(self, rep_rate=1e6, pulse_width=20e-9, coherent_amplitude=0.0, phase=0.0, lo_amplitude=0.0, shot_noise=0.05,
+                 electronic_noise=0.005, trigger_rate=1e3, arm_time=2e-3, latency=5e-4, bandwidth=25e6, seed=None):
+        self.rep_rate = rep_rate
+        self.pulse_width = pulse_width
+        self.coherent_amplitude = coherent_amplitude
+        self.phase = phase
+        self.lo_amplitude = lo_amplitude
+        self.shot_noise = shot_noise
+        self.electronic_noise = electronic_noise
+        self.trigger_rate = trigger_rate
+        self.arm_time = arm_time
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.timeout = 2000
+        self.log = []
+        self.errors = []
+        self._rng = np.random.default_rng(seed)
+        self._pulses = None  # Quadrature amplitude under every sample of every segment of the last acquisition
+        self._shape = None  # Pulse shape under every sample
+        self._records = {}  # Records of the sources of the last acquisition, in volts, computed when fetched
+        self._done_at = None  # perf_counter time at which the armed acquisition ends, None when nothing is armed
+        self._acquisition_done = False  # Acquisition done event register, cleared when read by :ADER?
+        self._acquired_at = time.localtime()  # Date and time of the last acquisition, reported by the preamble
+        self.reset()
+
+    def reset(self):
+        """
+        Restores the default settings, as *RST.
+        """
+        self.settings = {
+            ":ACQUIRE:POINTS": "1000",
+            ":ACQUIRE:MODE": "RTIMe",
+            ":ACQUIRE:SEGMENTED:COUNT": "2",
+            ":TIMEBASE:SCALE": "1e-6",
+            ":TIMEBASE:POSITION": "0",
+            ":WAVEFORM:SOURCE": "CHANnel1",
+            ":WAVEFORM:FORMAT": "ASCii",
+            ":WAVEFORM:BYTEORDER": "MSBFirst",
+            ":WAVEFORM:SEGMENTED:ALL": "OFF",
+            ":TRIGGER:MODE": "EDGE",
+        }
+        self._pulses = None
+        self._records = {}
+        self._done_at = None
+        self._acquisition_done = False
+
+    def inject_error(self, message='-113,"Undefined header"'):
+        """
+        Queues an instrument error, reported by *ESR? and :SYSTem:ERRor?.
+        """
+        self.errors.append(message)
+
+    # pyvisa resource interface
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, command):
+        time.sleep(self.latency)
+        self.log.append(command)
+        header, _, argument = command.strip().partition(" ")
+        header = header.upper()
+        if header == "*RST":
+            self.reset()
+        elif header == "*CLS":
+            self.errors.clear()
+        elif header == ":DIGITIZE":
+            self._digitize()
+        elif header == ":SINGLE":
+            start = time.perf_counter()
+            self._done_at = start + self._acquire()
+        elif header == ":STOP":
+            self._update_acquisition()
+            self._done_at = None  # An acquisition still running is aborted
+        elif header in (":AUTOSCALE", ":RUN") or header.startswith(":MEASURE"):
+            pass
+        else:
+            self.settings[header] = argument
+        return len(command)
+
+    def write_binary_values(self, command, values, datatype="B"):
+        self.write(command)
+
+    def query(self, query):
+        time.sleep(self.latency)
+        self.log.append(query)
+        header, _, argument = query.strip().partition(" ")
+        header = header.upper()
+        if header == "*IDN?":
+            return "KEYSIGHT TECHNOLOGIES,DSO9254A,SIM00001,simulated"
+        if header == "*OPC?":
+            if self._done_at is not None:
+                time.sleep(max(self._done_at - time.perf_counter(), 0))
+                self._update_acquisition()
+            return "1"
+        if header == ":ADER?":
+            self._update_acquisition()
+            done, self._acquisition_done = self._acquisition_done, False
+            return "1" if done else "0"
+        if header == "*ESR?":
+            return "16" if self.errors else "0"
+        if header == ":SYSTEM:ERROR?":
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        if header == ":WAVEFORM:PREAMBLE?":
+            return self._preamble()
+        if header in (":WAVEFORM:XINCREMENT?", ":WAVEFORM:XORIGIN?"):
+            return repr(self._time_axis()[header == ":WAVEFORM:XORIGIN?"])
+        if header in (":WAVEFORM:YINCREMENT?", ":WAVEFORM:YORIGIN?"):
+            return repr(self._vertical()[header == ":WAVEFORM:YORIGIN?"])
+        if header == ":WAVEFORM:TYPE?":
+            return "RAW"
+        if header == ":WAVEFORM:POINTS?":
+            return self.settings[":ACQUIRE:POINTS"]
+        if header == ":WAVEFORM:SEGMENTED:XLIST?":
+            segments = len(self._pulses) if self._pulses is not None else 1
+            return ",".join(f"{i / self.trigger_rate:.9e}" for i in range(segments))
+        value = self.settings.get(header[:-1], "0")
+        if argument and value.upper().startswith(argument.upper() + ","):
+            return value.split(",", 1)[1]  # e.g. :TRIGger:LEVel? channel1
+        return value
+
+    def query_binary_values(self, query, datatype="f", is_big_endian=False, container=list, **kwargs):
+        self.log.append(query)
+        header = query.strip().split(" ")[0].upper()
+        if header == ":WAVEFORM:DATA?":
+            payload = self._waveform_block()
+        else:
+            payload = bytes(1024)  # e.g. :DISPlay:DATA? PNG
+        time.sleep(self.latency + len(payload) / self.bandwidth)
+        if datatype == "s":
+            return container(payload)
+        return pyvisa.util.from_binary_block(payload, 0, len(payload), datatype, is_big_endian, container)
+
+    # Acquisition model
+
+    def _segments(self):
+        if self.settings[":ACQUIRE:MODE"].upper().startswith("SEGM"):
+            return int(float(self.settings[":ACQUIRE:SEGMENTED:COUNT"]))
+        return 1
+
+    def _time_axis(self):
+        points = int(float(self.settings[":ACQUIRE:POINTS"]))
+        window = 10 * float(self.settings[":TIMEBASE:SCALE"])
+        return window / points, float(self.settings[":TIMEBASE:POSITION"]) - window / 2
+
+    def _vertical(self):
+        source = source_name(self.settings[":WAVEFORM:SOURCE"])
+        scale = float(self.settings.get(f":{source}:SCALE", "0.1"))
+        offset = float(self.settings.get(f":{source}:OFFSET", "0"))
+        bits = format_bits.get(self.settings[":WAVEFORM:FORMAT"].upper(), 16)
+        return 8 * scale / 2 ** bits, offset
+
+    def _update_acquisition(self):
+        """
+        Sets the acquisition done event once the armed acquisition is over.
+        """
+        if self._done_at is not None and time.perf_counter() >= self._done_at:
+            self._done_at = None
+            self._acquisition_done = True
+
+    def _digitize(self):
+        """
+        Acquires, taking the time of the acquisition.
+        """
+        start = time.perf_counter()
+        duration = self._acquire()
+        self._done_at = None
+        self._acquisition_done = True
+        time.sleep(max(duration - (time.perf_counter() - start), 0))
+
+    def _acquire(self):
+        """
+        Draws the pulse amplitudes of every segment and returns the duration of the acquisition, in seconds.
+        """
+        segments = self._segments()
+        points = int(float(self.settings[":ACQUIRE:POINTS"]))
+        x_increment, x_origin = self._time_axis()
+        t = x_origin + x_increment * np.arange(points)
+        # Every sample belongs to the nearest pulse of the train
+        nearest = np.rint(t * self.rep_rate)
+        shape = np.exp(-0.5 * ((t - nearest / self.rep_rate) / self.pulse_width) ** 2)
+        pulse = (nearest - nearest[0]).astype(np.int64)
+        mean = self.coherent_amplitude * np.cos(self.phase)
+        amplitudes = mean + self.shot_noise * self._rng.standard_normal((segments, pulse[-1] + 1))
+        self._pulses = amplitudes[:, pulse]
+        self._shape = shape
+        self._records = {}
+        self._acquired_at = time.localtime()
+        self._source_record("CHANNEL1")
+        return self.arm_time + segments / self.trigger_rate
+
+    def _source_record(self, source):
+        """
+        Returns the record of a channel or function of the last acquisition, in volts, one row per segment.
+        """
+        source = source_name(source)
+        if source not in self._records:
+            if source.startswith("FUNCTION"):
+                for operation, sign in (("SUBTRACT", -1), ("ADD", 1)):
+                    operands = self.settings.get(f":{source}:{operation}")
+                    if operands:
+                        first, second = operands.split(",")
+                        record = self._source_record(first) + sign * self._source_record(second)
+                        break
+                else:
+                    raise KeyError(f"{source} is not defined")
+            else:
+                channel = int(source[len("CHANNEL"):])
+                sign = {1: 1, 2: -1}.get(channel, 0)
+                record = (self.lo_amplitude + sign * self._pulses) * self._shape
+                record += self.electronic_noise * self._rng.standard_normal(record.shape)
+            self._records[source] = record
+        return self._records[source]
+
+    def _waveform_block(self):
+        if self._pulses is None:
+            self._digitize()
+        waveform_format = self.settings[":WAVEFORM:FORMAT"].upper()
+        dtype = np.dtype(wav_dtype_dict.get(waveform_format, "b"))
+        y_increment, y_origin = self._vertical()
+        limits = np.iinfo(dtype)
+        bits = format_bits.get(waveform_format, 16)
+        low, high = max(limits.min, -2 ** (bits - 1)), min(limits.max, 2 ** (bits - 1) - 1)
+        record = self._source_record(self.settings[":WAVEFORM:SOURCE"])
+        record = record if self.settings[":WAVEFORM:SEGMENTED:ALL"].upper() == "ON" else record[-1:]
+        codes = np.clip(np.rint((record - y_origin) / y_increment), low, high).astype(dtype)
+        if self.settings[":WAVEFORM:BYTEORDER"].upper().startswith("MSB"):
+            codes = codes.astype(dtype.newbyteorder(">"))
+        return codes.tobytes()
+
+    def _preamble(self):
+        waveform_format = self.settings[":WAVEFORM:FORMAT"].upper()
+        format_code = next(code for code, name in wav_form_dict.items() if name.upper() == waveform_format)
+        points = self.settings[":ACQUIRE:POINTS"]
+        x_increment, x_origin = self._time_axis()
+        y_increment, y_origin = self._vertical()
+        x_range = x_increment * int(float(points))
+        # Like the instrument, the date and time are those of the acquisition
+        date = time.strftime('"%d %b %Y"', self._acquired_at).upper()
+        clock = time.strftime('"%H:%M:%S:00"', self._acquired_at)
+        fields = [format_code, 1, points, 1, repr(x_increment), repr(x_origin), 0, repr(y_increment), repr(y_origin), 0, 1,
+                  repr(x_range), repr(x_origin), repr(y_increment * 2 ** 8), repr(y_origin), date, clock,
+                  '"DSO9254A:SIM00001"', 0, 100, 2, 1, "2.5e9", "0"]
+        return ",".join(str(field) for field in fields)
+
+
+class SimulatedResourceManager:
+    """
+    Stands for pyvisa.ResourceManager and opens a SimulatedInfiniium for every address.
+
+    Attributes:
+        resources (dict): The simulated resource of each address opened so far.
+    """
+
+    def __init__(self, **instrument_settings):
+        self.instrument_settings = instrument_settings
+        self.resources = {}
+
+    def open_resource(self, address):
+        if address not in self.resources:
+            self.resources[address] = SimulatedInfiniium(**self.instrument_settings)
+        return self.resources[address]
+
+    def list_resources(self, query="?*::INSTR"):
+        return tuple(self.resources)
+
+    def close(self):
+        pass
@@ -0,0 +1,226 @@
+"""
+Mercury™ network simulator behind a pseudo-terminal (Linux/macOS).
+
+The simulator answers the native ASCII commands on the master side of a pty, so the serial backend
+(devices.MercurySerial) can be run unchanged against its slave device:
+
+    with MercurySimulator(axes=(1, 2)) as sim:
+        wrapper = MercurySerial('M1121DG', sim.port)
+        wrapper.open()
+"""
+
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+
+from devices.mercury_serial import default_velocity, default_acceleration
+
+REPORT_END = b'\r\n\x03'
+ADDRESS_CHARS = '0123456789ABCDEF'
+
+
+class SimulatedAxis:
+    """
+    One controller of the network. Moves follow a trapezoidal velocity profile computed from the
+    programmed velocity (SV) and acceleration (SA), so the position can be evaluated at any time.
+    The controller still reports moving during settle_time after the end of the profile, as the servo settles.
+    """
+
+    def __init__(self, velocity=default_velocity, acceleration=default_acceleration, settle_time=0.01):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.settle_time = settle_time
+        self.start = 0
+        self.target = 0
+        self.t0 = 0.0
+
+    def _profile(self, now):
+        distance = self.target - self.start
+        length = abs(distance)
+        t = now - self.t0
+        if length == 0:
+            return self.target, t < self.settle_time
+        # Triangular profile when the velocity cannot be reached
+        v_max = min(self.velocity, np.sqrt(length * self.acceleration))
+        t_acc = v_max / self.acceleration
+        t_total = length / v_max + t_acc
+        if t >= t_total:
+            return self.target, t < t_total + self.settle_time
+        if t < t_acc:
+            travelled = 0.5 * self.acceleration * t ** 2
+        elif t < t_total - t_acc:
+            travelled = 0.5 * self.acceleration * t_acc ** 2 + v_max * (t - t_acc)
+        else:
+            travelled = length - 0.5 * self.acceleration * (t_total - t) ** 2
+        return self.start + int(np.sign(distance) * travelled), True
+
+    def position(self, now=None):
+        return self._profile(time.monotonic() if now is None else now)[0]
+
+    def moving(self, now=None):
+        return self._profile(time.monotonic() if now is None else now)[1]
+
+    def move_to(self, target):
+        now = time.monotonic()
+        self.start = self.position(now)
+        self.target = int(target)
+        self.t0 = now
+
+    def set_motion(self, velocity=None, acceleration=None):
+        """
+        Programs the velocity (SV) or the acceleration (SA) from now on; a move in progress restarts from its current position.
+        """
+        now = time.monotonic()
+        position, moving = self._profile(now)
+        self.start = position
+        self.t0 = now if moving else now - self.settle_time
+        if velocity is not None:
+            self.velocity = velocity
+        if acceleration is not None:
+            self.acceleration = acceleration
+
+    def stop(self):
+        self.start = self.target = self.position()
+        self.t0 = time.monotonic() - self.settle_time
+
+    def status(self):
+        on_target = 0 if self.moving() else 0x04
+        return f"S:0{on_target:X} 00 00 01 00 00"
+
+
+class MercurySimulator:
+    """
+    A network of simulated Mercury™ controllers answering on a pseudo-terminal.
+
+    Attributes:
+        port (str): The slave device to open with the serial backend, e.g. '/dev/pts/5'.
+        axes (dict): The SimulatedAxis of each device number.
+        baud_rate (int): The simulated line rate; every character takes 10 bits each way, None for no delay.
+        commands (list): Every base or single-character command received, as (axis, command).
+    """
+
+    def __init__(self, axes=(1,), velocity=default_velocity, acceleration=default_acceleration, settle_time=0.01, baud_rate=9600):
+        self.axes = {axis: SimulatedAxis(velocity, acceleration, settle_time) for axis in axes}
+        self.baud_rate = baud_rate
+        self.commands = []
+        self._selected = None
+        self._line = b''
+        self._running = False
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self):
+        pending = b''
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            received = os.read(self._master, 4096)
+            self._line_delay(len(received))
+            pending += received
+            while pending:
+                # The address selection code is the only sequence of two characters without terminator
+                if pending[:1] == b'\x01':
+                    if len(pending) < 2:
+                        break
+                    address = ADDRESS_CHARS.find(pending[1:2].decode(errors='replace').upper())
+                    self._selected = address + 1 if address + 1 in self.axes else None
+                    pending = pending[2:]
+                    continue
+                char, pending = pending[:1], pending[1:]
+                if self._selected is None:
+                    continue
+                self._receive(char)
+
+    def _line_delay(self, characters):
+        if self.baud_rate:
+            time.sleep(characters * 10 / self.baud_rate)
+
+    def _reply(self, text, terminated=True):
+        data = text.encode() + (REPORT_END if terminated else b'')
+        self._line_delay(len(data))
+        os.write(self._master, data)
+
+    def _receive(self, char):
+        axis = self.axes[self._selected]
+        singles = {b'\\': None, b"'": 'TP', b'%': 'TS', b'+': 'TE', b'!': 'AB'}
+        if not self._line and char in singles:
+            self.commands.append((self._selected, char.decode()))
+            if char == b'\\':
+                self._reply('1' if axis.moving() else '0', terminated=False)
+            else:
+                self._execute(axis, singles[char])
+        elif char == b'\r':
+            for command in self._line.decode().replace(' ', '').upper().split(','):
+                if command:
+                    self.commands.append((self._selected, command))
+                    self._execute(axis, command)
+            self._line = b''
+        else:
+            self._line += char
+
+    def _execute(self, axis, command):
+        code, argument = command[:2], command[2:]
+        value = int(argument) if argument.lstrip('+-').isdigit() else None
+        if code == 'TP':
+            self._reply(f"P:{axis.position():+011d}")
+        elif code == 'TT':
+            self._reply(f"T:{axis.target:+011d}")
+        elif code == 'TE':
+            self._reply(f"E:{axis.target - axis.position():+011d}")
+        elif code == 'TF':
+            self._reply(f"F:{0:+011d}")
+        elif code == 'TY':
+            self._reply(f"Y:{int(axis.velocity):+011d}")
+        elif code == 'TL':
+            self._reply(f"L:{int(axis.acceleration):+011d}")
+        elif code == 'TS':
+            self._reply(axis.status())
+        elif code == 'VE':
+            self._reply("Mercury simulator")
+        elif code == 'MA' and value is not None:
+            axis.move_to(value)
+        elif code == 'MR' and value is not None:
+            axis.move_to(axis.target + value)
+        elif code == 'SV' and value is not None:
+            axis.set_motion(velocity=value)
+        elif code == 'SA' and value is not None:
+            axis.set_motion(acceleration=value)
+        elif code == 'GH':
+            axis.move_to(0)
+        elif code == 'FE':
+            # The reference switch is put at the origin of the simulated travel
+            axis.move_to(0)
+        elif code == 'DH':
+            axis.start = axis.target = 0
+            axis.t0 -= axis.settle_time
+        elif code == 'AB':
+            axis.stop()  # AB1 decelerates on a controller, the simulated axis stops at once
+        elif code == 'WS':
+            while axis.moving():
+                time.sleep(0.001)
@@ -0,0 +1 @@
+from .run_file import RunWriter, RunReader
@@ -0,0 +1,433 @@
+"""
+Binary run container for the waveforms acquired during a scan.
+
+A run is a directory holding:
+    run.json    the scaling of every distinct preamble, the calibration of the quadratures and general information about the run
+    codes.npy   the raw oscilloscope codes, one row of int8 (BYTE) or int16 (WORD) values per shot (optional)
+    quadratures.npy  the pulse quadratures extracted from each shot, one row of float32 values per shot (optional)
+    index.npy   one (position, pass, shot, preamble) record per shot, i.e. per row of codes.npy and quadratures.npy
+
+The time axis is never stored, it is rebuilt from x_origin and x_increment. The .npy files are
+regular NumPy files whose header is rewritten after every append, so a run can be opened with
+np.load(..., mmap_mode="r") at any time, including while it is still being written. The files are
+preallocated in chunks and the shots are copied into a writable memory map, so an append is a
+memcpy of the buffer received from the oscilloscope followed by a header update.
+"""
+
+import json
+import os
+import datetime
+import numpy as np
+
+index_dtype = np.dtype([("position", "<f8"), ("pass", "<i4"), ("shot", "<i8"), ("preamble", "<i4")])
+
+_HEADER_LENGTH = 256  # Fixed .npy header length of the new files, large enough for any shape reached in practice
+_CHUNK_BYTES = 64 * 2 ** 20  # The data files grow by at least this size, to avoid extending them at every shot
+_INDEX_CHUNK_BYTES = 2 ** 20
+_SCALING_KEYS = ("x_increment", "x_origin", "x_units", "y_increment", "y_origin", "y_units")
+
+
+class _AppendableNpy:
+    """
+    A .npy file whose first dimension grows as rows are appended.
+
+    The file is preallocated in chunks beyond the rows written; the header always gives the number of
+    rows actually written, so readers ignore the preallocated tail.
+    """
+
+    def __init__(self, path, dtype=None, row_shape=(), chunk_bytes=_CHUNK_BYTES):
+        """
+        Opens an existing .npy file for appending, or creates an empty one.
+
+        :param path: The path of the .npy file.
+        :param dtype: The dtype of the rows, only used when the file is created.
+        :param row_shape: The shape of a single row, only used when the file is created.
+        :param chunk_bytes: The minimum growth of the file when its preallocated space is full.
+        """
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        if os.path.exists(path):
+            self.file = open(path, "r+b")
+            np.lib.format.read_magic(self.file)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(self.file)
+            # Files written with a shorter fixed header are still appended to in place
+            self.header_length = self.file.tell()
+            if self.header_length % 64:
+                raise IOError(f"{path} was not written by this module")
+            self.rows, self.row_shape = shape[0], tuple(shape[1:])
+            self.dtype = dtype
+        else:
+            self.file = open(path, "w+b")
+            self.header_length = _HEADER_LENGTH
+            self.rows, self.row_shape = 0, tuple(row_shape)
+            self.dtype = np.dtype(dtype)
+            self._write_header()
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+        self.capacity = max(os.path.getsize(path) - self.header_length, 0) // max(self.row_bytes, 1)
+        self._map = None
+
+    def _write_header(self):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.rows,) + self.row_shape,
+        })
+        if len(header) + 10 + 1 > self.header_length:
+            raise IOError(f"the header of {self.path} does not fit in {self.header_length} bytes")
+        header = header.ljust(self.header_length - 10 - 1) + "\n"
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1"))
+
+    def _reserve(self, rows):
+        """
+        Makes room for rows more rows, growing the file by at least chunk_bytes and remapping it.
+        """
+        if self._map is not None and self.rows + rows <= self.capacity:
+            return
+        if self.rows + rows > self.capacity:
+            self.capacity = max(self.rows + rows, self.capacity + self.chunk_bytes // max(self.row_bytes, 1))
+            self.file.truncate(self.header_length + self.capacity * self.row_bytes)
+        if self._map is not None:
+            self._map.flush()
+        self._map = np.memmap(self.file, dtype=self.dtype, mode="r+", offset=self.header_length,
+                              shape=(self.capacity,) + self.row_shape)
+
+    def append(self, rows):
+        """
+        Copies rows at the end of the file and updates the header.
+
+        :param rows: An array of shape (n,) + row_shape.
+        """
+        rows = np.asanyarray(rows)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError(f"rows of shape {rows.shape[1:]} cannot be appended to {self.path} with rows of shape {self.row_shape}")
+        if self.row_bytes == 0 or len(rows) == 0:
+            return
+        self._reserve(len(rows))
+        # The rows are written before the header, so readers never see a row that is not complete
+        self._map[self.rows:self.rows + len(rows)] = rows
+        self.rows += len(rows)
+        self._write_header()
+        self.file.flush()  # Makes the new header visible to readers, the mapped pages are shared with them
+
+    def truncate(self, rows):
+        """
+        Drops the rows after the first ones; the file keeps its size and the dropped rows are overwritten by the next appends.
+        """
+        if rows < self.rows:
+            self.rows = rows
+            self._write_header()
+            self.file.flush()
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+        self.file.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map = None
+        try:
+            # Drops the preallocated tail, the file is then a plain .npy file
+            self.file.truncate(self.header_length + self.rows * self.row_bytes)
+        except OSError:
+            pass  # The file is still mapped by a reader (Windows); the header keeps the tail invisible
+        self.file.close()
+
+
+class RunWriter:
+    """
+    Appends the shots of a scan to a run directory.
+
+    Attributes:
+        path (str): The run directory.
+        info (dict): The content of run.json.
+    """
+
+    def __init__(self, path, metadata=None):
+        """
+        Opens a run directory for appending, creating it if needed.
+
+        :param path: The run directory.
+        :param metadata: Free information stored in run.json when the run is created (oscilloscope settings, stage, ...).
+        """
+        self.path = path
+        self.codes = None
+        self.quadratures = None
+        self.shot_counts = {}
+        self.visits = {}  # Number of append calls (passes) per position
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, "run.json")):
+            with open(os.path.join(path, "run.json")) as f:
+                self.info = json.load(f)
+            if os.path.exists(os.path.join(path, "codes.npy")):
+                self.codes = _AppendableNpy(os.path.join(path, "codes.npy"))
+            if os.path.exists(os.path.join(path, "quadratures.npy")):
+                self.quadratures = _AppendableNpy(os.path.join(path, "quadratures.npy"))
+            self.index = _AppendableNpy(os.path.join(path, "index.npy"), chunk_bytes=_INDEX_CHUNK_BYTES)
+            # The data is appended before the index, the rows of an interrupted append are dropped
+            for stream in (self.codes, self.quadratures):
+                if stream is not None:
+                    stream.truncate(self.index.rows)
+            self._count_shots()
+        else:
+            self.info = {
+                "created": datetime.datetime.now().isoformat(),
+                "dtype": None,
+                "points": None,
+                "pulses": None,
+                "calibration": None,
+                "preambles": [],
+                "metadata": metadata or {},
+            }
+            self.index = _AppendableNpy(os.path.join(path, "index.npy"), index_dtype, chunk_bytes=_INDEX_CHUNK_BYTES)
+            self._write_info()
+
+    def _count_shots(self):
+        """
+        Rebuilds the shot and pass counts of every position from the index file.
+        """
+        self.shot_counts = {}
+        self.visits = {}
+        index = np.load(os.path.join(self.path, "index.npy"), mmap_mode="r")
+        for position in np.unique(index["position"]):
+            at_position = index[index["position"] == position]
+            self.shot_counts[float(position)] = len(at_position)
+            # Runs written before the pass numbers were stored count as a single pass
+            self.visits[float(position)] = int(at_position["pass"].max()) + 1 if "pass" in index.dtype.names else 1
+
+    def __len__(self):
+        return self.index.rows
+
+    def truncate(self, shots):
+        """
+        Drops every shot after the first ones, e.g. the shots written after the last checkpoint of an interrupted scan.
+
+        :param shots: The number of shots kept.
+        """
+        if shots >= self.index.rows:
+            return
+        for stream in (self.codes, self.quadratures, self.index):
+            if stream is not None:
+                stream.truncate(shots)
+        self._count_shots()
+
+    @property
+    def calibration(self):
+        """
+        The calibration of the quadratures (see analysis.QuadratureExtractor.calibration), or None.
+        """
+        return self.info.get("calibration")
+
+    def save_calibration(self, calibration):
+        """
+        Stores the calibration of the quadratures in run.json, so that a resumed run extracts them the same way.
+
+        :param calibration: The dict returned by analysis.QuadratureExtractor.calibration.
+        """
+        if calibration.get("pulses") is not None and self.info["pulses"] not in (None, calibration["pulses"]):
+            raise ValueError(f"the run holds {self.info['pulses']} quadratures per shot, the calibration gives {calibration['pulses']}")
+        self.info["calibration"] = calibration
+        self._write_info()
+
+    def _write_info(self):
+        tmp_name = os.path.join(self.path, "run.json.tmp")
+        with open(tmp_name, "w") as f:
+            json.dump(self.info, f, indent=2)
+        os.replace(tmp_name, os.path.join(self.path, "run.json"))
+
+    def _preamble_id(self, preamble):
+        """
+        Returns the index of a preamble in run.json, registering it if its scaling was never seen.
+
+        :param preamble: The tuple returned by InfiniiumOscilloscope.get_preamble.
+        """
+        scaling = dict(zip(_SCALING_KEYS, preamble[:6]))
+        for i, known in enumerate(self.info["preambles"]):
+            if all(known[key] == scaling[key] for key in _SCALING_KEYS):
+                return i
+        scaling["date"], scaling["time"] = preamble[6], preamble[7]
+        self.info["preambles"].append(scaling)
+        self._write_info()
+        return len(self.info["preambles"]) - 1
+
+    def append(self, position, codes, preamble, quadratures=None, pass_number=None):
+        """
+        Appends one or several shots acquired at the same stage position. The codes are copied as they are,
+        without conversion, when they already have the dtype of the run.
+
+        :param position: The stage position of the shots.
+        :param codes: The raw codes of a shot (1D array) or of several shots (2D array, one shot per row),
+                      or None to only store the quadratures.
+        :param preamble: The tuple returned by InfiniiumOscilloscope.get_preamble for these shots.
+        :param quadratures: The quadratures of the pulses of every shot (see analysis.QuadratureExtractor), or None.
+        :param pass_number: The pass of the scan, or None to count the previous appends at this position,
+                            i.e. one append per visit of the position.
+        :return: The shot numbers given to the appended shots.
+        """
+        if codes is None and quadratures is None:
+            raise ValueError("nothing to append, codes and quadratures are both None")
+        if self.index.rows > 0 and ((codes is None) != (self.codes is None) or (quadratures is None) != (self.quadratures is None)):
+            raise ValueError("every shot of a run must store the same data (codes and/or quadratures)")
+        if codes is not None:
+            codes = np.atleast_2d(codes)
+            if self.codes is None:
+                self.info["dtype"] = codes.dtype.str
+                self.info["points"] = codes.shape[1]
+                self.codes = _AppendableNpy(os.path.join(self.path, "codes.npy"), codes.dtype, codes.shape[1:])
+                self._write_info()
+        if quadratures is not None:
+            quadratures = np.atleast_2d(quadratures)
+            if self.quadratures is None:
+                self.info["pulses"] = quadratures.shape[1]
+                self.quadratures = _AppendableNpy(os.path.join(self.path, "quadratures.npy"), np.float32, quadratures.shape[1:])
+                self._write_info()
+        shots = len(codes) if codes is not None else len(quadratures)
+        position = float(position)
+        first_shot = self.shot_counts.get(position, 0)
+        if pass_number is None:
+            pass_number = self.visits.get(position, 0)
+        records = np.empty(shots, dtype=self.index.dtype)
+        records["position"] = position
+        if "pass" in records.dtype.names:
+            records["pass"] = pass_number
+        records["shot"] = np.arange(first_shot, first_shot + shots)
+        records["preamble"] = self._preamble_id(preamble)
+        if codes is not None:
+            self.codes.append(codes)
+        if quadratures is not None:
+            self.quadratures.append(quadratures)
+        self.index.append(records)
+        self.shot_counts[position] = first_shot + shots
+        self.visits[position] = max(self.visits.get(position, 0), pass_number + 1)
+        return records["shot"]
+
+    def flush(self):
+        for stream in (self.codes, self.quadratures, self.index):
+            if stream is not None:
+                stream.flush()
+
+    def close(self):
+        for stream in (self.codes, self.quadratures, self.index):
+            if stream is not None:
+                stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RunReader:
+    """
+    Lazy access to a run directory written by RunWriter. The codes are memory-mapped and only the
+    shots that are asked for are read from disk. A run still being written can be followed with refresh.
+
+    Attributes:
+        info (dict): The content of run.json.
+        index (numpy.ndarray): The (position, pass, shot, preamble) record of every shot.
+        codes (numpy.memmap): The raw codes, one shot per row (no column if the raw codes were not stored).
+        quadratures (numpy.memmap): The pulse quadratures, one shot per row (no column if they were not stored).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The run directory.
+        """
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reloads run.json and the file headers, to see the shots appended since the run was opened.
+
+        :return: The number of shots now available.
+        """
+        with open(os.path.join(self.path, "run.json")) as f:
+            self.info = json.load(f)
+        self.index = np.load(os.path.join(self.path, "index.npy"))
+        self.codes = self._load("codes.npy", self.info.get("dtype") or np.int8)
+        self.quadratures = self._load("quadratures.npy", np.float32)
+        # While the run is being written, one of the files may be a few shots ahead of the others
+        shots = min([len(self.index)] + [len(data) for data in (self.codes, self.quadratures) if data.shape[1] > 0])
+        self.index, self.codes, self.quadratures = self.index[:shots], self.codes[:shots], self.quadratures[:shots]
+        return shots
+
+    def _load(self, name, dtype):
+        if os.path.exists(os.path.join(self.path, name)):
+            return np.load(os.path.join(self.path, name), mmap_mode="r")
+        return np.zeros((len(self.index), 0), dtype=dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def positions(self):
+        """
+        The distinct stage positions of the run, in acquisition order.
+        """
+        _, first = np.unique(self.index["position"], return_index=True)
+        return self.index["position"][np.sort(first)]
+
+    @property
+    def passes(self):
+        """
+        The number of passes of the run.
+        """
+        if "pass" not in self.index.dtype.names:
+            return 1 if len(self.index) else 0
+        return int(self.index["pass"].max()) + 1 if len(self.index) else 0
+
+    def select(self, position=None, shot=None, pass_number=None):
+        """
+        Returns the row numbers of the shots matching a stage position, a shot number and/or a pass.
+
+        :param position: The stage position, or None for every position.
+        :param shot: The shot number at that position, or None for every shot.
+        :param pass_number: The pass of the scan, or None for every pass.
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        if position is not None:
+            mask &= self.index["position"] == position
+        if pass_number is not None:
+            mask &= (self.index["pass"] if "pass" in self.index.dtype.names else 0) == pass_number
+        if shot is not None:
+            mask &= self.index["shot"] == shot
+        return np.flatnonzero(mask)
+
+    def times(self, preamble=0):
+        """
+        Rebuilds the time axis of the shots.
+
+        :param preamble: The index of the preamble in run.json.
+        """
+        scaling = self.info["preambles"][preamble]
+        return scaling["x_origin"] + np.arange(self.info["points"] or 0) * scaling["x_increment"]
+
+    def voltages(self, position=None, shot=None, pass_number=None):
+        """
+        Reads and scales the shots matching a stage position, a shot number and/or a pass.
+
+        :param position: The stage position, or None for every position.
+        :param shot: The shot number at that position, or None for every shot.
+        :param pass_number: The pass of the scan, or None for every pass.
+        :return: A (shots x points) array of voltages.
+        """
+        rows = self.select(position, shot, pass_number)
+        y_increment = np.array([p["y_increment"] for p in self.info["preambles"]])
+        y_origin = np.array([p["y_origin"] for p in self.info["preambles"]])
+        preamble = self.index["preamble"][rows]
+        return self.codes[rows] * y_increment[preamble, None] + y_origin[preamble, None]
+
+    def quadrature_values(self, position=None, shot=None, pass_number=None):
+        """
+        Reads the quadratures of the shots matching a stage position, a shot number and/or a pass.
+
+        :param position: The stage position, or None for every position.
+        :param shot: The shot number at that position, or None for every shot.
+        :param pass_number: The pass of the scan, or None for every pass.
+        :return: A (shots x pulses) array of quadratures.
+        """
+        return np.asarray(self.quadratures[self.select(position, shot, pass_number)])
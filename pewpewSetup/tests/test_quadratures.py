@@ -0,0 +1,53 @@
+"""
+Quadrature extraction against pulse trains of known areas.
+
+Run from the pewpewSetup directory:
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from analysis import QuadratureExtractor, find_pulse_train
+
+preamble = (1e-9, 0.0, "SECOND", 0.01, 0.0, "VOLT", "1 JAN 2024", "00:00:00:00")
+period = 50.0
+offset = 13.0  # Neither 0 nor half a period, so that a wrong sign of the offset shows
+points = 2000
+
+
+def pulse_records(rng, records, jitter=0.0):
+    """
+    Returns the codes of records of Gaussian pulses of random areas and the areas, one row per record.
+    """
+    t = np.arange(points)
+    centers = offset + period * np.arange(int(points / period))
+    areas = rng.standard_normal((records, len(centers)))
+    shifts = rng.uniform(-jitter, jitter, records)
+    shapes = np.exp(-0.5 * ((t - centers[:, None] - shifts[:, None, None]) / 3.0) ** 2)
+    volts = np.einsum("rk,rkt->rt", areas, shapes) + 0.02 * rng.standard_normal((records, points))
+    return np.clip(np.rint(volts / preamble[3]), -128, 127).astype(np.int8), areas
+
+
+def test_offset_is_the_center_of_the_first_pulse():
+    t = np.arange(points)
+    energy = np.exp(-0.5 * ((t - offset - period * np.arange(int(points / period))[:, None]) / 3.0) ** 2).sum(axis=0) ** 2
+    assert find_pulse_train(energy, period)[1] == pytest.approx(offset, abs=0.01)
+    estimated_period, estimated_offset = find_pulse_train(energy)
+    assert estimated_period == pytest.approx(period, rel=1e-4)
+    assert estimated_offset == pytest.approx(offset, abs=0.1)
+
+
+@pytest.mark.parametrize("mode", QuadratureExtractor.modes)
+@pytest.mark.parametrize("track_phase", [False, True])
+def test_quadratures_follow_the_pulse_areas(mode, track_phase):
+    rng = np.random.default_rng(0)
+    extractor = QuadratureExtractor(mode, track_phase=track_phase)
+    extractor.calibrate(pulse_records(rng, 16)[0], preamble)
+    assert extractor.offset == pytest.approx(offset, abs=0.5)
+
+    codes, areas = pulse_records(rng, 8, jitter=2.0 if track_phase else 0.0)
+    quadratures = extractor.extract(codes, preamble)
+    # The pulses integrated are the complete ones from the first pulse number on
+    expected = areas[:, extractor.pulse_numbers]
+    assert np.corrcoef(quadratures.ravel(), expected.ravel())[0, 1] > 0.99
@@ -0,0 +1,144 @@
+"""
+Resuming an interrupted scan whose shots are stored as quadratures.
+
+Run from the pewpewSetup directory:
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from analysis import QuadratureExtractor
+from scanning import ResumableScan, ScanPlan
+from storage import RunReader, RunWriter
+
+preamble = (1e-9, 0.0, "SECOND", 0.02, 0.0, "VOLT", "1 JAN 2024", "00:00:00:00")
+period = 100.0
+points = 1000
+
+
+def pulse_records(rng, records):
+    """
+    Balanced detector records: pulses of random sign and area every period samples, with white noise.
+    """
+    t = np.arange(points)
+    centers = 37.0 + period * np.arange(int(points / period))
+    areas = rng.standard_normal((records, len(centers)))
+    volts = areas @ np.exp(-0.5 * ((t - centers[:, None]) / 6.0) ** 2) + 0.15 * rng.standard_normal((records, points))
+    return np.clip(np.rint(volts / preamble[3]), -128, 127).astype(np.int8)
+
+
+class Wrapper:
+    def counts_to_units(self, counts):
+        return counts * 1e-3
+
+    def units_to_counts(self, units):
+        return int(units * 1e3)
+
+
+class Stage:
+    """
+    A stage reaching every target at once.
+    """
+
+    def start_move_counts(self, counts):
+        self.counts = counts
+
+    def wait_motion(self, timeout=30.0):
+        return True
+
+    def stop_motion(self):
+        pass
+
+    def get_position(self):
+        return self.counts * 1e-3
+
+
+def scan(path, plan, extractor, rng, crash_after=None):
+    writer = RunWriter(path)
+
+    def acquire():
+        pass
+
+    def transfer():
+        return pulse_records(rng, 4), preamble
+
+    def store(position, waveform):
+        codes, scaling = waveform
+        writer.append(position, codes, scaling, extractor.extract(codes, scaling))
+        if crash_after is not None and len(writer) >= crash_after:
+            raise IOError("simulated crash")
+
+    try:
+        ResumableScan(writer, plan, Stage(), acquire, transfer, store).run()
+    finally:
+        writer.close()
+
+
+def test_resume_keeps_the_calibration(tmp_path):
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "run")
+    plan = ScanPlan(np.arange(0, 60, 10), np.zeros(6), Wrapper())
+
+    extractor = QuadratureExtractor("template")
+    extractor.calibrate(pulse_records(rng, 16), preamble)
+    with RunWriter(path) as writer:
+        writer.save_calibration(extractor.calibration())
+    with pytest.raises(RuntimeError, match="simulated crash"):
+        scan(path, plan, extractor, rng, crash_after=12)
+
+    # The resumed run extracts the quadratures with the stored calibration, not with a new one
+    with RunWriter(path) as writer:
+        resumed = QuadratureExtractor.from_calibration(writer.calibration)
+    for name in ("period", "offset", "pulses"):
+        assert getattr(resumed, name) == getattr(extractor, name)
+    scan(path, plan, resumed, rng)
+
+    reader = RunReader(path)
+    assert len(reader) == 4 * len(plan)
+    assert reader.quadratures.shape == (4 * len(plan), extractor.pulses)
+    assert sorted(set(reader.index["position"])) == [plan.wrapper.counts_to_units(c) for c in plan.counts]
+    # Every stored quadrature, before and after the resume, is the one of the original calibration
+    resumed_rows = reader.select() >= 12
+    assert resumed_rows.any()
+    np.testing.assert_allclose(reader.quadratures, extractor.extract(np.asarray(reader.codes), preamble), rtol=1e-5, atol=1e-6)
+    # whereas a new calibration, on other records, would not give them
+    other = QuadratureExtractor("template", pulses=extractor.pulses).calibrate(pulse_records(np.random.default_rng(5), 16), preamble)
+    assert not np.allclose(reader.quadratures[resumed_rows], other.extract(np.asarray(reader.codes[resumed_rows]), preamble))
+
+
+def test_calibration_must_match_the_stored_quadratures(tmp_path):
+    rng = np.random.default_rng(1)
+    writer = RunWriter(str(tmp_path / "run"))
+    extractor = QuadratureExtractor("boxcar", period=period).calibrate(pulse_records(rng, 1), preamble)
+    writer.append(0.0, None, preamble, extractor.extract(pulse_records(rng, 2), preamble))
+    other = QuadratureExtractor("boxcar", period=period, pulses=extractor.pulses - 1).calibrate(pulse_records(rng, 1), preamble)
+    with pytest.raises(ValueError):
+        writer.save_calibration(other.calibration())
+    writer.close()
+
+
+def test_failed_transfer_is_acquired_on_resume(tmp_path):
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / "run")
+    plan = ScanPlan(np.arange(0, 60, 10), np.zeros(6), Wrapper())
+    extractor = QuadratureExtractor("boxcar", period=period).calibrate(pulse_records(rng, 4), preamble)
+    transfers = []
+
+    def transfer():
+        transfers.append(None)
+        return None if len(transfers) == 3 else (pulse_records(rng, 4), preamble)
+
+    def store(position, waveform):
+        codes, scaling = waveform
+        writer.append(position, None, scaling, extractor.extract(codes, scaling))
+
+    with RunWriter(path) as writer:
+        timings = ResumableScan(writer, plan, Stage(), lambda: None, transfer, store).run()
+    assert [step for step, _ in timings.failed] == [2]
+    with RunWriter(path) as writer:
+        scan = ResumableScan(writer, plan, Stage(), lambda: None, transfer, store)
+        assert scan.manifest.remaining() == [2]
+        scan.run()
+        assert scan.done
+    assert len(RunReader(path)) == 4 * len(plan)
@@ -0,0 +1 @@
+from .tracer import Tracer
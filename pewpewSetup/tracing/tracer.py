@@ -0,0 +1,199 @@
+"""
+Opt-in latency tracing of the instrument I/O.
+
+A Tracer records (category, name, start, duration, bytes, thread) events in a fixed-size ring buffer.
+Instruments are traced by replacing their I/O object with a proxy timing every call:
+
+    tracer = Tracer()
+    oscilloscope.enable_tracing(tracer)    # every VISA write/query, named by SCPI header
+    stage.wrapper.enable_tracing(tracer)   # every MMC.dll call, or every serial read/write
+    scan = PipelinedScan(stage, acquire, transfer, store, tracer=tracer)  # the scan phases and file writes
+    ...
+    tracer.summary()
+    tracer.export_chrome_trace("scan_trace.json")  # open in https://ui.perfetto.dev or chrome://tracing
+
+Nothing is wrapped while tracing is disabled, so the drivers run at full speed.
+"""
+
+import itertools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def _nbytes(value):
+    """
+    Returns the size of a value moved over the bus: strings, bytes and arrays count, numbers and None do not.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    return getattr(value, "nbytes", 0)
+
+
+class _TracedObject:
+    """
+    Proxy timing every method call of an object (a pyvisa resource, a ctypes library, a serial port).
+    Attributes that are not callable are read and written through to the object.
+    """
+
+    def __init__(self, target, tracer, category):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_tracer", tracer)
+        object.__setattr__(self, "_category", category)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        tracer, category = self._tracer, self._category
+
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            result = attribute(*args, **kwargs)
+            duration = time.perf_counter() - start
+            # SCPI calls are named by the command header, without the arguments
+            label = f"{name} {args[0].split(' ', 1)[0]}" if args and isinstance(args[0], str) else name
+            tracer.add(category, label, start, duration, sum(_nbytes(arg) for arg in args) + _nbytes(result))
+            return result
+
+        object.__setattr__(self, name, traced)  # Later calls skip __getattr__
+        return traced
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+
+class Tracer:
+    """
+    Ring buffer of timed events.
+
+    Attributes:
+        capacity (int): The number of events kept; the oldest events are overwritten.
+        origin (float): The time.perf_counter() value taken as time zero in the exports.
+    """
+
+    def __init__(self, capacity=2 ** 16):
+        """
+        :param capacity: The number of events kept.
+        """
+        self.capacity = capacity
+        self.origin = time.perf_counter()
+        self._events = [None] * capacity
+        self._counter = itertools.count()  # next() is atomic, so events from several threads never collide
+        self._count = 0
+        self._threads = {}  # Names of the threads that recorded events, kept after the threads end
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def wrap(self, target, category):
+        """
+        Returns a proxy of target recording every method call as an event of the category.
+        """
+        return _TracedObject(target, self, category)
+
+    def add(self, category, name, start, duration, nbytes=0):
+        """
+        Records an event.
+
+        :param category: The event group, e.g. "scpi", "mmc", "serial" or "scan".
+        :param name: The event name, e.g. the SCPI header or the DLL function.
+        :param start: The time.perf_counter() value at the start of the event.
+        :param duration: The duration of the event, in seconds.
+        :param nbytes: The number of bytes sent and received.
+        """
+        i = next(self._counter)
+        thread = threading.get_ident()
+        if thread not in self._threads:
+            self._threads[thread] = threading.current_thread().name
+        self._events[i % self.capacity] = (category, name, start, duration, nbytes, thread)
+        self._count = max(self._count, i + 1)
+
+    @contextmanager
+    def span(self, category, name, nbytes=0):
+        """
+        Records the block of a with statement as an event.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(category, name, start, time.perf_counter() - start, nbytes)
+
+    def clear(self):
+        self._events = [None] * self.capacity
+        self._counter = itertools.count()
+        self._count = 0
+        self.origin = time.perf_counter()
+
+    def events(self):
+        """
+        Returns the recorded events in chronological order, as a list of
+        (category, name, start, duration, nbytes, thread) tuples.
+        """
+        return sorted((event for event in self._events if event is not None), key=lambda event: event[2])
+
+    def histograms(self, bins=None):
+        """
+        Returns the latency histogram of every (category, name).
+
+        :param bins: The bin edges in seconds, logarithmic from 1 us to 100 s if None.
+        :return: A tuple (bins, histograms) with histograms mapping (category, name) to the counts in every bin.
+        """
+        bins = np.logspace(-6, 2, 33) if bins is None else np.asarray(bins)
+        durations = {}
+        for category, name, _, duration, _, _ in self.events():
+            durations.setdefault((category, name), []).append(duration)
+        return bins, {key: np.histogram(values, bins)[0] for key, values in durations.items()}
+
+    def statistics(self):
+        """
+        Returns a structured array with the count, total, mean, median, 99th percentile, maximum duration and
+        the bytes of every (category, name), sorted by total time.
+        """
+        groups = {}
+        for category, name, _, duration, nbytes, _ in self.events():
+            group = groups.setdefault((category, name), ([], [0]))
+            group[0].append(duration)
+            group[1][0] += nbytes
+        table = np.zeros(len(groups), dtype=[("category", "U16"), ("name", "U64"), ("count", "i8"), ("total", "f8"),
+                                             ("mean", "f8"), ("median", "f8"), ("p99", "f8"), ("max", "f8"), ("bytes", "i8")])
+        for i, ((category, name), (durations, nbytes)) in enumerate(groups.items()):
+            durations = np.array(durations)
+            table[i] = (category, name, len(durations), durations.sum(), durations.mean(), np.median(durations),
+                        np.percentile(durations, 99), durations.max(), nbytes[0])
+        return np.sort(table, order="total")[::-1]
+
+    def summary(self, limit=20):
+        """
+        Prints the events taking the most time, per (category, name).
+
+        :param limit: The number of lines printed.
+        """
+        table = self.statistics()
+        if self._count > self.capacity:
+            print(f"Only the last {self.capacity} of {self._count} events were kept.")
+        print(f"{'category':<8s} {'name':<40s} {'count':>7s} {'total ms':>10s} {'mean ms':>9s} {'p50 ms':>9s} "
+              f"{'p99 ms':>9s} {'max ms':>9s} {'kB':>9s}")
+        for row in table[:limit]:
+            print(f"{row['category']:<8s} {row['name'][:40]:<40s} {row['count']:>7d} {row['total'] * 1e3:>10.2f} "
+                  f"{row['mean'] * 1e3:>9.3f} {row['median'] * 1e3:>9.3f} {row['p99'] * 1e3:>9.3f} "
+                  f"{row['max'] * 1e3:>9.3f} {row['bytes'] / 1e3:>9.1f}")
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the events in the Chrome trace event format, readable by chrome://tracing and Perfetto.
+        Every thread is a track, the categories can be filtered in the viewer.
+
+        :param path: The .json file written.
+        """
+        events = [{"name": name, "cat": category, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                   "pid": 1, "tid": thread, "args": {"bytes": nbytes}}
+                  for category, name, start, duration, nbytes, thread in self.events()]
+        events += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": thread, "args": {"name": name}}
+                   for thread, name in self._threads.items()]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)